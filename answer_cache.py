@@ -0,0 +1,74 @@
+"""
+語意答案快取（app.py 用）
+
+以「mode + 問題 embedding」為 key：同一個 mode 內 cosine 相似度 >= threshold 的問題視為同一題，直接回傳先前的回答。
+- 每個 mode 各自 LRU（最多 max_entries 筆）+ TTL
+- 每筆綁定該 mode 的 FAISS index 版本；版本變了（資料庫重建並熱更新）整個 mode 失效
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    def __init__(self, threshold: float = 0.92, ttl: float = 3600, max_entries: int = 256):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: Dict[str, OrderedDict] = {}  # { mode: OrderedDict[int, (vec, answer, created)] }
+        self._versions: Dict[str, str] = {}
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(vec) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        return v / n if n else v
+
+    def _bucket(self, mode: str, version: str) -> OrderedDict:
+        if self._versions.get(mode) != version:
+            self._entries[mode] = OrderedDict()
+            self._versions[mode] = version
+        return self._entries[mode]
+
+    def get(self, mode: str, version: str, vec) -> Optional[str]:
+        q = self._normalize(vec)
+        now = time.time()
+        with self._lock:
+            bucket = self._bucket(mode, version)
+            for key in [k for k, (_, _, created) in bucket.items() if now - created > self.ttl]:
+                del bucket[key]
+            if not bucket:
+                self.misses += 1
+                return None
+
+            keys = list(bucket.keys())
+            sims = np.stack([bucket[k][0] for k in keys]) @ q
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses += 1
+                return None
+            bucket.move_to_end(keys[best])
+            self.hits += 1
+            return bucket[keys[best]][1]
+
+    def put(self, mode: str, version: str, vec, answer: str):
+        v = self._normalize(vec)
+        with self._lock:
+            bucket = self._bucket(mode, version)
+            self._next_id += 1
+            bucket[self._next_id] = (v, answer, time.time())
+            while len(bucket) > self.max_entries:
+                bucket.popitem(last=False)
+
+    def invalidate(self, mode: Optional[str] = None):
+        with self._lock:
+            for m in ([mode] if mode else list(self._entries)):
+                self._entries.pop(m, None)
+                self._versions.pop(m, None)
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 import os
 import re
-from datetime import datetime
+import json
+import time
+import queue
+import threading
+import functools
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from itertools import zip_longest
 from urllib.parse import parse_qs
 
 from flask import Flask, request, abort
 
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
     TemplateSendMessage, ButtonsTemplate,
@@ -17,12 +25,27 @@ from linebot.models import (
 from groq import Groq
 
 # === RAG ===
+import faiss
 from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.documents import Document
+from embedding_backend import EMBED_MODEL_NAME, LazyEmbeddings, create_embeddings, embedding_id
+from embedding_cache import DEFAULT_MAX_ENTRIES, with_embedding_cache
+from faq_index import load_faq_index
+from mmap_store import has_mmap_docstore, load_mmap_vectorstore
+from answer_cache import SemanticAnswerCache
+from course_graph import INTENT_GRADUATION, INTENT_NEXT, INTENT_PREREQ, load_course_graph
+from lexical_index import load_lexical_index
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram, current_trace, observe, stage, start_trace
+from prompt_builder import (
+    GROQ_MODEL, RAG_SYSTEM_PROMPT, assemble_messages, estimate_tokens, extractive_answer, normalize_question, rag_user_prompt,
+)
+from retrieval import hybrid_search, load_thresholds, vector_candidates
+from scheduler import FairScheduler, PriorityClass
+from session_store import FirebaseStateBackend, MemoryStateBackend, SQLiteStateBackend
 
 # === Firebase (RTDB) ===
 import firebase_admin
-from firebase_admin import credentials, db
+from firebase_admin import credentials
 
 
 
@@ -40,14 +63,36 @@ LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
 
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
-GROQ_MODEL = os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile")
-
+# GROQ_MODEL 定義在 prompt_builder.py（建庫時的 FAQ 預先回答共用同一個模型）
 
 firebase_enabled = True
 
 # Debug: 是否每次回答後都附上選單（開發方便）
 DEBUG_SHOW_MENU_AFTER_REPLY = os.environ.get("DEBUG_SHOW_MENU_AFTER_REPLY", "1") == "0"
 
+# 非同步 webhook：/callback 驗證簽章後把事件放進佇列立即回 200，由背景 worker 產生回答
+# （同步模式下，除了選單等即時回覆，事件也交給這組 worker 依排程處理，request 等待完成）
+WEBHOOK_ASYNC = os.environ.get("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+# rag / long 各自最多排隊幾個事件，滿了就回覆忙碌訊息
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "100"))
+
+# 公平排程：事件分三個優先等級 instant（選單、切換類別）> rag（資料庫問答）> long（@翻譯 / @摘要），
+# 同一等級內各 sender 輪流；保留 SCHED_RESERVED_WORKERS 個 worker 只處理 instant，LLM 工作再多也不會卡住選單
+SCHED_RESERVED_WORKERS = int(os.environ.get("SCHED_RESERVED_WORKERS", "1"))
+SCHED_RAG_CONCURRENCY = int(os.environ.get("SCHED_RAG_CONCURRENCY", str(max(1, WEBHOOK_WORKERS - 1))))
+SCHED_LONG_CONCURRENCY = int(os.environ.get("SCHED_LONG_CONCURRENCY", "1"))
+# 每個 sender（群組/房間整個算一個）的速率上限：平均每分鐘幾次、最多可連續幾次；超過就回覆請稍候（0 = 不限）
+SCHED_RAG_RATE_PER_MIN = float(os.environ.get("SCHED_RAG_RATE_PER_MIN", "10"))
+SCHED_RAG_BURST = float(os.environ.get("SCHED_RAG_BURST", "5"))
+SCHED_LONG_RATE_PER_MIN = float(os.environ.get("SCHED_LONG_RATE_PER_MIN", "2"))
+SCHED_LONG_BURST = float(os.environ.get("SCHED_LONG_BURST", "2"))
+# 排隊超過幾秒就不處理、改回覆忙碌訊息（0 = 一直等）
+SCHED_RAG_MAX_WAIT = float(os.environ.get("SCHED_RAG_MAX_WAIT", "30"))
+SCHED_LONG_MAX_WAIT = float(os.environ.get("SCHED_LONG_MAX_WAIT", "60"))
+# reply token 有效期有限：事件發生超過這個秒數才要回覆時，改用 push 傳送
+REPLY_TOKEN_SAFE_SECONDS = float(os.environ.get("REPLY_TOKEN_SAFE_SECONDS", "50"))
+
 missing = [k for k, v in {
     "LINE_CHANNEL_ACCESS_TOKEN": LINE_CHANNEL_ACCESS_TOKEN,
     "LINE_CHANNEL_SECRET": LINE_CHANNEL_SECRET,
@@ -74,9 +119,6 @@ MODE_LABELS = {
     "course_requirement": "修課規定",
 }
 
-# 本地狀態（輔助用）：重啟會清空；真正「暫存記憶」放 Firebase
-user_state = {}  # { sender_id: {"mode": "..."} }
-
 # 你的 faiss 路徑：與 app.py 同層 /faiss_db/faiss_db_xxx
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 BASE_FAISS_DIR = os.path.join(BASE_DIR, "faiss_db")
@@ -87,6 +129,143 @@ FAISS_DIR_BY_MODE = {
     "course_requirement": os.path.join(BASE_FAISS_DIR, "faiss_db_course_requirement"),
 }
 
+# Embedding 快取：與 build_faiss_db.py 共用（預設同一個資料夾）；設 EMBED_CACHE_DIR="" 可關閉
+EMBED_CACHE_DIR = os.environ.get("EMBED_CACHE_DIR", os.path.join(BASE_DIR, "embedding_cache"))
+EMBED_CACHE_MAX_ENTRIES = int(os.environ.get("EMBED_CACHE_MAX_ENTRIES", str(DEFAULT_MAX_ENTRIES)))
+
+# 快速啟動：INDEX_LAZY_LOAD=1（預設）時 import 階段不載入模型與資料庫，由背景 warm-up thread 載入
+# （INDEX_WARMUP=0 則完全等到第一次用到才載入）；warm-up 完成前的問題會直接觸發該類別的載入。
+# 設 INDEX_LAZY_LOAD=0 則啟動時同步全部載入完才開始服務
+INDEX_LAZY_LOAD = os.environ.get("INDEX_LAZY_LOAD", "1") == "1"
+INDEX_WARMUP = os.environ.get("INDEX_WARMUP", "1") == "1"
+
+# 熱更新：每 FAISS_RELOAD_INTERVAL 秒檢查各 faiss_db_* 的 manifest 版本，有新版就載入並原子替換（0=關閉）
+FAISS_RELOAD_INTERVAL = float(os.environ.get("FAISS_RELOAD_INTERVAL", "30"))
+# import 時就在本 process 啟動熱更新 watcher；serve.py 設為 0：master 不處理請求，只由 fork 出的 worker 各自啟動
+INDEX_WATCHER_IN_PARENT = os.environ.get("INDEX_WATCHER_IN_PARENT", "1") == "1"
+# 管理端點 POST /admin/reload 的 token（未設定則不開放）
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# 語意答案快取：同 mode 內相似度 >= ANSWER_CACHE_THRESHOLD 的問題直接回傳快取的回答（ANSWER_CACHE=0 關閉）
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.92"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "256"))
+
+# FAQ 預先回答（建庫時 FAQ_GENERATOR 產生，寫在各 faiss_db_* 內的 faq.json / faq.npz）：
+# 問題與已審核 FAQ 的 cosine >= FAQ_MATCH_THRESHOLD 就直接回覆預先產生的答案（FAQ=0 關閉）
+FAQ_ENABLED = os.environ.get("FAQ", "1") == "1"
+FAQ_MATCH_THRESHOLD = float(os.environ.get("FAQ_MATCH_THRESHOLD", "0.9"))
+
+# 問題 embedding：LRU 快取 + micro-batching（QUERY_EMBED_BATCH_WINDOW_MS 內到達的問題合併成一次 forward）
+QUERY_EMBED_CACHE_SIZE = int(os.environ.get("QUERY_EMBED_CACHE_SIZE", "2048"))
+QUERY_EMBED_BATCH_WINDOW_MS = float(os.environ.get("QUERY_EMBED_BATCH_WINDOW_MS", "5"))
+QUERY_EMBED_MAX_BATCH = int(os.environ.get("QUERY_EMBED_MAX_BATCH", "32"))
+
+# sender 狀態（mode + 對話記憶）的儲存後端：memory | sqlite | firebase（未設定時 Firebase 可用就用 firebase，否則 memory）
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "").strip().lower()
+STATE_SQLITE_PATH = os.environ.get("STATE_SQLITE_PATH", os.path.join(BASE_DIR, "state.sqlite3"))
+# 記憶體中的 sender 狀態超過 STATE_TTL 秒沒有互動就淘汰（memory 後端、firebase 後端的 mode 快取）
+STATE_TTL = float(os.environ.get("STATE_TTL", "86400"))
+
+# 對話記憶 session 層：每個 sender 保留最近幾則、最多記住幾個 sender、寫回 Firebase 的間隔秒數
+SESSION_HISTORY_KEEP = int(os.environ.get("SESSION_HISTORY_KEEP", "8"))
+# 每次提問帶進 prompt 的最近幾輪對話（1 輪 = 問題 + 回答 2 則；最多只有 SESSION_HISTORY_KEEP 則可用）
+HISTORY_CONTEXT_TURNS = int(os.environ.get("HISTORY_CONTEXT_TURNS", "4"))
+SESSION_MAX_SENDERS = int(os.environ.get("SESSION_MAX_SENDERS", "10000"))
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "0.5"))
+
+# 檢索門檻：最相關片段的相關度（cosine，0~1）低於門檻就不呼叫 LLM，直接回覆沒有相關資訊
+# 優先順序：RAG_MIN_RELEVANCE_<MODE> 環境變數 > RAG_THRESHOLDS_FILE（calibrate_retrieval.py 產生）> RAG_MIN_RELEVANCE
+RAG_MIN_RELEVANCE = float(os.environ.get("RAG_MIN_RELEVANCE", "0.3"))
+RAG_THRESHOLDS_FILE = os.environ.get("RAG_THRESHOLDS_FILE", os.path.join(BASE_DIR, "retrieval_thresholds.json"))
+RAG_TOP_K = int(os.environ.get("RAG_TOP_K", "3"))
+# MMR：從前 RAG_FETCH_K 個候選中挑出兼顧相關與多樣的 RAG_TOP_K 個（RAG_MMR_LAMBDA 越小越重視多樣性）
+RAG_MMR = os.environ.get("RAG_MMR", "0") == "1"
+RAG_MMR_LAMBDA = float(os.environ.get("RAG_MMR_LAMBDA", "0.5"))
+RAG_FETCH_K = int(os.environ.get("RAG_FETCH_K", "10"))
+# Hybrid 檢索：向量 + BM25（中文字元 bigram，建庫時寫在各 faiss_db_* 內的 lexical.npz）以 RRF 合併；
+# 只被 BM25 找到的片段，命中的查詢 token 比例需 >= RAG_LEXICAL_MIN_COVERAGE
+RAG_HYBRID = os.environ.get("RAG_HYBRID", "1") == "1"
+RAG_LEXICAL_MIN_COVERAGE = float(os.environ.get("RAG_LEXICAL_MIN_COVERAGE", "0.5"))
+
+# 修課規定的先修圖（建庫時寫在 faiss_db_course_requirement/course_graph.json）：
+# 先修/後續課程、課程資訊、畢業學分等問題直接由圖回答；COURSE_GRAPH_LLM=1 則把圖的結果交給 LLM 潤飾措辭
+COURSE_GRAPH_ENABLED = os.environ.get("COURSE_GRAPH", "1") == "1"
+COURSE_GRAPH_LLM = os.environ.get("COURSE_GRAPH_LLM", "0") == "1"
+
+# 自動判斷類別：還沒選類別的使用者直接提問時，以同一個問題 embedding 平行查四個資料庫，
+# 最高分領先第二名至少 AUTO_ROUTE_MARGIN 就用該類別；差距太小時合併前幾名（AUTO_ROUTE_MERGE），都不行才顯示選單
+AUTO_ROUTE = os.environ.get("AUTO_ROUTE", "1") == "1"
+AUTO_ROUTE_MARGIN = float(os.environ.get("AUTO_ROUTE_MARGIN", "0.05"))
+AUTO_ROUTE_MERGE = os.environ.get("AUTO_ROUTE_MERGE", "1") == "1"
+AUTO_ROUTE_MAX_MERGE = int(os.environ.get("AUTO_ROUTE_MAX_MERGE", "2"))
+# 類別分數 = 最相關片段的向量相關度 + AUTO_ROUTE_LEXICAL_WEIGHT × BM25 命中的查詢詞比例
+AUTO_ROUTE_LEXICAL_WEIGHT = float(os.environ.get("AUTO_ROUTE_LEXICAL_WEIGHT", "0.2"))
+# 先修/後續課程、畢業學分問題直接判給有先修圖的類別；先修圖能回答的課程資訊問題（學分、授課…）只在分數上加 AUTO_ROUTE_GRAPH_BONUS
+AUTO_ROUTE_GRAPH_BONUS = float(os.environ.get("AUTO_ROUTE_GRAPH_BONUS", "0.1"))
+
+# Prompt 的 token 預算（估算值）：重疊片段合併、重複行去除後，對話記憶最多佔 PROMPT_HISTORY_SHARE，
+# 放不下的舊回合先縮短成 PROMPT_SUMMARY_TOKENS 再丟棄，最後才截斷排名較後的參考資料
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "3000"))
+PROMPT_HISTORY_SHARE = float(os.environ.get("PROMPT_HISTORY_SHARE", "0.3"))
+PROMPT_SUMMARY_TOKENS = int(os.environ.get("PROMPT_SUMMARY_TOKENS", "80"))
+
+# 回答的延遲預算：從事件發生起 RAG_LATENCY_BUDGET 秒內一定回覆（LLM 以 streaming 取得）；
+# 逾時就先回已產生的部分內容（至少 RAG_MIN_PARTIAL_CHARS 字），否則回從檢索片段摘錄的答案
+RAG_LATENCY_BUDGET = float(os.environ.get("RAG_LATENCY_BUDGET", "20"))
+RAG_MIN_PARTIAL_CHARS = int(os.environ.get("RAG_MIN_PARTIAL_CHARS", "60"))
+# 逾時後 LLM 仍繼續產生，完成時以 push 補送完整回答（會消耗 push 額度，預設關閉）
+RAG_PUSH_LATE_ANSWER = os.environ.get("RAG_PUSH_LATE_ANSWER", "0") == "1"
+# 單次 LLM 呼叫的硬上限（秒）與同時進行的 streaming 數
+RAG_LLM_TIMEOUT = float(os.environ.get("RAG_LLM_TIMEOUT", "120"))
+RAG_LLM_WORKERS = int(os.environ.get("RAG_LLM_WORKERS", "8"))
+# 同一類別、同一個問題（正規化後）同時有多人在問時只算一次，其他人等同一個結果（追問類問題不合併）
+RAG_SINGLE_FLIGHT = os.environ.get("RAG_SINGLE_FLIGHT", "1") == "1"
+
+# 向量庫以 mmap 載入（index.faiss + docstore.bin）；設 FAISS_MMAP=0 或舊版資料夾則改用 FAISS.load_local
+FAISS_MMAP = os.environ.get("FAISS_MMAP", "1") == "1"
+
+# Prometheus 指標：GET /metrics（設 METRICS=0 關閉；設 METRICS_TOKEN 則需帶 Authorization: Bearer <token>）
+METRICS_ENABLED = os.environ.get("METRICS", "1") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+# 抽樣印出單一請求各階段耗時（TRACE 開頭的一行 JSON）；0 = 不印，1 = 每個請求都印
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+
+
+# =============================================================================
+# Metrics
+# =============================================================================
+STAGE_SECONDS = Histogram(
+    "guides_stage_seconds", "Time spent in each request stage", ["stage", "mode"],
+)
+REQUEST_SECONDS = Histogram(
+    "guides_request_seconds", "End-to-end handling time of LINE events", ["kind", "mode", "outcome"],
+)
+CACHE_TOTAL = Counter("guides_cache_total", "Cache lookups", ["cache", "mode", "result"])
+LLM_TOKENS = Counter("guides_llm_tokens_total", "LLM tokens (usage from Groq, estimated if absent)", ["mode", "kind"])
+ERRORS = Counter("guides_errors_total", "Errors by stage", ["stage", "mode"])
+QUEUE_SECONDS = Histogram("guides_queue_seconds", "Time LINE events wait in the scheduler", ["priority"])
+REJECTED = Counter("guides_rejected_total", "LINE events rejected by the scheduler", ["priority", "reason"])
+
+
+def timed(name: str, mode: str = None):
+    return stage(name, STAGE_SECONDS, mode)
+
+
+def trace_set(**fields):
+    trace = current_trace()
+    if trace is not None:
+        trace.set(**fields)
+
+
+def set_outcome(outcome: str):
+    trace_set(outcome=outcome)
+
+
+def count_error(stage_name: str, mode: str = ""):
+    ERRORS.inc(stage=stage_name, mode=mode)
+
 
 def get_sender_id(event) -> str:
     """
@@ -107,6 +286,60 @@ def get_sender_id(event) -> str:
     return "unknown_sender"
 
 
+def get_push_target(event):
+    """
+    push_message 的對象：私聊用 user_id，群組/房間用 group_id / room_id
+    """
+    src = event.source
+    return getattr(src, "group_id", None) or getattr(src, "room_id", None) or getattr(src, "user_id", None)
+
+
+def send_reply(event, messages):
+    """
+    回覆訊息：reply token 還在有效期內就用 reply_message；
+    事件已太舊（非同步處理排隊較久）或 reply 失敗時，改用 push_message 傳給同一個聊天對象。
+    """
+    age = time.time() - (getattr(event, "timestamp", None) or time.time() * 1000) / 1000
+    if age < REPLY_TOKEN_SAFE_SECONDS:
+        try:
+            with timed("line_reply"):
+                line_bot_api.reply_message(event.reply_token, messages)
+            return
+        except LineBotApiError as e:
+            count_error("line_reply")
+            print("reply_message failed, fallback to push:", e)
+
+    target = get_push_target(event)
+    if not target:
+        print("No push target for event, reply dropped.")
+        return
+    try:
+        with timed("line_push"):
+            line_bot_api.push_message(target, messages)
+    except LineBotApiError:
+        count_error("line_push")
+        raise
+
+
+def traced(kind: str):
+    """
+    事件處理包在 Trace 裡：記錄總耗時（依 kind / mode / outcome），並依 TRACE_SAMPLE_RATE 抽樣印出各階段耗時
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(event):
+            with start_trace(kind, STAGE_SECONDS, TRACE_SAMPLE_RATE) as trace:
+                try:
+                    return fn(event)
+                finally:
+                    REQUEST_SECONDS.observe(
+                        trace.elapsed(), kind=kind,
+                        mode=trace.fields.get("mode", ""), outcome=trace.fields.get("outcome", "ok"),
+                    )
+        return wrapper
+    return decorator
+
+
 def build_mode_menu() -> TemplateSendMessage:
     return TemplateSendMessage(
         alt_text="GuidES 功能選單",
@@ -131,24 +364,7 @@ GENERAL_SYSTEM_PROMPT = (
     "回答請適當分段與分行，避免整段黏在一起。"
 )
 
-RAG_SYSTEM_PROMPT = """
-你是一個專業的「GuidES 系所資訊助理」。
-請依據下方【參考資料】回答學生問題，並遵守下列規則：
-
-【內容規則】
-1) 只能根據參考資料回答；若資料不足或無關，請明確說：「系上資料庫目前沒有相關資訊」。
-2) 不要猜測、不補充未出現在資料中的細節。
-
-【格式規則（很重要）】
-- 回答請適當分行，不要整段黏在一起。
-- 優先用條列（• 或 1./2./3.）整理重點。
-- 建議結構：
-  第一行是查詢結論
-  然後列 2–5 點相關内容的條列
-  有URL的話就放上來
-  注意事項：如有日期/資格/截止，獨立一行或條列
-- 使用繁體中文，語氣親切且專業。
-""".strip()
+NO_DATA_REPLY = "系上資料庫目前沒有相關資訊。\n可以換個問法，或輸入ES切換其他類別。"
 
 
 # =============================================================================
@@ -191,172 +407,860 @@ except Exception as e:
 
 
 
-def _mem_base(sender_id: str) -> str:
-    return f"TempMemory/{sender_id}"
+def create_state_backend():
+    """
+    依 STATE_BACKEND 建立 sender 狀態儲存後端；firebase 不可用時退回 memory
+    """
+    kind = STATE_BACKEND or ("firebase" if firebase_enabled else "memory")
+    if kind == "firebase":
+        if firebase_enabled:
+            return FirebaseStateBackend(
+                root="TempMemory",
+                keep=SESSION_HISTORY_KEEP,
+                max_senders=SESSION_MAX_SENDERS,
+                flush_interval=SESSION_FLUSH_INTERVAL,
+                ttl=STATE_TTL,
+            )
+        print("❌ STATE_BACKEND=firebase but Firebase is disabled, using memory backend.")
+    elif kind == "sqlite":
+        try:
+            return SQLiteStateBackend(STATE_SQLITE_PATH, keep=SESSION_HISTORY_KEEP)
+        except Exception as e:
+            print(f"❌ SQLite state backend failed ({STATE_SQLITE_PATH}):", repr(e))
+    elif kind != "memory":
+        print(f"❌ Unknown STATE_BACKEND={kind!r}, using memory backend.")
+    return MemoryStateBackend(keep=SESSION_HISTORY_KEEP, max_senders=SESSION_MAX_SENDERS, ttl=STATE_TTL)
+
 
+# sender 狀態：mode 與同一 mode 內的對話記憶都只透過 state_backend 存取
+state_backend = create_state_backend()
+print(f"✅ State backend: {type(state_backend).__name__}")
 
-def fb_set_mode(sender_id: str, mode: str):
-    if not firebase_enabled:
-        return
+
+# =============================================================================
+# RAG: load multiple FAISS DBs
+# =============================================================================
+# embedding 後端（EMBED_BACKEND=hf / onnx）必須與 build_faiss_db.py 相同；
+# 模型在第一次真的需要計算時才載入（embedding 快取命中時不需要模型）
+EMBEDDING_ID = embedding_id()
+base_embeddings = LazyEmbeddings(lambda: create_embeddings(EMBED_MODEL_NAME))
+embedding_model = with_embedding_cache(
+    base_embeddings, EMBEDDING_ID, EMBED_CACHE_DIR, max_entries=EMBED_CACHE_MAX_ENTRIES,
+)
+
+class QueryEmbeddingService:
+    """
+    問題 embedding 服務：
+    - LRU 快取：key 為正規化後的問題字串（NFKC、去頭尾空白、合併空白、轉小寫）；直接使用模型，不經過 EmbeddingCache
+    - micro-batching：背景 thread 把 window 內陸續到達的問題合併成一次 embed_documents，
+      每個請求各自等待自己的 Future（避免多個 batch size 1 的 forward 互搶 CPU）
+    """
+
+    def __init__(self, embeddings, cache_size: int = 2048, window_ms: float = 5, max_batch: int = 32):
+        self._emb = embeddings
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._window = window_ms / 1000
+        self._max_batch = max(1, max_batch)
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self._start()
+        # 背景 thread 不會跟著 fork 到子 process（serve.py pre-fork 多 worker）：在子 process 重新建立
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, name="query-embedder", daemon=True).start()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return normalize_question(text)
+
+    def embed(self, text: str, timeout: float = 30):
+        key = self.normalize(text)
+        with self._lock:
+            vec = self._cache.get(key)
+            if vec is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                CACHE_TOTAL.inc(cache="query_embedding", result="hit")
+                return vec
+            self.misses += 1
+        CACHE_TOTAL.inc(cache="query_embedding", result="miss")
+        fut = Future()
+        self._queue.put((key, fut))
+        return fut.result(timeout=timeout)
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            keys = list(dict.fromkeys(k for k, _ in batch))
+            t0 = time.perf_counter()
+            try:
+                vecs = dict(zip(keys, self._emb.embed_documents(keys)))
+                STAGE_SECONDS.observe(time.perf_counter() - t0, stage="embed_batch", mode="")
+            except Exception as e:
+                count_error("embed_batch")
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+
+            self.batches += 1
+            with self._lock:
+                for k, v in vecs.items():
+                    self._cache[k] = v
+                    self._cache.move_to_end(k)
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+            for k, fut in batch:
+                fut.set_result(vecs[k])
+
+
+# 使用者問題不寫入磁碟上的 embedding 快取（會隨流量無限成長、請求路徑還要等寫檔），只用 process 內的 LRU
+query_embedder = QueryEmbeddingService(
+    base_embeddings,
+    cache_size=QUERY_EMBED_CACHE_SIZE,
+    window_ms=QUERY_EMBED_BATCH_WINDOW_MS,
+    max_batch=QUERY_EMBED_MAX_BATCH,
+)
+
+
+def load_index_info(path: str) -> dict:
+    """
+    讀 build_faiss_db.py 寫在 manifest.json 的 index 資訊（類型、搜尋參數）；舊版資料夾沒有就回傳 {}
+    """
     try:
-        db.reference(_mem_base(sender_id)).update({"mode": mode})
-    except Exception as e:
-        print("fb_set_mode error:", e)
+        with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+            return json.load(f).get("index", {})
+    except Exception:
+        return {}
 
 
-def fb_get_mode(sender_id: str):
-    if not firebase_enabled:
-        return None
+def read_index_embedding(path: str):
+    """
+    建庫時使用的 embedding 後端（manifest.json 的 config.model）；舊版資料夾沒有就回傳 None
+    """
     try:
-        return db.reference(_mem_base(sender_id) + "/mode").get()
-    except Exception as e:
-        print("fb_get_mode error:", e)
+        with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+            return (json.load(f).get("config") or {}).get("model")
+    except Exception:
         return None
 
 
-def fb_clear_history(sender_id: str):
+def read_index_version(path: str):
     """
-    A) 切換 mode 時清空舊記憶：刪掉 history 整個節點
+    向量庫版本：(manifest.json 的 version, 是否正在發布)。
+    建庫時先標記 publishing 才開始覆寫檔案，全部寫完才換上新 version 並清掉標記；舊版資料夾用 index.faiss 的 mtime
     """
-    if not firebase_enabled:
-        return
     try:
-        db.reference(_mem_base(sender_id) + "/history").delete()
-    except Exception as e:
-        print("fb_clear_history error:", e)
+        with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        version = str(manifest["version"]) if manifest.get("version") else None
+        if version or manifest.get("publishing"):
+            return version, bool(manifest.get("publishing"))
+    except Exception:
+        pass
+    try:
+        return f"mtime-{int(os.path.getmtime(os.path.join(path, 'index.faiss')))}", False
+    except OSError:
+        return None, False
 
 
-def fb_append_history(sender_id: str, role: str, content: str):
-    if not firebase_enabled:
-        return
-    if role not in ("user", "assistant") or not content:
-        return
+def apply_index_search_params(vs, info: dict):
+    """
+    IVF / HNSW 等近似 index 的搜尋參數（nprobe / efSearch）依建庫時的設定套用
+    """
+    ps = faiss.ParameterSpace()
+    for k, v in (info.get("search_params") or {}).items():
+        try:
+            ps.set_index_parameter(vs.index, k, v)
+        except Exception as e:
+            print(f"set index param {k}={v} failed: {e}")
 
-    # 用毫秒時間戳作 key，天然可排序
-    key = str(int(datetime.utcnow().timestamp() * 1000))
-    try:
-        db.reference(_mem_base(sender_id) + f"/history/{key}").set({
-            "role": role,
-            "content": content
-        })
-    except Exception as e:
-        print("fb_append_history error:", e)
+
+def load_vectorstore(path: str):
+    if FAISS_MMAP and has_mmap_docstore(path):
+        return load_mmap_vectorstore(path, embedding_model)
+    return FAISS.load_local(path, embeddings=embedding_model, allow_dangerous_deserialization=True)
 
 
-def fb_load_recent_history(sender_id: str, limit: int = 8):
+class LoadedIndex:
     """
-    讀取最近 N 則 history（同一個 sender_id，且只有「目前 mode」那份記憶）
-    回傳 [{"role":"user","content":"..."}, ...] 按時間排序
+    某個 mode 目前服務中的向量庫版本。
+    查詢一開始就取得這個物件的參照並用到結束；熱更新只會替換 loaded_indexes[mode]，
+    舊版本在最後一個進行中的查詢結束後由 GC 釋放（含 mmap 的檔案）。
     """
-    if not firebase_enabled:
-        return []
+
+    def __init__(self, mode: str, vs, version: str, info: dict, lexical=None, graph=None, faq=None):
+        self.mode = mode
+        self.vs = vs
+        self.lexical = lexical
+        self.graph = graph
+        self.faq = faq
+        self.version = version
+        self.info = info
+        self.loaded_at = time.time()
+
+
+loaded_indexes = {mode: None for mode in FAISS_DIR_BY_MODE}  # { mode: LoadedIndex | None }
+calibrated_thresholds = load_thresholds(RAG_THRESHOLDS_FILE)
+
+
+def min_relevance_for_mode(mode: str) -> float:
+    env = os.environ.get(f"RAG_MIN_RELEVANCE_{mode.upper()}")
+    if env:
+        return float(env)
+    return calibrated_thresholds.get(mode, RAG_MIN_RELEVANCE)
+
+answer_cache = SemanticAnswerCache(
+    threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_SIZE
+)
+# 每個 mode 各自一把鎖：warm-up 載入某一類時，其他類別的 lazy 載入不必排隊
+_index_reload_locks = {mode: threading.Lock() for mode in FAISS_DIR_BY_MODE}
+_index_reported = {}  # { mode: 上次印出的載入失敗原因 }（watcher 每輪重試時不重複印）
+
+
+def _report_once(mode: str, msg: str):
+    if _index_reported.get(mode) != msg:
+        _index_reported[mode] = msg
+        print(msg)
+# BM25 查詢與 FAISS 檢索平行執行
+lexical_executor = ThreadPoolExecutor(max_workers=RAG_LLM_WORKERS, thread_name_prefix="lexical")
+# 跨類別（自動判斷 / 合併多個類別）時各資料庫平行檢索
+route_executor = ThreadPoolExecutor(max_workers=len(FAISS_DIR_BY_MODE) * 2, thread_name_prefix="route")
+
+
+def reload_index(mode: str, force: bool = False) -> bool:
+    """
+    版本有變（或 force）時，在舊版旁邊載入新版，成功後才原子替換；失敗則繼續使用舊版。
+    回傳是否有替換。
+    """
+    path = FAISS_DIR_BY_MODE[mode]
+    with _index_reload_locks[mode]:
+        current = loaded_indexes.get(mode)
+        version, publishing = read_index_version(path)
+        if publishing:
+            if current is None:
+                _report_once(mode, f"⚠️ [{mode}] {path} is being published, retry later")
+            return False
+        if version is None:
+            if current is None:
+                _report_once(mode, f"❌ [{mode}] load failed: {path} | not found")
+            return False
+        if current is not None and current.version == version and not force:
+            return False
+        built_with = read_index_embedding(path)
+        if built_with and built_with != EMBEDDING_ID:
+            _report_once(mode, f"❌ [{mode}] load skipped: {path} was built with {built_with}, "
+                               f"serving with {EMBEDDING_ID} (rebuild or set the same EMBED_BACKEND)")
+            return False
+        try:
+            vs = load_vectorstore(path)
+            info = load_index_info(path)
+            apply_index_search_params(vs, info)
+            lexical = load_lexical_index(path) if RAG_HYBRID else None
+            graph = load_course_graph(path) if COURSE_GRAPH_ENABLED else None
+            faq = load_faq_index(path) if FAQ_ENABLED else None
+            # 載入期間若開始（或完成）發布新版本，檔案可能來自不同版本：整批捨棄，下一輪再載
+            if read_index_version(path) != (version, False):
+                print(f"⚠️ [{mode}] a new version was published while loading, retry later")
+                return False
+        except Exception as e:
+            print(f"❌ [{mode}] load failed: {path} | {e}")
+            return False
+
+        new = LoadedIndex(mode, vs, version, info, lexical=lexical, graph=graph, faq=faq)
+        _index_reported.pop(mode, None)
+        if current is not None:
+            weakref.finalize(current, print, f"♻️ [{mode}] released version {current.version}")
+        loaded_indexes[mode] = new
+        answer_cache.invalidate(mode)
+        print(f"✅ [{mode}] loaded: {path} (version={version}, index={info.get('type', 'flat')}, "
+              f"vectors={vs.index.ntotal}, bm25={'yes' if lexical else 'no'}"
+              f"{', course_graph=yes' if graph else ''}{f', faq={len(faq)}' if faq else ''})")
+        return True
+
+
+def reload_all_indexes(force: bool = False) -> dict:
+    return {mode: reload_index(mode, force=force) for mode in FAISS_DIR_BY_MODE}
+
+
+def get_index(mode: str):
+    """
+    某個 mode 服務中的資料庫；還沒載入（lazy 啟動、warm-up 尚未載到）就在這裡載入
+    """
+    idx = loaded_indexes.get(mode)
+    if idx is None and mode in FAISS_DIR_BY_MODE:
+        reload_index(mode)
+        idx = loaded_indexes.get(mode)
+    return idx
+
+
+def _index_watcher():
+    while True:
+        time.sleep(FAISS_RELOAD_INTERVAL)
+        try:
+            reload_all_indexes()
+        except Exception as e:
+            print("index watcher error:", repr(e))
+
+
+warm_up_done = threading.Event()
+WARM_UP_SECONDS = Gauge("guides_warm_up_seconds", "Time to load all indexes and the embedding model")
+
+
+def warm_up(load_model: bool = True, forward: bool = True):
+    """
+    載入全部資料庫（mmap，很快）與 embedding 模型，並先跑一次 forward，第一個問題就不必等。
+    serve.py 在 fork 前呼叫時不跑 forward（torch / onnxruntime 的 thread pool 不能跨 fork 使用）
+    """
+    t0 = time.time()
+    print(f"正在載入 Embedding 模型（{EMBEDDING_ID}）與 FAISS 資料庫...")
+    reload_all_indexes()
     try:
-        data = db.reference(_mem_base(sender_id) + "/history").get() or {}
-        items = sorted(data.items(), key=lambda x: x[0])
-        last_items = items[-limit:] if len(items) > limit else items
-
-        out = []
-        for _, v in last_items:
-            role = v.get("role")
-            content = v.get("content")
-            if role in ("user", "assistant") and content:
-                out.append({"role": role, "content": content})
-        return out
+        if forward:
+            base_embeddings.embed_query("warm up")
+        elif load_model:
+            base_embeddings.get()
     except Exception as e:
-        print("fb_load_recent_history error:", e)
-        return []
+        count_error("warm_up")
+        print(f"❌ Embedding model load failed: {e}")
+    WARM_UP_SECONDS.set(time.time() - t0)
+    warm_up_done.set()
+    print(f"✅ Warm-up done in {time.time() - t0:.1f}s")
+
+
+def start_index_watcher():
+    if FAISS_RELOAD_INTERVAL > 0:
+        threading.Thread(target=_index_watcher, name="faiss-index-watcher", daemon=True).start()
+
+
+def _after_fork_in_child():
+    # fork 時 master 的 watcher 可能正持有載入鎖；子 process 換新的鎖並啟動自己的 watcher
+    for mode in _index_reload_locks:
+        _index_reload_locks[mode] = threading.Lock()
+    start_index_watcher()
+
+
+if not INDEX_LAZY_LOAD:
+    warm_up()
+elif INDEX_WARMUP:
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+if INDEX_WATCHER_IN_PARENT:
+    start_index_watcher()
+os.register_at_fork(after_in_child=_after_fork_in_child)
 
 
-def fb_trim_history(sender_id: str, keep: int = 8):
+# 追問（指代上文、過短）時答案取決於對話記憶，不能共用快取。
+# 只看問題開頭的代名詞/指示詞（「其他」「那裡」「大一第二學期」「哪個實驗室」等不算）
+FOLLOWUP_PATTERN = re.compile(
+    r"^(請問)?(那(個|些|麼|樣)?(?![裡裏邊時])|這(個|些|樣|門|位|篇)|[它他她]們?|上面|剛剛|剛才|前面|同樣|還有|另外"
+    r"|第[一二三四五六七八九十\d]+個)"
+)
+
+
+# =============================================================================
+# RAG: streaming LLM with latency budget
+# =============================================================================
+llm_executor = ThreadPoolExecutor(max_workers=RAG_LLM_WORKERS, thread_name_prefix="llm")
+
+
+class StreamingCompletion:
     """
-    超過 keep 就刪掉最舊的，避免無限長
+    在背景 thread 以 stream=True 呼叫 Groq；前景可在 deadline 到時取得目前已收到的部分內容，
+    並以 detach() 註冊「之後完成時」的 callback（用來 push 完整回答）；不再需要結果時 cancel() 關閉 stream
     """
-    if not firebase_enabled:
-        return
-    try:
-        ref = db.reference(_mem_base(sender_id) + "/history")
-        data = ref.get() or {}
-        keys = sorted(list(data.keys()))
-        if len(keys) <= keep:
+
+    def __init__(self, messages: list, temperature: float = 0.3, mode: str = "", prompt_tokens: int = 0):
+        self._parts = []
+        self._lock = threading.Lock()
+        self._on_late = None
+        self._trace = current_trace()
+        self.mode = mode
+        self.prompt_tokens = prompt_tokens
+        self.usage = None
+        self.error = None
+        self.cancelled = False
+        self._stream = None
+        self.done = threading.Event()
+        llm_executor.submit(self._run, messages, temperature)
+
+    def _run(self, messages, temperature):
+        t0 = time.perf_counter()
+        first = True
+        try:
+            if self.cancelled:
+                return
+            stream = groq_client.chat.completions.create(
+                model=GROQ_MODEL,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                timeout=RAG_LLM_TIMEOUT,
+            )
+            with self._lock:
+                self._stream = stream
+            if self.cancelled:
+                self._close_stream()
+                return
+            for chunk in stream:
+                if self.cancelled:
+                    break
+                # Groq 在最後一個 chunk 的 x_groq.usage 附上 token 用量
+                usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+                if usage is not None:
+                    self.usage = usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first:
+                        first = False
+                        observe("llm_first_token", STAGE_SECONDS, time.perf_counter() - t0, self.mode, self._trace)
+                    with self._lock:
+                        self._parts.append(delta)
+        except Exception as e:
+            # cancel() 關閉連線造成的錯誤不算 LLM 錯誤
+            if not self.cancelled:
+                self.error = e
+                count_error("llm", self.mode)
+        finally:
+            observe("llm_total", STAGE_SECONDS, time.perf_counter() - t0, self.mode, self._trace)
+            self._count_tokens()
+            with self._lock:
+                self.done.set()
+                callback = None if self.cancelled else self._on_late
+            if callback:
+                try:
+                    callback(self)
+                except Exception as e:
+                    print("Late answer callback error:", repr(e))
+
+    def _count_tokens(self):
+        if self._stream is None:
+            return  # 請求沒有送出（已取消或建立連線失敗）
+        prompt = getattr(self.usage, "prompt_tokens", None)
+        completion = getattr(self.usage, "completion_tokens", None)
+        if prompt is None:
+            prompt = self.prompt_tokens
+        if completion is None:
+            completion = estimate_tokens(self.text())
+        LLM_TOKENS.inc(prompt, mode=self.mode, kind="prompt")
+        LLM_TOKENS.inc(completion, mode=self.mode, kind="completion")
+
+    def text(self) -> str:
+        with self._lock:
+            return "".join(self._parts)
+
+    def wait(self, deadline: float = None) -> bool:
+        return self.done.wait(None if deadline is None else max(0.0, deadline - time.time()))
+
+    def detach(self, callback) -> bool:
+        """
+        逾時後註冊完成時的 callback；若剛好已經完成則回傳 False（呼叫端直接使用完整回答）
+        """
+        with self._lock:
+            if self.done.is_set():
+                return False
+            self._on_late = callback
+            return True
+
+    def cancel(self):
+        """
+        結果已經不需要（逾時且不會 push）：關閉 Groq stream，釋出 llm_executor 的位置、不再消耗 token
+        """
+        with self._lock:
+            if self.done.is_set():
+                return
+            self.cancelled = True
+            self._on_late = None
+        self._close_stream()
+
+    def _close_stream(self):
+        with self._lock:
+            stream = self._stream
+        close = getattr(stream, "close", None)
+        if close is None:
             return
-        to_delete = keys[:len(keys) - keep]
-        for k in to_delete:
-            db.reference(_mem_base(sender_id) + f"/history/{k}").delete()
-    except Exception as e:
-        print("fb_trim_history error:", e)
+        try:
+            close()
+        except Exception as e:
+            print("Close LLM stream error:", repr(e))
+
+
+def truncate_partial(text: str) -> str:
+    """
+    部分回答切在最後一個完整句子/行（找不到就原樣）
+    """
+    cut = max(text.rfind(c) for c in "\n。！？!?")
+    return text[:cut + 1].rstrip() if cut >= len(text) // 2 else text.rstrip()
+
+
+def retrieve_docs(idx: LoadedIndex, question: str, query_vec) -> list:
+    hits = hybrid_search(
+        idx.vs, idx.lexical, query_vec, question, k=RAG_TOP_K, fetch_k=RAG_FETCH_K,
+        min_relevance=min_relevance_for_mode(idx.mode),
+        min_coverage=RAG_LEXICAL_MIN_COVERAGE,
+        mmr_lambda=RAG_MMR_LAMBDA if RAG_MMR else None,
+        embeddings=embedding_model,
+        executor=lexical_executor,
+    )
+    return [doc for doc, _ in hits]
 
 
 # =============================================================================
-# RAG: load multiple FAISS DBs
+# RAG: automatic mode routing
 # =============================================================================
-print("正在載入 Embedding 模型與 FAISS 資料庫...")
-embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+def score_mode(idx: LoadedIndex, question: str, query_vec):
+    """
+    回傳 (分數, 是否通過門檻)：最相關片段的向量相關度，加上 BM25 命中查詢詞比例的加權
+    """
+    vec_hits = vector_candidates(idx.vs, query_vec, 1)
+    relevance = vec_hits[0][1] if vec_hits else 0.0
+    lex_hits = idx.lexical.search(question, 1) if idx.lexical is not None else []
+    coverage = lex_hits[0][2] if lex_hits else 0.0
+    passed = relevance >= min_relevance_for_mode(idx.mode) or coverage >= RAG_LEXICAL_MIN_COVERAGE
+    return relevance + AUTO_ROUTE_LEXICAL_WEIGHT * coverage, passed
 
-vectorstores = {}
-retrievers = {}
 
-for mode, path in FAISS_DIR_BY_MODE.items():
+def route_question(question: str) -> list:
+    """
+    回傳要使用的類別：1 個 = 明確；多個 = 分數接近，合併檢索（第一個為主）；空 = 無法判斷（顯示選單）
+    """
+    indexes = [(m, get_index(m)) for m in FAISS_DIR_BY_MODE]
+    indexes = [(m, idx) for m, idx in indexes if idx is not None]
+
+    # 先修/畢業學分問題只有修課規定能回答；其他先修圖能回答的問題（課程資訊）與各類別的檢索分數一起比較
+    graph_modes = set()
+    for mode, idx in indexes:
+        if idx.graph is None or not idx.graph.answer(question):
+            continue
+        kind, _ = idx.graph.intent(question)
+        if kind in (INTENT_PREREQ, INTENT_NEXT, INTENT_GRADUATION):
+            return [mode]
+        graph_modes.add(mode)
+
     try:
-        vs = FAISS.load_local(path, embeddings=embedding_model, allow_dangerous_deserialization=True)
-        vectorstores[mode] = vs
-        retrievers[mode] = vs.as_retriever(search_kwargs={"k": 3})
-        print(f"✅ [{mode}] loaded: {path}")
+        with timed("embed"):
+            query_vec = query_embedder.embed(question)
     except Exception as e:
-        vectorstores[mode] = None
-        retrievers[mode] = None
-        print(f"❌ [{mode}] load failed: {path} | {e}")
+        count_error("embed")
+        print(f"Embedding Error (route): {e}")
+        return []
 
+    futures = {mode: route_executor.submit(score_mode, idx, question, query_vec) for mode, idx in indexes}
+    ranked = []
+    for mode, fut in futures.items():
+        try:
+            score, passed = fut.result()
+        except Exception as e:
+            count_error("route", mode)
+            print(f"Route scoring error ({mode}): {e}")
+            continue
+        if mode in graph_modes:
+            score, passed = score + AUTO_ROUTE_GRAPH_BONUS, True
+        if passed:
+            ranked.append((score, mode))
+    ranked.sort(reverse=True)
+    print("Route scores:", [(m, round(sc, 3)) for sc, m in ranked])
+
+    if not ranked:
+        return []
+    if len(ranked) == 1 or ranked[0][0] - ranked[1][0] >= AUTO_ROUTE_MARGIN:
+        return [ranked[0][1]]
+    close = [m for sc, m in ranked if ranked[0][0] - sc < AUTO_ROUTE_MARGIN]
+    if AUTO_ROUTE_MERGE and len(close) <= AUTO_ROUTE_MAX_MERGE:
+        return close
+    return []
 
-def generate_rag_response(sender_id: str, user_question: str, mode: str) -> str:
-    retriever = retrievers.get(mode)
-    if not retriever:
-        label = MODE_LABELS.get(mode, mode)
-        return f"⚠️ 系統維護中：[{label}] 資料庫尚未載入，請稍後再試或切換其他類別。"
 
-    # 取同一個 sender_id 的暫存記憶（最多 8 則）
-    history = fb_load_recent_history(sender_id, limit=8)
+# =============================================================================
+# RAG: single-flight (coalesce identical in-flight questions)
+# =============================================================================
+class Flight:
+    """
+    同一個 key 的一次執行：future 為 leader 的結果；leader 執行中把檢索到的片段放在 docs，
+    回答不完整（逾時的部分/摘錄答案、LLM 中途失敗）時 complete = False，共用者不直接沿用
+    """
 
-    # Retrieval
-    try:
-        docs = retriever.invoke(user_question)
-        context_text = "\n\n".join([f"[資料片段]: {doc.page_content}" for doc in docs])
-    except Exception as e:
-        print(f"Retrieval Error ({mode}): {e}")
-        context_text = "（檢索發生錯誤）"
+    def __init__(self):
+        self.future = Future()
+        self.docs = None
+        self.complete = True
 
-    mode_label = MODE_LABELS.get(mode, mode)
-    user_prompt = f"""
-【查詢類別】：
-{mode_label}
 
-【參考資料】：
-{context_text}
+class SingleFlight:
+    """
+    同一個 key 同時只執行一次：第一個到的（leader）執行 fn，期間到達的相同 key 等待同一個 Flight。
+    結束後立即移除，之後的請求重新計算（已完成的結果由答案快取負責）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # { key: Flight }
+
+    def join(self, key):
+        """
+        回傳 (Flight, 是否為 leader)；leader 必須接著呼叫 run
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._calls[key] = Flight()
+            return flight, True
+
+    def run(self, key, flight: Flight, fn):
+        try:
+            result = fn(flight)
+            flight.future.set_result(result)
+            return result
+        except BaseException as e:
+            flight.future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is flight:
+                    del self._calls[key]
+
+
+rag_flights = SingleFlight()
+
+
+def question_depends_on_history(question: str, history: list) -> bool:
+    if not history:
+        return False
+    q = question.strip()
+    return len(q) <= 6 or bool(FOLLOWUP_PATTERN.search(q))
+
+
+def record_history(sender_id: str, user_question: str, answer: str):
+    # 寫入暫存記憶（只保留最近 SESSION_HISTORY_KEEP 則）
+    with timed("state_write"):
+        state_backend.append_history(sender_id, "user", user_question)
+        state_backend.append_history(sender_id, "assistant", answer)
+
+
+def generate_rag_response(sender_id: str, user_question: str, mode: str,
+                          deadline: float = None, on_late_answer=None, extra_modes: tuple = ()) -> str:
+    """
+    deadline：time.time() 時間點，到時還沒產生完就回部分/摘錄答案
+    on_late_answer(text)：逾時後完整回答產生完成時呼叫（例如以 push 補送）
+    extra_modes：自動判斷類別無法分出高下時，一起檢索的其他類別（結果依名次交錯合併）
 
-【學生問題】：
-{user_question}
-""".strip()
+    同一個問題同時有多人在問（例如公告剛發布）時只有第一位實際檢索與呼叫 LLM，其他人共用其結果，
+    各自的對話記憶仍分別寫入；共用者不會收到 on_late_answer 的補送。
+    leader 的回答不完整、或等到自己的 deadline 仍沒有結果時，共用者改回 leader 檢索片段的摘錄答案（不另外呼叫 LLM）
+    """
+    # 取同一個 sender_id 的暫存記憶（最多 8 則）
+    with timed("state_read"):
+        history = state_backend.load_history(sender_id, limit=HISTORY_CONTEXT_TURNS * 2)
+
+    def compute(flight=None):
+        return _generate_rag_response(sender_id, user_question, mode, history, deadline=deadline,
+                                      on_late_answer=on_late_answer, extra_modes=extra_modes, flight=flight)
+
+    if not RAG_SINGLE_FLIGHT or question_depends_on_history(user_question, history):
+        return compute()
+
+    key = (mode, tuple(extra_modes), QueryEmbeddingService.normalize(user_question))
+    flight, leader = rag_flights.join(key)
+    if leader:
+        CACHE_TOTAL.inc(cache="single_flight", mode=mode, result="leader")
+        return rag_flights.run(key, flight, compute)
+
+    # 共用者最多等到自己的 deadline；那時 leader 還沒檢索完就繼續等（leader 自己也會在 deadline 附近回覆）
+    timeout = None if deadline is None else max(0.0, deadline - time.time())
+    t0 = time.perf_counter()
+    answer = None
+    try:
+        try:
+            answer = flight.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            if not flight.docs:
+                answer = flight.future.result()
+    except Exception as e:
+        # leader 失敗：自己算
+        print(f"Single-flight fallback ({mode}): {e!r}")
+        return compute()
+    CACHE_TOTAL.inc(cache="single_flight", mode=mode, result="shared")
+    observe("single_flight_wait", STAGE_SECONDS, time.perf_counter() - t0, mode)
+    if answer is None or not flight.complete:
+        set_outcome("extractive")
+        if flight.docs:
+            answer = "（AI 回覆較慢，先提供資料庫中最相關的內容）\n" + extractive_answer(user_question, flight.docs)
+        else:
+            answer = "抱歉，AI 思考時發生錯誤。"
+    else:
+        set_outcome("coalesced")
+    record_history(sender_id, user_question, answer)
+    return answer
+
+
+def _generate_rag_response(sender_id: str, user_question: str, mode: str, history: list,
+                           deadline: float = None, on_late_answer=None, extra_modes: tuple = (),
+                           flight: Flight = None) -> str:
+    idx = get_index(mode)
+    if not idx:
+        label = MODE_LABELS.get(mode, mode)
+        set_outcome("index_missing")
+        return f"⚠️ 系統維護中：[{label}] 資料庫尚未載入，請稍後再試或切換其他類別。"
 
-    messages = [{"role": "system", "content": RAG_SYSTEM_PROMPT}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": user_prompt})
+    # 先修/課程/畢業學分等結構化問題：直接由先修圖回答（不需 embedding、檢索與 LLM）
+    with timed("course_graph"):
+        graph_answer = idx.graph.answer(user_question) if idx.graph is not None else None
+    if graph_answer and not COURSE_GRAPH_LLM:
+        set_outcome("graph")
+        record_history(sender_id, user_question, graph_answer)
+        return graph_answer
 
+    # 問題 embedding 只算一次：查答案快取與 FAISS 檢索共用
     try:
-        r = groq_client.chat.completions.create(
-            model=GROQ_MODEL,
-            messages=messages,
-            temperature=0.3,
-        )
-        ans = prettify_reply((r.choices[0].message.content or "").strip())
+        with timed("embed"):
+            query_vec = query_embedder.embed(user_question)
+    except Exception as e:
+        count_error("embed", mode)
+        print(f"Embedding Error ({mode}): {e}")
+        query_vec = None
+
+    followup = question_depends_on_history(user_question, history)
+
+    # 預先回答的 FAQ：建庫時已檢索、生成並審核過，命中就不必檢索與呼叫 LLM
+    if idx.faq is not None and query_vec is not None and not extra_modes and not followup:
+        with timed("faq"):
+            hit = idx.faq.match(query_vec, FAQ_MATCH_THRESHOLD)
+        CACHE_TOTAL.inc(cache="faq", mode=mode, result="hit" if hit else "miss")
+        if hit:
+            set_outcome("faq")
+            trace_set(faq_score=round(hit["score"], 3))
+            ans = prettify_reply(hit["answer"])
+            record_history(sender_id, user_question, ans)
+            return ans
+
+    use_cache = ANSWER_CACHE_ENABLED and query_vec is not None and not extra_modes and not followup
+    if use_cache:
+        with timed("answer_cache"):
+            cached = answer_cache.get(mode, idx.version, query_vec)
+        CACHE_TOTAL.inc(cache="answer", mode=mode, result="hit" if cached else "miss")
+        if cached:
+            set_outcome("cache")
+            record_history(sender_id, user_question, cached)
+            return cached
 
-        # 寫入 Firebase 暫存記憶
-        fb_append_history(sender_id, "user", user_question)
-        fb_append_history(sender_id, "assistant", ans)
-        fb_trim_history(sender_id, keep=8)
+    # Retrieval
+    try:
+        if query_vec is None:
+            raise RuntimeError("no query embedding")
+        others = [get_index(m) for m in extra_modes]
+        others = [o for o in others if o is not None]
+        with timed("retrieval"):
+            if not others:
+                docs = retrieve_docs(idx, user_question, query_vec)
+            else:
+                futures = [route_executor.submit(retrieve_docs, i, user_question, query_vec) for i in [idx] + others]
+                results = [f.result() for f in futures]
+                docs = [d for rank in zip_longest(*results) for d in rank if d is not None][:RAG_TOP_K + len(others)]
+        retrieval_error = False
+    except Exception as e:
+        count_error("retrieval", mode)
+        print(f"Retrieval Error ({mode}): {e}")
+        docs = None
+        retrieval_error = True
+        use_cache = False
+
+    if graph_answer:
+        docs = [Document(page_content=graph_answer, metadata={"source_file": "course_graph"})] + (docs or [])
+
+    # 沒有任何片段達到門檻（且不是接續上文的追問）：不必花一次 LLM 呼叫
+    if docs == [] and not followup:
+        set_outcome("no_data")
+        record_history(sender_id, user_question, NO_DATA_REPLY)
+        return NO_DATA_REPLY
+    docs = docs or []
+    if flight is not None:
+        flight.docs = docs
+
+    mode_label = "、".join(MODE_LABELS.get(m, m) for m in (mode, *extra_modes))
+
+    def make_user_prompt(context_text: str) -> str:
+        if retrieval_error:
+            context_text = "（檢索發生錯誤）"
+        return rag_user_prompt(mode_label, context_text, user_question)
+
+    # 合併重疊片段、去除重複內容，並把對話記憶與參考資料控制在 token 預算內
+    with timed("prompt"):
+        messages, prompt_stats = assemble_messages(
+            RAG_SYSTEM_PROMPT, history, docs, make_user_prompt,
+            budget=PROMPT_TOKEN_BUDGET,
+            history_share=PROMPT_HISTORY_SHARE,
+            summary_tokens=PROMPT_SUMMARY_TOKENS,
+        )
 
+    def finish(completion: StreamingCompletion):
+        ans = prettify_reply(completion.text().strip())
+        record_history(sender_id, user_question, ans)
+        if use_cache and ans:
+            answer_cache.put(mode, idx.version, query_vec, ans)
         return ans
-    except Exception as e:
-        print(f"Groq Error: {e}")
-        return "抱歉，AI 思考時發生錯誤。"
+
+    def incomplete_answer(partial: str) -> str:
+        """
+        未完成的回答（逾時或 stream 中途失敗）：部分內容夠長就回部分內容，否則回摘錄答案
+        """
+        if len(partial) >= RAG_MIN_PARTIAL_CHARS:
+            return prettify_reply(truncate_partial(partial)) + "\n\n（回答未完…）"
+        if not docs:
+            return "抱歉，AI 思考時發生錯誤。"
+        return "（AI 回覆較慢，先提供資料庫中最相關的內容）\n" + extractive_answer(user_question, docs)
+
+    completion = StreamingCompletion(messages, temperature=0.3, mode=mode, prompt_tokens=prompt_stats["tokens"])
+    with timed("llm_wait"):
+        finished = completion.wait(deadline)
+    if finished:
+        if completion.error:
+            # stream 中途失敗：已收到的內容不完整，不寫入答案快取與對話記憶
+            print(f"Groq Error: {completion.error}")
+            set_outcome("llm_error")
+            if flight is not None:
+                flight.complete = False
+            return incomplete_answer(completion.text())
+        set_outcome("llm")
+        return finish(completion)
+
+    # 超過延遲預算：先回部分內容或摘錄答案
+    partial = completion.text()
+    print(f"LLM over budget ({mode}): {len(partial)} chars received")
+    set_outcome("partial" if len(partial) >= RAG_MIN_PARTIAL_CHARS else "extractive")
+    quick = incomplete_answer(partial)
+
+    def late(c: StreamingCompletion):
+        if c.error:
+            print(f"Groq Error (late): {c.error}")
+            return
+        on_late_answer(finish(c))
+
+    if not (on_late_answer and completion.detach(late)):
+        if completion.done.is_set() and not completion.error:
+            set_outcome("llm")
+            return finish(completion)
+        # 不會 push 完整回答：停止產生
+        completion.cancel()
+        record_history(sender_id, user_question, quick)
+    if flight is not None:
+        flight.complete = False
+    return quick
 
 
 def generate_general_response(user_text: str) -> str:
@@ -379,29 +1283,166 @@ def generate_general_response(user_text: str) -> str:
 # =============================================================================
 @app.route("/", methods=["GET"])
 def health():
-    loaded = [m for m, r in retrievers.items() if r is not None]
-    missing_db = [m for m, r in retrievers.items() if r is None]
+    loaded = {m: idx.version for m, idx in loaded_indexes.items() if idx is not None}
+    missing_db = [m for m, idx in loaded_indexes.items() if idx is None]
     fb = "enabled" if firebase_enabled else "disabled"
-    return f"OK | faiss_loaded={loaded} faiss_missing={missing_db} | firebase={fb}"
+    warm = "done" if warm_up_done.is_set() else "warming"
+    return (f"OK | faiss_loaded={loaded} faiss_missing={missing_db} | firebase={fb} | "
+            f"embedding={EMBEDDING_ID} model_loaded={base_embeddings.loaded} warm_up={warm}")
+
+
+# =============================================================================
+# Metrics (Prometheus)
+# =============================================================================
+Gauge(
+    "guides_index_vectors", "Vectors in the loaded FAISS index", ["mode"],
+    callback=lambda: {(m,): idx.vs.index.ntotal for m, idx in loaded_indexes.items() if idx is not None},
+)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        abort(404)
+    if METRICS_TOKEN and request.headers.get("Authorization", "") != f"Bearer {METRICS_TOKEN}":
+        abort(403)
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+# =============================================================================
+# Admin: hot reload FAISS indexes
+# =============================================================================
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """
+    立即檢查並載入新版本向量庫（?mode=xxx 只載入單一 mode，?force=1 即使版本相同也重載）
+    需設定 ADMIN_TOKEN，並以 X-Admin-Token header 帶入
+    """
+    if not ADMIN_TOKEN:
+        abort(404)
+    if request.headers.get("X-Admin-Token", "") != ADMIN_TOKEN:
+        abort(403)
+
+    mode = request.args.get("mode")
+    force = request.args.get("force") == "1"
+    if mode:
+        if mode not in FAISS_DIR_BY_MODE:
+            abort(400)
+        swapped = {mode: reload_index(mode, force=force)}
+    else:
+        swapped = reload_all_indexes(force=force)
+    versions = {m: (idx.version if idx else None) for m, idx in loaded_indexes.items()}
+    return {"swapped": swapped, "versions": versions}
 
 
 # =============================================================================
 # LINE webhook
 # =============================================================================
+MENU_KEYWORDS = ["@機器人", "選單", "menu", "功能", "開始", "start", "切換", "OK", "ES", "我沒了"]
+LONG_COMMANDS = ("@翻譯 ", "@摘要 ")
+
+RATE_LIMITED_REPLY = {
+    "rag": "你問得有點快 🙏 請稍等一下再問下一題。",
+    "long": "翻譯/摘要需要比較久的時間，請稍等一下再傳下一則 🙏",
+}
+BUSY_REPLY = "目前詢問的人比較多，系統忙碌中 🙏 請稍後再試一次。"
+
+
+def event_priority(event) -> str:
+    """
+    instant：選單、切換類別（postback）等不需要 LLM 的回覆；long：@翻譯 / @摘要；其他文字訊息：rag
+    """
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        text = (event.message.text or "").strip()
+        if text in MENU_KEYWORDS:
+            return "instant"
+        if text.startswith(LONG_COMMANDS):
+            return "long"
+        return "rag"
+    return "instant"
+
+
+def reject_event(event, priority: str, reason: str):
+    """
+    超速 / 佇列滿 / 排隊太久：回覆友善的訊息（不經過 LLM）
+    """
+    print(f"Rejected {priority} event from {get_sender_id(event)}: {reason}")
+    text = RATE_LIMITED_REPLY.get(priority, BUSY_REPLY) if reason == FairScheduler.RATE_LIMITED else BUSY_REPLY
+    try:
+        send_reply(event, TextSendMessage(text=text))
+    except Exception as e:
+        print("Reject reply failed:", repr(e))
+
+
+event_scheduler = FairScheduler(
+    WEBHOOK_WORKERS,
+    [
+        PriorityClass("instant"),
+        PriorityClass("rag", limit=SCHED_RAG_CONCURRENCY, rate_per_min=SCHED_RAG_RATE_PER_MIN,
+                      burst=SCHED_RAG_BURST, max_queue=WEBHOOK_QUEUE_SIZE, max_wait=SCHED_RAG_MAX_WAIT),
+        PriorityClass("long", limit=SCHED_LONG_CONCURRENCY, rate_per_min=SCHED_LONG_RATE_PER_MIN,
+                      burst=SCHED_LONG_BURST, max_queue=WEBHOOK_QUEUE_SIZE, max_wait=SCHED_LONG_MAX_WAIT),
+    ],
+    reserved=SCHED_RESERVED_WORKERS,
+    name="webhook",
+    on_wait=lambda priority, seconds: QUEUE_SECONDS.observe(seconds, priority=priority),
+    on_rejected=lambda priority, reason: REJECTED.inc(priority=priority, reason=reason),
+)
+Gauge("guides_webhook_pending", "LINE events queued or running", callback=lambda: {(): event_scheduler.pending})
+Gauge(
+    "guides_scheduler_events", "LINE events in the scheduler by priority and state", ["priority", "state"],
+    callback=lambda: {(p, st): n for p, counts in event_scheduler.stats().items() for st, n in counts.items()},
+)
+
+
+def dispatch_line_event(event):
+    """
+    依 handler.add 註冊的函式派送單一事件（查找規則同 WebhookHandler.handle）
+    """
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        func = handler._default
+    if func is None:
+        return
+    try:
+        func(event)
+    except Exception as e:
+        print("Handler error:", repr(e))
+
+
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
 
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         print("Invalid signature. Check LINE_CHANNEL_SECRET.")
         abort(400)
-    except Exception as e:
-        print("Handler error:", repr(e))
-        abort(500)
 
+    # 同步模式且只有一個即時回覆的事件：該 sender 沒有排隊中的工作時直接在 request thread 處理，
+    # 否則照常排進該 sender 的佇列（不能插隊到先前的事件前面）
+    if not WEBHOOK_ASYNC and len(events) == 1 and event_priority(events[0]) == "instant":
+        if event_scheduler.run_inline(get_sender_id(events[0]), dispatch_line_event, events[0]):
+            return "OK"
+
+    # 依優先等級排程：不同 sender 平行處理（同等級輪流），同一 sender 依序處理；超速或過載時回覆友善的訊息
+    futures = []
+    for event in events:
+        priority = event_priority(event)
+        futures.append(event_scheduler.submit(
+            get_sender_id(event), priority, dispatch_line_event, event,
+            on_reject=functools.partial(reject_event, event, priority),
+        ))
+
+    # 非同步模式：事件已排入佇列，立即回 200；同步模式：等這一批全部處理完
+    if not WEBHOOK_ASYNC:
+        wait(futures)
     return "OK"
 
 
@@ -409,6 +1450,7 @@ def callback():
 # Postback handler (select mode)
 # =============================================================================
 @handler.add(PostbackEvent)
+@traced("postback")
 def handle_postback(event):
     sender_id = get_sender_id(event)
     data = event.postback.data or ""
@@ -416,25 +1458,25 @@ def handle_postback(event):
     mode = qs.get("mode", [None])[0]
 
     if mode not in MODE_LABELS:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="我沒有辨識到你的選擇，請再點一次。"))
+        set_outcome("invalid")
+        send_reply(event, TextSendMessage(text="我沒有辨識到你的選擇，請再點一次。"))
         return
+    trace_set(mode=mode)
 
-    # 取得目前 mode（本地優先；沒有就用 Firebase）
-    prev_mode = user_state.get(sender_id, {}).get("mode")
-    if not prev_mode:
-        prev_mode = fb_get_mode(sender_id)
+    with timed("state_write"):
+        # 取得目前 mode
+        prev_mode = state_backend.get_mode(sender_id)
 
-    # A) 只有「切換到新 mode」才清空舊記憶
-    if prev_mode != mode:
-        fb_clear_history(sender_id)
+        # A) 只有「切換到新 mode」才清空舊記憶
+        if prev_mode != mode:
+            state_backend.clear_history(sender_id)
 
-    # 記住新 mode（本地 + Firebase）
-    user_state[sender_id] = {"mode": mode}
-    fb_set_mode(sender_id, mode)
+        # 記住新 mode
+        state_backend.set_mode(sender_id, mode)
 
     label = MODE_LABELS[mode]
-    line_bot_api.reply_message(
-        event.reply_token,
+    send_reply(
+        event,
         TextSendMessage(
             text=f"你選了【{label}】。\n"
                  f"請直接輸入你要查的問題。\n"
@@ -447,6 +1489,7 @@ def handle_postback(event):
 # Text handler (no @ needed for RAG)
 # =============================================================================
 @handler.add(MessageEvent, message=TextMessage)
+@traced("text")
 def handle_text_message(event):
     sender_id = get_sender_id(event)
     text = (event.message.text or "").strip()
@@ -454,61 +1497,96 @@ def handle_text_message(event):
 
     try:
         # 呼叫選單（任何時候）
-        if text in ["@機器人", "選單", "menu", "功能", "開始", "start", "切換", "OK", "ES", "我沒了"]:
-            line_bot_api.reply_message(event.reply_token, build_mode_menu())
+        if text in MENU_KEYWORDS:
+            set_outcome("menu")
+            send_reply(event, build_mode_menu())
             return
 
         # （可選）保留原本的翻譯/摘要指令
         if text.startswith("@翻譯 "):
             content = text[len("@翻譯 "):].strip()
             prompt = "將以下內容翻譯成繁體中文：\n" + content
+            set_outcome("general")
             reply = generate_general_response(prompt)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+            send_reply(event, TextSendMessage(text=reply))
             return
 
         if text.startswith("@摘要 "):
             content = text[len("@摘要 "):].strip()
             prompt = "請用繁體中文總結以下內容（適當分行、條列重點）：\n" + content
+            set_outcome("general")
             reply = generate_general_response(prompt)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+            send_reply(event, TextSendMessage(text=reply))
             return
 
-        # 取得 mode（本地優先；沒有就去 Firebase 恢復）
-        mode = user_state.get(sender_id, {}).get("mode")
-        if not mode:
-            mode = fb_get_mode(sender_id)
-            if mode:
-                user_state[sender_id] = {"mode": mode}
+        # 取得 mode
+        with timed("state_read"):
+            mode = state_backend.get_mode(sender_id)
+
+        # 還沒選類別：自動判斷（明確時記住該類別，之後的追問沿用；合併多類別時不記住）
+        extra_modes = ()
+        routed = False
+        if (not mode or mode not in MODE_LABELS) and AUTO_ROUTE:
+            with timed("route"):
+                modes = route_question(text)
+            if modes:
+                mode, extra_modes, routed = modes[0], tuple(modes[1:]), True
+                trace_set(routed="+".join(modes))
+                if not extra_modes:
+                    # 與選單切換相同：記住新類別時清空舊記憶（舊記憶不屬於這個類別）
+                    with timed("state_write"):
+                        state_backend.clear_history(sender_id)
+                        state_backend.set_mode(sender_id, mode)
 
         # 如果仍沒有 mode → 引導選單
         if not mode or mode not in MODE_LABELS:
-            line_bot_api.reply_message(event.reply_token, [
+            set_outcome("menu")
+            send_reply(event, [
                 TextSendMessage(text="請先選擇你要查詢的類別："),
                 build_mode_menu()
             ])
             return
 
-        # RAG
-        reply = generate_rag_response(sender_id, text, mode=mode)
+        trace_set(mode=mode)
+
+        # RAG（從事件發生起算延遲預算；reply token 已經過期改走 push 時就不必截斷）
+        event_time = (getattr(event, "timestamp", None) or time.time() * 1000) / 1000
+        deadline = None
+        if time.time() - event_time < REPLY_TOKEN_SAFE_SECONDS:
+            deadline = event_time + min(RAG_LATENCY_BUDGET, REPLY_TOKEN_SAFE_SECONDS)
+
+        push_target = get_push_target(event) if RAG_PUSH_LATE_ANSWER else None
+
+        def push_late_answer(full: str):
+            line_bot_api.push_message(push_target, TextSendMessage(text="完整回答：\n" + full))
+
+        reply = generate_rag_response(sender_id, text, mode=mode, deadline=deadline,
+                                      on_late_answer=push_late_answer if push_target else None,
+                                      extra_modes=extra_modes)
+        if routed:
+            labels = "、".join(MODE_LABELS[m] for m in (mode, *extra_modes))
+            reply += f"\n\n（已自動判斷為【{labels}】類別）"
 
         if DEBUG_SHOW_MENU_AFTER_REPLY:
             # 可選1：回答後再附上選單，方便切換（開發/Debug）
-            line_bot_api.reply_message(event.reply_token, [
+            send_reply(event, [
                 TextSendMessage(text=reply),
                 build_mode_menu()
             ])
         else:
             # 可選2：回答後要輸入「選單」才可切換類別（正式使用體驗較乾淨）
-            line_bot_api.reply_message(
-                event.reply_token,
+            send_reply(
+                event,
                 TextSendMessage(text=reply + "\n\n（輸入ES可回到選單）")
             )
 
 
     except Exception as e:
+        count_error("handler")
+        set_outcome("error")
         print("Unexpected error:", repr(e))
         # 開發期可開啟回傳錯誤
-        # line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"系統錯誤: {e}"))
+        # send_reply(event, TextSendMessage(text=f"系統錯誤: {e}"))
 
 
 if __name__ == "__main__":
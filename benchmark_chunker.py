@@ -0,0 +1,173 @@
+"""
+比較 cjk chunker（text_chunker.py）與原本的 RecursiveCharacterTextSplitter：python benchmark_chunker.py
+
+- 文件：UPLOAD_DIR 內的全部檔案（與建庫相同的解析方式）；chunk 大小預設同建庫的 CHUNK_SIZE / CHUNK_OVERLAP，
+  可用 BENCH_CHUNK_SIZE / BENCH_CHUNK_OVERLAP 改變（文件都比 chunk 小時兩種切法結果相同）
+- 建庫：切 chunk、embed 並加入 FAISS（與 build_faiss_db.add_chunks 相同，不使用 embedding 快取）的時間，
+  以及 index + docstore 的大小
+- 大文件：每份文件重複 BENCH_SCALE 次後只量切分時間（確認隨文件長度線性成長）
+- 檢索：BENCH_QUERY_FILE 每行「檔名<TAB>問題<TAB>答案片段（選填）」；檔案不存在時從每份文件抽 BENCH_QUERIES_PER_DOC 句當查詢，
+  答案片段就是該句（句子被切斷就找不到）。前 BENCH_K 個結果中有該檔案且含答案片段的 chunk 算命中；
+  同時統計送進 prompt 的參考資料 token 數（合併重疊、去除重複行之後）
+"""
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import faiss
+from langchain_core.documents import Document
+
+from build_faiss_db import (
+    CHUNK_OVERLAP, CHUNK_SIZE, CHUNKERS, SUPPORTED_EXTS, UPLOAD_DIR, add_chunks, load_tagged_file, make_splitter,
+)
+from embedding_backend import EMBED_MODEL_NAME, create_embeddings
+from lexical_index import load_lexical_index, write_lexical_index
+from prompt_builder import dedupe_lines, estimate_tokens, merge_chunks
+from retrieval import hybrid_search
+from text_chunker import parse_header
+
+
+BENCH_QUERY_FILE = os.environ.get("BENCH_QUERY_FILE", "chunker_queries.txt")
+BENCH_QUERIES_PER_DOC = int(os.environ.get("BENCH_QUERIES_PER_DOC", "3"))
+BENCH_K = int(os.environ.get("BENCH_K", "3"))
+BENCH_SCALE = int(os.environ.get("BENCH_SCALE", "200"))
+BENCH_CHUNK_SIZE = int(os.environ.get("BENCH_CHUNK_SIZE", str(CHUNK_SIZE)))
+BENCH_CHUNK_OVERLAP = int(os.environ.get("BENCH_CHUNK_OVERLAP", str(CHUNK_OVERLAP)))
+
+_SENTENCE = re.compile(r"[^。！？!?；;\n]+[。！？!?；;]?")
+_CLEAN_END = re.compile(r"[。！？!?；;」』）)]$")
+
+
+def load_files(upload_dir: str) -> Dict[str, List[Document]]:
+    files = {}
+    for fn in sorted(os.listdir(upload_dir)):
+        path = os.path.join(upload_dir, fn)
+        if not os.path.isfile(path) or os.path.splitext(fn)[1].lower() not in SUPPORTED_EXTS:
+            continue
+        tag, docs, reason = load_tagged_file(path)
+        if reason is None and docs:
+            files[fn] = docs
+    return files
+
+
+def load_queries(path: str, files: Dict[str, List[Document]]) -> Tuple[List[Tuple[str, str, str]], str]:
+    """
+    回傳 ([(檔名, 問題, 答案片段), ...], 來源說明)
+    """
+    if os.path.isfile(path):
+        out = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line.strip() or line.startswith("#"):
+                    continue
+                parts = line.split("\t")
+                if len(parts) >= 2:
+                    out.append((parts[0], parts[1], parts[2] if len(parts) > 2 else ""))
+        return out, path
+
+    out = []
+    for fn, docs in files.items():
+        text = "\n".join(d.page_content or "" for d in docs)
+        _, body = parse_header(text)
+        sents = [s.strip(" -•*・\t") for s in _SENTENCE.findall(text[body:])]
+        sents = [s for s in sents if 12 <= len(s) <= 80]
+        if not sents:
+            continue
+        step = max(1, len(sents) // BENCH_QUERIES_PER_DOC)
+        out.extend((fn, s, s) for s in sents[::step][:BENCH_QUERIES_PER_DOC])
+    return out, "sampled sentences"
+
+
+def clean_end_ratio(chunks: List[Document], sources: Dict[Tuple[str, int], str]) -> float:
+    """
+    chunk 結尾落在句子邊界（句末標點、換行或文件結尾）的比例
+    """
+    clean = 0
+    for c in chunks:
+        src = sources[(c.metadata["source_file"], c.metadata.get("page", 0))]
+        end = c.metadata.get("start_index", 0) + len(c.page_content)
+        if end >= len(src.rstrip()) or src[end:end + 1] == "\n" or _CLEAN_END.search(c.page_content):
+            clean += 1
+    return clean / max(1, len(chunks))
+
+
+def bench(chunker: str, files: Dict[str, List[Document]], queries: List[Tuple[str, str, str]], emb) -> Dict:
+    splitter = make_splitter(BENCH_CHUNK_SIZE, BENCH_CHUNK_OVERLAP, chunker=chunker)
+    sources = {(fn, d.metadata.get("page", 0)): d.page_content or "" for fn, docs in files.items() for d in docs}
+    source_chars = sum(len(t) for t in sources.values())
+
+    t0 = time.perf_counter()
+    chunks = [c for docs in files.values() for c in splitter.split_documents(docs)]
+    split_s = time.perf_counter() - t0
+
+    big = [Document(page_content=(d.page_content + "\n") * BENCH_SCALE, metadata=dict(d.metadata))
+           for docs in files.values() for d in docs]
+    t0 = time.perf_counter()
+    for d in big:
+        splitter.split_documents([d])
+    big_split_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    vs, _ = add_chunks(None, chunks, emb, 0)
+    embed_s = time.perf_counter() - t0
+
+    index_bytes = int(faiss.serialize_index(vs.index).size)
+    docstore_bytes = sum(
+        len(json.dumps({"page_content": c.page_content, "metadata": c.metadata}, ensure_ascii=False).encode("utf-8"))
+        for c in chunks
+    )
+
+    hits, ctx_tokens = 0, 0
+    with tempfile.TemporaryDirectory() as tmp:
+        write_lexical_index(tmp, vs)
+        lexical = load_lexical_index(tmp)
+        for fn, question, answer in queries:
+            found = hybrid_search(vs, lexical, emb.embed_query(question), question, k=BENCH_K, fetch_k=10)
+            docs = [d for d, _ in found]
+            if any(d.metadata.get("source_file") == fn and answer in d.page_content for d in docs):
+                hits += 1
+            ctx_tokens += sum(estimate_tokens(t) for _, t in dedupe_lines(merge_chunks(docs)))
+        del lexical
+
+    n = max(1, len(queries))
+    return {
+        "chunks": len(chunks),
+        "avg_chars": sum(len(c.page_content) for c in chunks) / max(1, len(chunks)),
+        "stored_vs_source": sum(len(c.page_content) for c in chunks) / max(1, source_chars),
+        "clean_end": clean_end_ratio(chunks, sources),
+        "split_ms": split_s * 1000,
+        f"split_x{BENCH_SCALE}_ms": big_split_s * 1000,
+        "embed_index_s": embed_s,
+        "index_kib": index_bytes / 1024,
+        "docstore_kib": docstore_bytes / 1024,
+        f"hit@{BENCH_K}": hits / n,
+        "context_tokens": ctx_tokens / n,
+    }
+
+
+def main():
+    files = load_files(UPLOAD_DIR)
+    if not files:
+        raise RuntimeError(f"No valid tagged documents found in {UPLOAD_DIR}.")
+    queries, query_source = load_queries(BENCH_QUERY_FILE, files)
+    emb = create_embeddings(EMBED_MODEL_NAME)
+    print(f"files={len(files)}, queries={len(queries)} ({query_source}), "
+          f"chunk_size={BENCH_CHUNK_SIZE}, chunk_overlap={BENCH_CHUNK_OVERLAP}")
+
+    order = ["recursive"] + [c for c in CHUNKERS if c != "recursive"]
+    results = {c: bench(c, files, queries, emb) for c in order}
+    print(f"{'metric':<20}" + "".join(f"{c:>14}" for c in order))
+    for metric in results[order[0]]:
+        row = []
+        for c in order:
+            v = results[c][metric]
+            row.append(f"{v:>14d}" if isinstance(v, int) else f"{v:>14.3f}")
+        print(f"{metric:<20}" + "".join(row))
+
+
+if __name__ == "__main__":
+    main()
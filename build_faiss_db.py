@@ -1,14 +1,89 @@
 import os
 import re
-from typing import Dict, List, Optional
+import json
+import pickle
+import hashlib
+import time
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import faiss
+import numpy as np
 
 from langchain_community.document_loaders import TextLoader, PyPDFLoader, Docx2txtLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
+
+from course_graph import COURSE_GRAPH_FILE, build_course_graph, write_course_graph
+from embedding_backend import EMBED_MODEL_NAME, create_embeddings, embedding_id
+from embedding_cache import DEFAULT_MAX_ENTRIES, with_embedding_cache
+from faq_index import build_faq, create_faq_generator, has_faq_index
+from lexical_index import has_lexical_index, load_lexical_index, write_lexical_index
+from mmap_store import INDEX_FILE, write_mmap_docstore
+from text_chunker import CJKTextSplitter, embedding_text
 
 
 UPLOAD_DIR = "uploaded_docs"
+SUPPORTED_EXTS = {".txt", ".pdf", ".docx"}
+
+CHUNK_SIZE = 900
+CHUNK_OVERLAP = 150
+# 切 chunk 的方式：cjk（預設，依中文句子與段落標題切，標頭寫進每個 chunk 的 metadata，見 text_chunker.py）
+# 或 recursive（原本的 RecursiveCharacterTextSplitter）；切換後 manifest 設定不同，會自動全量重建
+CHUNKERS = ("cjk", "recursive")
+CHUNKER = os.environ.get("CHUNKER", "cjk").strip().lower()
+
+# 增量建庫（預設開啟）：每個 tag 資料夾內存一份 manifest（檔名 → 檔案 hash + chunk ids），
+# 只 embed 新增/修改的檔案，刪除的檔案則從既有 index 移除。設 FAISS_INCREMENTAL=0 可強制全量重建。
+INCREMENTAL_BUILD = os.environ.get("FAISS_INCREMENTAL", "1") == "1"
+MANIFEST_FILE = "manifest.json"
+
+# chunk embedding 快取（與 app.py 共用同一個資料夾）；設 EMBED_CACHE_DIR="" 可關閉
+EMBED_CACHE_DIR = os.environ.get(
+    "EMBED_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding_cache")
+)
+EMBED_CACHE_MAX_ENTRIES = int(os.environ.get("EMBED_CACHE_MAX_ENTRIES", str(DEFAULT_MAX_ENTRIES)))
+
+# 串流建庫：解析檔案用 process pool（PDF 解析吃 CPU），同時最多 INGEST_MAX_INFLIGHT 個檔案在途，
+# 解析完立刻切 chunk，累積到 EMBED_BATCH_SIZE 個 chunk 就 embed 一次；記憶體不隨文件總量成長。
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", str(os.cpu_count() or 1)))
+INGEST_MAX_INFLIGHT = int(os.environ.get("INGEST_MAX_INFLIGHT", str(max(2, INGEST_WORKERS * 2))))
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+
+# 對外服務用的 index 類型（每個 tag 可不同）：flat（精確，預設）/ ivf / hnsw / pq / sq8
+# FAISS_INDEX_TYPE 設預設值，FAISS_INDEX_TYPE_<TAG>（例：FAISS_INDEX_TYPE_DEPARTMENT_ANNOUNCEMENT=hnsw）覆寫單一 tag。
+# 非 flat 時，精確的 IndexIDMap2 另存為 flat.faiss（增量建庫與 recall 評估的基準），index.faiss 則是壓縮/近似版本。
+INDEX_TYPES = ("flat", "ivf", "hnsw", "pq", "sq8")
+DEFAULT_INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "flat").lower()
+MASTER_INDEX_FILE = "flat.faiss"
+IVF_NPROBE = int(os.environ.get("FAISS_IVF_NPROBE", "8"))
+HNSW_M = int(os.environ.get("FAISS_HNSW_M", "32"))
+HNSW_EF_SEARCH = int(os.environ.get("FAISS_HNSW_EF_SEARCH", "64"))
+
+# recall 評估用的查詢集（每行一個問題；可寫成「tag<TAB>問題」只套用到該 tag）。
+# 檔案不存在時，改從 index 抽樣向量並加入少量雜訊當作查詢。
+RECALL_QUERY_FILE = os.environ.get("RECALL_QUERY_FILE", "eval_queries.txt")
+RECALL_K = int(os.environ.get("RECALL_K", "10"))
+RECALL_SAMPLE = 100
+
+# FAQ 預先回答（預設關閉）：FAQ_GENERATOR=groq 以 LLM 對每個檔案出 FAQ_QUESTIONS_PER_DOC 題並預先回答；
+# FAQ_GENERATOR=local 不呼叫 LLM（標題/欄位組題、摘錄回答），測試用。FAQ_QUESTION_FILE 可再加人工指定的問題（格式同 RECALL_QUERY_FILE）。
+# 回答的字元 bigram 至少 FAQ_MIN_GROUNDING 比例出現在參考資料中才上線；檢索門檻 FAQ_MIN_RELEVANCE 與 app.py 的 RAG_MIN_RELEVANCE 對齊
+FAQ_GENERATOR = os.environ.get("FAQ_GENERATOR", "").strip().lower()
+FAQ_QUESTIONS_PER_DOC = int(os.environ.get("FAQ_QUESTIONS_PER_DOC", "5"))
+FAQ_QUESTION_FILE = os.environ.get("FAQ_QUESTION_FILE", "faq_questions.txt")
+FAQ_MIN_GROUNDING = float(os.environ.get("FAQ_MIN_GROUNDING", "0.5"))
+FAQ_MIN_RELEVANCE = float(os.environ.get("FAQ_MIN_RELEVANCE", "0.3"))
+
+# 與 app.py 的 MODE_LABELS 相同（FAQ 預先回答的 prompt 用）
+LABEL_BY_TAG = {
+    "department_announcement": "系所公告",
+    "scholarship": "獎助學金資訊",
+    "faculty_lab": "實驗室與師資介紹",
+    "course_requirement": "修課規定",
+}
 
 # 你目前支援的四種標籤（依你說的）
 VALID_TAGS = {
@@ -26,6 +101,9 @@ OUT_DIR_BY_TAG = {
     "course_requirement": "faiss_db_course_requirement",
 }
 
+# 先修圖（course_graph.json）只從這個 tag 的 txt 建立，跟著該 tag 的資料庫一起發布
+COURSE_GRAPH_TAG = "course_requirement"
+
 
 TAG_PATTERN = re.compile(r"^\s*類型\s*[:：]\s*([A-Za-z0-9_]+)\s*$")
 
@@ -71,99 +149,609 @@ def parse_tag_from_file(path: str, ext: str) -> Optional[str]:
     return None
 
 
-def load_documents_grouped_by_tag(upload_dir: str) -> Dict[str, List]:
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_upload_dir(upload_dir: str) -> Dict[str, str]:
+    """
+    回傳 {檔名: sha256}，只包含支援的副檔名
+    """
+    hashes = {}
+    for fn in os.listdir(upload_dir):
+        path = os.path.join(upload_dir, fn)
+        if os.path.isfile(path) and os.path.splitext(fn)[1].lower() in SUPPORTED_EXTS:
+            hashes[fn] = file_sha256(path)
+    return hashes
+
+
+def load_tagged_file(path: str) -> Tuple[Optional[str], List, Optional[str]]:
+    """
+    解析單一檔案（在 process pool 內執行，必須是 module-level function）
+    回傳 (tag, docs, skip_reason)；skip_reason 不為 None 代表略過此檔案
+    """
+    fn = os.path.basename(path)
+    ext = os.path.splitext(fn)[1].lower()
+
+    # 選 loader
+    try:
+        if ext == ".txt":
+            loader = TextLoader(path, encoding="utf-8")
+        elif ext == ".pdf":
+            loader = PyPDFLoader(path)
+        elif ext == ".docx":
+            loader = Docx2txtLoader(path)
+        else:
+            return None, [], "unsupported"
+    except Exception as e:
+        return None, [], f"loader init failed: {e}"
+
+    # 先嘗試直接從檔案第一行拿 tag（txt 最穩）
+    tag = parse_tag_from_file(path, ext)
+
+    try:
+        docs = loader.load()
+    except Exception as e:
+        return None, [], f"load failed: {e}"
+
+    # 若前面拿不到 tag，改從載入後內容的第一個非空行解析
+    if tag is None and docs:
+        tag = parse_tag_from_text_first_line(docs[0].page_content)
+
+    if tag is None:
+        return None, [], f"no valid tag in first line. Expected one of: {sorted(VALID_TAGS)}"
+
+    # 寫 metadata
+    for d in docs:
+        d.metadata = d.metadata or {}
+        d.metadata["tag"] = tag
+        d.metadata["source_file"] = fn
+        d.metadata["source_path"] = path
+    return tag, docs, None
+
+
+def iter_tagged_documents(upload_dir: str, skip_files: Optional[Set[str]] = None,
+                          workers: int = 1, max_inflight: int = 2) -> Iterator[Tuple[str, str, List]]:
+    """
+    逐檔產出 (檔名, tag, [Document, ...])，順序依完成先後。
+    workers > 1 時用 process pool 平行解析；在途的檔案數上限為 max_inflight（有界佇列），
+    呼叫端處理得慢時不會有大量已解析的文件堆在記憶體裡。
+    """
+    skip_files = skip_files or set()
+    paths = []
+    for fn in sorted(os.listdir(upload_dir)):
+        path = os.path.join(upload_dir, fn)
+        if not os.path.isfile(path) or fn in skip_files:
+            continue
+        if os.path.splitext(fn)[1].lower() not in SUPPORTED_EXTS:
+            continue
+        paths.append(path)
+
+    def _result(path, tag, docs, reason):
+        fn = os.path.basename(path)
+        if reason:
+            print(f"Skip {fn} ({reason})")
+            return None
+        print(f"Loaded: {fn}  -> tag={tag}")
+        return fn, tag, docs
+
+    if workers <= 1 or len(paths) <= 1:
+        for path in paths:
+            item = _result(path, *load_tagged_file(path))
+            if item:
+                yield item
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        it = iter(paths)
+        while True:
+            while len(pending) < max_inflight:
+                path = next(it, None)
+                if path is None:
+                    break
+                pending[pool.submit(load_tagged_file, path)] = path
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                path = pending.pop(fut)
+                try:
+                    item = _result(path, *fut.result())
+                except Exception as e:
+                    item = _result(path, None, [], f"worker failed: {e}")
+                if item:
+                    yield item
+
+
+def load_documents_grouped_by_tag(upload_dir: str, skip_files: Optional[Set[str]] = None) -> Dict[str, List]:
     """
     讀取 uploaded_docs 內的檔案，依標籤分組成 {tag: [Document, ...]}
     會把 tag 寫入每個 Document.metadata，便於日後 debug / 追蹤。
+    skip_files：增量建庫時內容未變的檔案，直接略過不重新解析。
+    （一次載入全部文件；建庫主流程改用 iter_tagged_documents 串流處理）
     """
     grouped: Dict[str, List] = {t: [] for t in VALID_TAGS}
+    for _, tag, docs in iter_tagged_documents(upload_dir, skip_files=skip_files):
+        grouped[tag].extend(docs)
+    return grouped
 
-    for fn in os.listdir(upload_dir):
-        path = os.path.join(upload_dir, fn)
-        if not os.path.isfile(path):
-            continue
 
-        ext = os.path.splitext(fn)[1].lower()
+# =============================================================================
+# Incremental build: manifest + ID-mapped FAISS index
+# =============================================================================
+def build_config(chunk_size: int, chunk_overlap: int, chunker: str = CHUNKER) -> Dict:
+    """
+    manifest 內記錄的建庫設定；設定不同時舊的向量不可沿用，必須全量重建
+    """
+    return {"model": embedding_id(), "chunker": chunker, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap,
+            "start_index": True}
 
-        # 選 loader
-        try:
-            if ext == ".txt":
-                loader = TextLoader(path, encoding="utf-8")
-            elif ext == ".pdf":
-                loader = PyPDFLoader(path)
-            elif ext == ".docx":
-                loader = Docx2txtLoader(path)
-            else:
-                continue
-        except Exception as e:
-            print(f"Skip {fn} (loader init failed): {e}")
-            continue
 
-        # 先嘗試直接從檔案第一行拿 tag（txt 最穩）
-        tag = parse_tag_from_file(path, ext)
+def make_splitter(chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP, chunker: str = CHUNKER):
+    if chunker not in CHUNKERS:
+        raise ValueError(f"Unknown CHUNKER={chunker!r} (expected one of {CHUNKERS})")
+    if chunker == "cjk":
+        return CJKTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
 
-        try:
-            docs = loader.load()
-        except Exception as e:
-            print(f"Skip {fn} (load failed): {e}")
-            continue
 
-        # 若前面拿不到 tag，改從載入後內容的第一個非空行解析
-        if tag is None and docs:
-            tag = parse_tag_from_text_first_line(docs[0].page_content)
+def load_manifest(out_dir: str) -> Optional[Dict]:
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Ignore broken manifest {path}: {e}")
+        return None
 
-        if tag is None:
-            print(f"Skip {fn} (no valid tag in first line). Expected one of: {sorted(VALID_TAGS)}")
-            continue
 
-        # 寫 metadata 並加入分組
-        for d in docs:
-            d.metadata = d.metadata or {}
-            d.metadata["tag"] = tag
-            d.metadata["source_file"] = fn
-            d.metadata["source_path"] = path
+def save_manifest(out_dir: str, manifest: Dict):
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
 
-        grouped[tag].extend(docs)
-        print(f"Loaded: {fn}  -> tag={tag}")
 
-    return grouped
+def mark_publishing(out_dir: str):
+    """
+    覆寫任何檔案前先在磁碟上的 manifest 標記 publishing（version 不變），全部寫完後 save_manifest 換上新版本並清掉標記。
+    app.py 看到標記就不載入；載入後再讀一次，有標記或 version 不同代表檔案可能混到兩個版本，整批捨棄
+    """
+    manifest = load_manifest(out_dir) or {}
+    manifest["publishing"] = True
+    save_manifest(out_dir, manifest)
+
 
+def write_index_atomic(index, path: str):
+    # 先寫暫存檔再 os.replace：app 端可能正 mmap 著舊檔，不能原地覆寫
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
 
-def build_faiss_for_tag(tag: str, docs: List, emb, chunk_size: int = 900, chunk_overlap: int = 150):
+
+def save_store(vs: FAISS, out_dir: str):
     """
-    單一 tag 建庫並輸出
+    寫出 index.faiss + index.pkl（LangChain load_local 格式，增量建庫會讀回）
+    以及 app.py 用 mmap 載入的 docstore.bin / docstore_ids.npy
     """
-    if not docs:
-        print(f"[{tag}] No documents. Skip building FAISS.")
-        return
+    write_index_atomic(vs.index, os.path.join(out_dir, INDEX_FILE))
+    pkl_path = os.path.join(out_dir, "index.pkl")
+    with open(pkl_path + ".tmp", "wb") as f:
+        pickle.dump((vs.docstore, vs.index_to_docstore_id), f)
+    os.replace(pkl_path + ".tmp", pkl_path)
+    write_mmap_docstore(out_dir, vs)
+
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    split_docs = splitter.split_documents(docs)
-    print(f"[{tag}] docs={len(docs)}, chunks={len(split_docs)}")
+def new_manifest(config: Dict) -> Dict:
+    return {"config": config, "next_id": 0, "files": {}}
 
+
+def open_tag_store(tag: str, emb, config: Dict, incremental: bool) -> Tuple[Optional[FAISS], Dict]:
+    """
+    讀取既有的 tag 資料庫與 manifest。
+    只有 manifest 設定一致、且 index 是 IndexIDMap2（可依 id 刪除）時才沿用；
+    否則回傳 (None, 空 manifest)，代表這個 tag 要全量重建。
+    """
     out_dir = OUT_DIR_BY_TAG[tag]
-    vs = FAISS.from_documents(split_docs, emb)
-    vs.save_local(out_dir)
-    print(f"[{tag}] OK: saved to {out_dir}/")
+    manifest = load_manifest(out_dir) if incremental else None
+    if not manifest or manifest.get("config") != config:
+        return None, new_manifest(config)
+    if manifest.get("publishing"):
+        print(f"[{tag}] Previous build did not finish publishing, rebuild.")
+        return None, new_manifest(config)
+    try:
+        vs = FAISS.load_local(out_dir, embeddings=emb, allow_dangerous_deserialization=True)
+    except Exception as e:
+        print(f"[{tag}] Existing DB not loadable, rebuild: {e}")
+        return None, new_manifest(config)
+    # 服務用的 index 若是壓縮/近似版本，增量更新要改用精確的 master index
+    master_path = os.path.join(out_dir, MASTER_INDEX_FILE)
+    if manifest.get("index", {}).get("type", "flat") != "flat":
+        if not os.path.isfile(master_path):
+            print(f"[{tag}] Missing {MASTER_INDEX_FILE}, rebuild.")
+            return None, new_manifest(config)
+        vs.index = faiss.read_index(master_path)
+    if not isinstance(vs.index, faiss.IndexIDMap2):
+        print(f"[{tag}] Existing DB is not ID-mapped, rebuild.")
+        return None, new_manifest(config)
+    return vs, manifest
+
+
+def add_chunks(vs: Optional[FAISS], chunks: List, emb, start_id: int) -> Tuple[FAISS, List[int]]:
+    """
+    embed chunks 並以連續的 int64 id 加入 IndexIDMap2。
+    docstore 的 key 用 str(id)，index_to_docstore_id 以 FAISS id 為 key（搜尋結果回傳的就是 id）。
+    embed 的文字補上 chunk 所屬的文件標題/段落標題（cjk chunker 寫在 metadata），docstore 存原文。
+    """
+    vecs = np.asarray(emb.embed_documents([embedding_text(d) for d in chunks]), dtype="float32")
+    if vs is None:
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(vecs.shape[1]))
+        vs = FAISS(embedding_function=emb, index=index, docstore=InMemoryDocstore(), index_to_docstore_id={})
+
+    ids = list(range(start_id, start_id + len(chunks)))
+    vs.index.add_with_ids(vecs, np.asarray(ids, dtype="int64"))
+    vs.docstore.add({str(i): d for i, d in zip(ids, chunks)})
+    for i in ids:
+        vs.index_to_docstore_id[i] = str(i)
+    return vs, ids
+
+
+def remove_chunks(vs: FAISS, ids: List[int]):
+    if not ids:
+        return
+    vs.index.remove_ids(np.asarray(ids, dtype="int64"))
+    vs.docstore.delete([str(i) for i in ids])
+    for i in ids:
+        vs.index_to_docstore_id.pop(i, None)
+
+
+# =============================================================================
+# Serving index: flat / IVF / HNSW / PQ / SQ8
+# =============================================================================
+def index_type_for_tag(tag: str) -> str:
+    index_type = os.environ.get(f"FAISS_INDEX_TYPE_{tag.upper()}", DEFAULT_INDEX_TYPE).lower()
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown FAISS index type for {tag}: {index_type} (expected one of {INDEX_TYPES})")
+    return index_type
+
+
+def build_serving_index(master, index_type: str) -> Tuple[object, Dict]:
+    """
+    由精確的 IndexIDMap2(IndexFlatL2) 產生服務用 index（同樣包 IndexIDMap2，保留相同 id）。
+    回傳 (index, info)；資料量太少、無法訓練時退回較簡單的類型。
+    """
+    n, d = master.ntotal, master.d
+    requested = index_type
+    if index_type == "pq" and n < 256:
+        # 8-bit PQ 至少需要 256 筆訓練資料
+        print(f"  pq needs >= 256 vectors (have {n}), fallback to sq8")
+        index_type = "sq8"
+    if index_type == "flat" or n == 0:
+        return master, {"type": "flat", "requested": requested, "search_params": {}}
+
+    nlist = max(1, min(int(4 * n ** 0.5), n // 39))
+    search_params: Dict[str, int] = {}
+    if index_type == "ivf":
+        desc = f"IVF{nlist},Flat"
+        search_params["nprobe"] = min(nlist, IVF_NPROBE)
+    elif index_type == "hnsw":
+        desc = f"HNSW{HNSW_M}"
+        search_params["efSearch"] = HNSW_EF_SEARCH
+    elif index_type == "pq":
+        m = max(k for k in range(1, d // 8 + 1) if d % k == 0)
+        desc = f"PQ{m}"
+    else:
+        desc = "SQ8"
+
+    xb = master.index.reconstruct_n(0, n)
+    ids = faiss.vector_to_array(master.id_map).astype("int64")
+    index = faiss.index_factory(d, desc)
+    if not index.is_trained:
+        index.train(xb)
+    wrapped = faiss.IndexIDMap2(index)
+    wrapped.add_with_ids(xb, ids)
+    ps = faiss.ParameterSpace()
+    for k, v in search_params.items():
+        ps.set_index_parameter(wrapped, k, v)
+    return wrapped, {"type": index_type, "requested": requested, "factory": desc, "search_params": search_params}
+
+
+def load_recall_queries(path: str) -> Dict[Optional[str], List[str]]:
+    """
+    回傳 {tag 或 None（套用全部 tag）: [問題, ...]}
+    """
+    out: Dict[Optional[str], List[str]] = {}
+    if not path or not os.path.isfile(path):
+        return out
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            tag, _, q = line.partition("\t")
+            if not q:
+                tag, q = None, line
+            out.setdefault(tag, []).append(q)
+    return out
+
+
+def evaluate_recall(master, serving, queries: np.ndarray, k: int = RECALL_K) -> Dict:
+    """
+    recall@k：近似 index 的前 k 名中，有多少也在精確搜尋（flat）的前 k 名
+    """
+    k = min(k, master.ntotal)
+    _, truth = master.search(queries, k)
+    t0 = time.perf_counter()
+    _, got = serving.search(queries, k)
+    ms = (time.perf_counter() - t0) * 1000 / max(1, len(queries))
+    hits = sum(len(set(a) & set(b)) for a, b in zip(truth, got))
+    return {"k": k, "recall": hits / (len(queries) * k), "ms_per_query": ms}
+
+
+def unchanged_files(manifest: Dict, hashes: Dict[str, str]) -> Set[str]:
+    return {fn for fn, entry in manifest.get("files", {}).items() if hashes.get(fn) == entry.get("sha256")}
+
+
+class TagIndexBuilder:
+    """
+    單一 tag 的（增量）建庫狀態：
+    - 建立時先移除 manifest 中已刪除/已修改檔案的向量
+    - add_file() 串流接收新檔案：立即切 chunk，累積到 batch_size 再一次 embed
+    - finish() 寫出 FAISS（course_requirement 另有先修圖）與 manifest
+    """
+
+    def __init__(self, tag: str, emb, hashes: Dict[str, str], vs: Optional[FAISS], manifest: Dict,
+                 splitter, batch_size: int = EMBED_BATCH_SIZE,
+                 index_type: str = "flat", recall_queries: Optional[List[str]] = None,
+                 faq_generator=None, faq_questions: Optional[List[str]] = None,
+                 course_graph_texts: Optional[Dict[str, str]] = None):
+        self.tag = tag
+        # None：這個 tag 沒有先修圖；{}：有先修圖但已沒有來源檔案（舊的 course_graph.json 要刪掉）
+        self.course_graph_texts = course_graph_texts
+        self.faq_generator = faq_generator
+        self.faq_questions = faq_questions or []
+        self.index_type = index_type
+        self.recall_queries = recall_queries or []
+        self.emb = emb
+        self.hashes = hashes
+        self.vs = vs
+        self.manifest = manifest
+        self.splitter = splitter
+        self.batch_size = max(1, batch_size)
+
+        self.pending: List[Tuple[str, object]] = []  # [(檔名, chunk)] 等待 embed
+        self.added_files = 0
+        self.added_chunks = 0
+
+        self.keep = unchanged_files(manifest, hashes)
+        # 刪除：已刪除、內容已改、或改標到別的 tag 的舊檔案
+        self.stale = [fn for fn in manifest["files"] if fn not in self.keep]
+        for fn in self.stale:
+            if vs is not None:
+                remove_chunks(vs, manifest["files"][fn]["ids"])
+            del manifest["files"][fn]
+
+    def add_file(self, fn: str, docs: List):
+        self.manifest["files"][fn] = {"sha256": self.hashes[fn], "ids": []}
+        self.added_files += 1
+        for chunk in self.splitter.split_documents(docs):
+            self.pending.append((fn, chunk))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            self.vs, ids = add_chunks(self.vs, [c for _, c in batch], self.emb, self.manifest["next_id"])
+            self.manifest["next_id"] += len(ids)
+            for (fn, _), i in zip(batch, ids):
+                self.manifest["files"][fn]["ids"].append(i)
+            self.added_chunks += len(ids)
+
+    def finish(self):
+        tag = self.tag
+        out_dir = OUT_DIR_BY_TAG[tag]
+        self.flush()
+
+        if not self.added_files and self.vs is None:
+            print(f"[{tag}] No documents. Skip building FAISS.")
+            return
+        same_index = self.manifest.get("index", {}).get("requested") == self.index_type
+        has_faq = self.faq_generator is None or has_faq_index(out_dir)
+        has_graph = self.course_graph_texts is None or (
+            bool(self.course_graph_texts) == os.path.isfile(os.path.join(out_dir, COURSE_GRAPH_FILE))
+        )
+        if (not self.added_files and not self.stale and same_index and has_lexical_index(out_dir)
+                and has_faq and has_graph):
+            print(f"[{tag}] Up to date ({len(self.keep)} files).")
+            return
+
+        print(f"[{tag}] added_files={self.added_files} (chunks={self.added_chunks}), "
+              f"removed_files={len(self.stale)}, kept_files={len(self.keep)}, "
+              f"total_vectors={self.vs.index.ntotal if self.vs else 0}")
+        if self.vs is None:
+            print(f"[{tag}] No chunks. Skip building FAISS.")
+            return
+
+        os.makedirs(out_dir, exist_ok=True)
+        mark_publishing(out_dir)
+        master = self.vs.index
+        serving, info = build_serving_index(master, self.index_type)
+        master_path = os.path.join(out_dir, MASTER_INDEX_FILE)
+        if serving is master:
+            save_store(self.vs, out_dir)
+            if os.path.exists(master_path):
+                os.remove(master_path)
+        else:
+            write_index_atomic(master, master_path)
+            info["recall"] = self.report_recall(master, serving, info["type"])
+            self.vs.index = serving
+            try:
+                save_store(self.vs, out_dir)
+            finally:
+                self.vs.index = master
+
+        # BM25 倒排索引（中文字元 bigram）：與向量庫同一份 chunk，app.py 檢索時兩者平行查詢再合併
+        write_lexical_index(out_dir, self.vs)
+        if self.faq_generator is not None:
+            self.write_faq(out_dir)
+        self.write_graph(out_dir)
+
+        info["bytes"] = int(faiss.serialize_index(serving).size)
+        self.manifest["index"] = info
+        # manifest 最後寫入（同時清掉 publishing 標記）：app.py 以 version 變化判斷新版本已完整發布，才熱更新
+        self.manifest.pop("publishing", None)
+        self.manifest["version"] = datetime.now().strftime("%Y%m%d-%H%M%S.%f")[:-3]
+        save_manifest(out_dir, self.manifest)
+        print(f"[{tag}] OK: saved to {out_dir}/ (index={info['type']}, {info['bytes'] / 1024:.1f} KiB)")
+
+    def write_graph(self, out_dir: str):
+        """
+        先修圖只在這個 tag 重新發布時寫出（接著寫 manifest、版本更新，app.py 才會重新載入）；沒有來源檔案就刪除
+        """
+        if self.course_graph_texts is None:
+            return
+        path = os.path.join(out_dir, COURSE_GRAPH_FILE)
+        if not self.course_graph_texts:
+            if os.path.exists(path):
+                os.remove(path)
+                print(f"[{self.tag}] course graph removed (no source files)")
+            return
+        graph = build_course_graph(self.course_graph_texts)
+        write_course_graph(out_dir, graph)
+        print(f"[{self.tag}] course graph: {len(graph['courses'])} courses, {len(graph['edges'])} prerequisite edges, "
+              f"graduation={'yes' if graph['graduation'] else 'no'}")
+
+    def write_faq(self, out_dir: str):
+        """
+        以精確的 master index 檢索（與線上 flat 結果相同），預先回答並寫出 faq.json / faq.npz；
+        失敗只印警告，不影響這次建庫
+        """
+        try:
+            stats = build_faq(
+                out_dir, self.vs, load_lexical_index(out_dir), self.emb, self.faq_generator, self.hashes,
+                LABEL_BY_TAG.get(self.tag, self.tag),
+                questions_per_doc=FAQ_QUESTIONS_PER_DOC, curated=self.faq_questions,
+                min_relevance=FAQ_MIN_RELEVANCE, min_grounding=FAQ_MIN_GROUNDING,
+            )
+        except Exception as e:
+            print(f"⚠️ [{self.tag}] FAQ build failed: {e}")
+            return
+        print(f"[{self.tag}] FAQ: {stats['approved']}/{stats['questions']} approved "
+              f"(reused={stats['reused']}, generated={stats['generated']}, "
+              f"ambiguous_dropped={stats['dropped_ambiguous']})")
+
+    def report_recall(self, master, serving, index_type: str) -> Dict:
+        """
+        在查詢集上比較近似 index 與 flat 的 recall@k 並印出
+        """
+        if self.recall_queries:
+            queries = np.asarray(self.emb.embed_documents(self.recall_queries), dtype="float32")
+            source = RECALL_QUERY_FILE
+        else:
+            rng = np.random.default_rng(0)
+            n = master.ntotal
+            sample = master.index.reconstruct_n(0, n)[rng.choice(n, size=min(RECALL_SAMPLE, n), replace=False)]
+            queries = (sample + rng.normal(0, 0.05, sample.shape)).astype("float32")
+            source = "sampled"
+        r = evaluate_recall(master, serving, queries)
+        flat_bytes = faiss.serialize_index(master).size
+        serving_bytes = faiss.serialize_index(serving).size
+        print(f"[{self.tag}] {index_type}: recall@{r['k']}={r['recall']:.3f} vs flat "
+              f"(queries={len(queries)}, {source}), {r['ms_per_query']:.3f} ms/query, "
+              f"size {serving_bytes / 1024:.1f} KiB vs flat {flat_bytes / 1024:.1f} KiB")
+        r["queries"] = len(queries)
+        r["source"] = source
+        return r
+
+
+def build_faiss_for_tag(tag: str, docs: List, emb, hashes: Dict[str, str],
+                        vs: Optional[FAISS], manifest: Dict,
+                        chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    """
+    單一 tag 建庫並輸出（增量，一次給齊 docs 的版本）
+    docs：只包含新增/修改的檔案；manifest 內 hash 不變的檔案原封保留，其餘舊檔案的向量移除。
+    """
+    splitter = make_splitter(chunk_size, chunk_overlap)
+    builder = TagIndexBuilder(tag, emb, hashes, vs, manifest, splitter, index_type=index_type_for_tag(tag))
+    by_file: Dict[str, List] = {}
+    for d in docs:
+        by_file.setdefault(d.metadata["source_file"], []).append(d)
+    for fn, file_docs in sorted(by_file.items()):
+        builder.add_file(fn, file_docs)
+    builder.finish()
+
+
+def course_graph_sources(upload_dir: str, tag: str = COURSE_GRAPH_TAG) -> Dict[str, str]:
+    """
+    該 tag 的 txt（先修鏈、開課清單、修業規定）全文 {檔名: 內容}；由 TagIndexBuilder.write_graph 解析成先修圖
+    """
+    texts = {}
+    for fn in sorted(os.listdir(upload_dir)):
+        path = os.path.join(upload_dir, fn)
+        ext = os.path.splitext(fn)[1].lower()
+        if ext != ".txt" or parse_tag_from_file(path, ext) != tag:
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            texts[fn] = f.read()
+    return texts
 
 
 def main():
     os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-    grouped = load_documents_grouped_by_tag(UPLOAD_DIR)
+    # embedding 後端（EMBED_BACKEND）必須與 app.py 相同；後端識別字串記在 manifest 的 config.model
+    emb = with_embedding_cache(
+        create_embeddings(EMBED_MODEL_NAME),
+        embedding_id(), EMBED_CACHE_DIR, max_entries=EMBED_CACHE_MAX_ENTRIES,
+    )
+    config = build_config(CHUNK_SIZE, CHUNK_OVERLAP)
+    splitter = make_splitter(CHUNK_SIZE, CHUNK_OVERLAP)
+
+    # 先讀各 tag 既有的資料庫與 manifest，找出內容未變的檔案（不必重新解析與 embed）
+    hashes = hash_upload_dir(UPLOAD_DIR)
+    recall_queries = load_recall_queries(RECALL_QUERY_FILE)
+    faq_generator = create_faq_generator(FAQ_GENERATOR)
+    faq_questions = load_recall_queries(FAQ_QUESTION_FILE) if faq_generator else {}
+    graph_texts = course_graph_sources(UPLOAD_DIR)
+    builders = {}
+    skip = set()
+    for tag in sorted(VALID_TAGS):
+        vs, manifest = open_tag_store(tag, emb, config, INCREMENTAL_BUILD)
+        skip |= unchanged_files(manifest, hashes)
+        builders[tag] = TagIndexBuilder(
+            tag, emb, hashes, vs, manifest, splitter,
+            index_type=index_type_for_tag(tag),
+            recall_queries=recall_queries.get(tag, []) + recall_queries.get(None, []),
+            faq_generator=faq_generator,
+            faq_questions=faq_questions.get(tag, []) + faq_questions.get(None, []),
+            course_graph_texts=graph_texts if tag == COURSE_GRAPH_TAG else None,
+        )
+
+    # 串流：解析（process pool）→ 切 chunk → 分 tag 累積 batch → embed
+    n_loaded = 0
+    for fn, tag, docs in iter_tagged_documents(UPLOAD_DIR, skip_files=skip,
+                                               workers=INGEST_WORKERS, max_inflight=INGEST_MAX_INFLIGHT):
+        builders[tag].add_file(fn, docs)
+        n_loaded += 1
 
     # 至少要有一組有資料
-    total = sum(len(v) for v in grouped.values())
-    if total == 0:
+    if n_loaded == 0 and not skip:
         raise RuntimeError(
             f"No valid tagged documents found in {UPLOAD_DIR}. "
             f"Ensure first non-empty line is like '類型：department_announcement'."
         )
-
-    emb = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    print(f"Unchanged files skipped: {len(skip)}, files (re)embedded: {n_loaded}")
 
     for tag in sorted(VALID_TAGS):
-        build_faiss_for_tag(tag, grouped[tag], emb, chunk_size=900, chunk_overlap=150)
+        builders[tag].finish()
 
 
 if __name__ == "__main__":
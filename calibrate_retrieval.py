@@ -0,0 +1,128 @@
+"""
+校正各類別（mode）的檢索門檻，產生 app.py 讀取的 retrieval_thresholds.json
+
+標註檔（CALIBRATION_FILE，預設 calibration_queries.txt），每行：
+    mode<TAB>1<TAB>問題     （1 = 資料庫裡有答案）
+    mode<TAB>0<TAB>問題     （0 = 無關 / 資料庫沒有答案）
+
+每題取最相關片段的相關度；門檻取「有答案的題目至少 CALIBRATE_MIN_RECALL 比例仍能通過」的最高值，
+再減去 CALIBRATE_MARGIN 保留一點餘裕。只有 0 或只有 1 的類別不產生門檻（沿用 RAG_MIN_RELEVANCE）。
+"""
+import json
+import math
+import os
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import faiss
+from langchain_community.vectorstores import FAISS
+
+from build_faiss_db import EMBED_CACHE_DIR, EMBED_CACHE_MAX_ENTRIES, VALID_TAGS
+from embedding_backend import EMBED_MODEL_NAME, create_embeddings, embedding_id
+from embedding_cache import with_embedding_cache
+from mmap_store import has_mmap_docstore, load_mmap_vectorstore
+from retrieval import scored_search
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FAISS_DB_DIR = os.environ.get("FAISS_DB_DIR", os.path.join(BASE_DIR, "faiss_db"))
+CALIBRATION_FILE = os.environ.get("CALIBRATION_FILE", "calibration_queries.txt")
+OUTPUT_FILE = os.environ.get("RAG_THRESHOLDS_FILE", os.path.join(BASE_DIR, "retrieval_thresholds.json"))
+CALIBRATE_MIN_RECALL = float(os.environ.get("CALIBRATE_MIN_RECALL", "0.95"))
+CALIBRATE_MARGIN = float(os.environ.get("CALIBRATE_MARGIN", "0.01"))
+
+
+def load_labeled_queries(path: str) -> Dict[str, List[Tuple[bool, str]]]:
+    """
+    回傳 {mode: [(有答案?, 問題), ...]}
+    """
+    out: Dict[str, List[Tuple[bool, str]]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split("\t", 2)
+            if len(parts) != 3 or parts[0] not in VALID_TAGS or parts[1] not in ("0", "1"):
+                print(f"⚠️ Skip line {n}: {line[:40]}")
+                continue
+            out.setdefault(parts[0], []).append((parts[1] == "1", parts[2]))
+    return out
+
+
+def load_vectorstore(path: str, emb):
+    vs = load_mmap_vectorstore(path, emb) if has_mmap_docstore(path) else \
+        FAISS.load_local(path, embeddings=emb, allow_dangerous_deserialization=True)
+    # 近似 index 套用建庫時的搜尋參數，讓分數與線上一致
+    try:
+        with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+            params = json.load(f).get("index", {}).get("search_params") or {}
+    except Exception:
+        params = {}
+    ps = faiss.ParameterSpace()
+    for k, v in params.items():
+        ps.set_index_parameter(vs.index, k, v)
+    return vs
+
+
+def pick_threshold(pos: List[float], min_recall: float) -> float:
+    ranked = sorted(pos, reverse=True)
+    keep = max(1, math.ceil(min_recall * len(ranked)))
+    return ranked[keep - 1]
+
+
+def main():
+    labeled = load_labeled_queries(CALIBRATION_FILE)
+    if not labeled:
+        raise RuntimeError(f"No labeled queries in {CALIBRATION_FILE} (format: mode<TAB>1|0<TAB>問題)")
+
+    emb = with_embedding_cache(
+        create_embeddings(EMBED_MODEL_NAME),
+        embedding_id(), EMBED_CACHE_DIR, max_entries=EMBED_CACHE_MAX_ENTRIES,
+    )
+
+    thresholds, stats = {}, {}
+    for mode in sorted(labeled):
+        path = os.path.join(FAISS_DB_DIR, f"faiss_db_{mode}")
+        if not os.path.isdir(path):
+            print(f"⚠️ [{mode}] no database at {path}, skipped.")
+            continue
+        vs = load_vectorstore(path, emb)
+
+        vecs = [emb.embed_query(q) for _, q in labeled[mode]]
+        pos, neg = [], []
+        for (has_answer, _), vec in zip(labeled[mode], vecs):
+            hits = scored_search(vs, vec, k=1)
+            top = hits[0][1] if hits else 0.0
+            (pos if has_answer else neg).append(top)
+
+        if not pos or not neg:
+            print(f"⚠️ [{mode}] needs both 1 and 0 labels (got {len(pos)}/{len(neg)}), skipped.")
+            continue
+
+        t = max(0.0, pick_threshold(pos, CALIBRATE_MIN_RECALL) - CALIBRATE_MARGIN)
+        kept = sum(r >= t for r in pos) / len(pos)
+        rejected = sum(r < t for r in neg) / len(neg)
+        thresholds[mode] = round(t, 4)
+        stats[mode] = {
+            "positives": len(pos), "negatives": len(neg),
+            "positive_kept": round(kept, 4), "negative_rejected": round(rejected, 4),
+        }
+        print(f"✅ [{mode}] threshold={t:.4f} keeps {kept:.0%} answerable, rejects {rejected:.0%} off-topic")
+
+    out = {
+        "model": embedding_id(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "min_recall": CALIBRATE_MIN_RECALL,
+        "thresholds": thresholds,
+        "stats": stats,
+    }
+    tmp = OUTPUT_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(out, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, OUTPUT_FILE)
+    print(f"Saved: {OUTPUT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""
+修課規定的結構化資料：先修關係圖 + 課程目錄 + 畢業學分（build_faiss_db.py 寫出、app.py 載入）
+
+來源（course_requirement 類的 txt，依內容辨識，不依檔名）：
+- 先修鏈：含「→」的行，例如「電路學 → 電子學 →（延伸）控制理論／數位控制」
+- 課程目錄：「- 課名｜N學分｜必修/選修｜教師：…｜先修限制：需先修「課名/…」」
+- 畢業學分：「- 畢業總學分：130 學分」「- 通識課程：28 學分」「…至多承認 9 學分」
+
+app.py 對「X 要先修什麼」「X 之後可以修什麼」「X 幾學分/誰教」「畢業要幾學分」直接由圖回答，不經檢索與 LLM。
+"""
+import json
+import os
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+
+COURSE_GRAPH_FILE = "course_graph.json"
+
+EDGE_SUGGESTED = "suggested"   # 先修鏈文件中的建議順序
+EDGE_EXTENSION = "extension"   # 先修鏈中標示（延伸）的後續課
+EDGE_REQUIRED = "required"     # 課程目錄明列的先修限制
+
+_BULLET_RE = re.compile(r"^\s*(?:[-•*]|\d+\s*[).、]|[A-Za-z][.、])?\s*")
+_EXT_RE = re.compile(r"^（[^）]*延伸[^）]*）|^\([^)]*延伸[^)]*\)")
+_COURSE_LINE_RE = re.compile(r"^\s*-\s*([^｜|]+)[｜|](.+)$")
+_GRADE_RE = re.compile(r"【\s*([一二三四五六])年級")
+_CREDIT_RE = re.compile(r"(\d+)\s*學分")
+_NUM_SUFFIX_RE = re.compile(r"^(.+)\(([一二三四五六])\)$")
+_PAREN_SUFFIX_RE = re.compile(r"^(.+?)\([^()]*\)$")
+CHAIN_DOC_PATTERN = re.compile(r"修課順序|先修鏈|先修順序")
+_GRADE_NUM = {"一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6}
+
+# 學生常用簡稱 → 課名（只有圖中真的有這門課才會生效；問題中另有 COURSE_INTENT_PATTERN 才採用，避免「網路實驗室」被當成課名）
+ALIASES = {
+    "dsp": "數位訊號處理",
+    "os": "作業系統",
+    "網路": "計算機網路",
+    "計概": "計算機概論",
+    "程設": "程式設計",
+    "資結": "資料結構",
+    "普物": "普通物理學",
+    "物理一": "普通物理學（一）",
+    "物理二": "普通物理學（二）",
+    "物理實驗": "普通物理學實驗",
+    "自控": "自動控制",
+    "數值": "數值方法",
+}
+
+PREREQ_PATTERN = re.compile(r"先修|之前|以前|前面|要先|先上|基礎|擋修")
+NEXT_PATTERN = re.compile(r"之後|以後|後面|接著|接下來|延伸|進階|下一")
+INFO_PATTERN = re.compile(r"學分|誰教|授課|必修|選修|必選|開課|幾年級")
+COURSE_INTENT_PATTERN = re.compile(r"先修|擋修|學分|必修|選修|必選|修課|這門課|誰教|授課|開課")
+GRAD_PATTERN = re.compile(r"畢業")
+# 課程資訊問題問的是哪個欄位：紀錄中沒有該欄位就交給 RAG（避免答非所問）
+INFO_FIELDS = (
+    ("credits", re.compile(r"學分")),
+    ("category", re.compile(r"必修|選修|必選")),
+    ("teachers", re.compile(r"誰教|授課")),
+    ("grade", re.compile(r"開課|幾年級")),
+)
+# 一個問題問了好幾件事（「…幾學分？英文門檻呢」）時先修圖只能答一部分，整題交給 RAG
+_CLAUSE_SPLIT = re.compile(r"[，,。？?！!；;\n]+|還有|另外|以及|順便")
+CREDIT_PATTERN = re.compile(r"學分")
+
+# CourseGraph.intent 的問題類型（先修/後續/畢業學分屬於修課規定特有的問題，課程資訊則可能與其他類別重疊）
+INTENT_GRADUATION = "graduation"
+INTENT_PREREQ = "prereq"
+INTENT_NEXT = "next"
+INTENT_INFO = "info"
+
+SUGGESTED_NOTE = "（以上為系上整理的建議修課順序，正式先修限制以當學期課程系統/課綱為準）"
+
+
+def _is_ascii_alnum(ch: str) -> bool:
+    return ch.isascii() and ch.isalnum()
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", text or "")).lower()
+
+
+# =============================================================================
+# Parsing（build_faiss_db.py）
+# =============================================================================
+def _split_alternatives(segment: str) -> Tuple[List[str], bool]:
+    seg = segment.strip()
+    ext = bool(_EXT_RE.match(seg))
+    seg = _EXT_RE.sub("", seg).strip()
+    names = [s.strip() for s in re.split(r"[／/]", seg) if s.strip()]
+    return names, ext
+
+
+def parse_prereq_chains(text: str) -> List[Dict]:
+    # 只有先修鏈文件才解析「→」（其他規定文件也可能用箭頭表示「→ 退學」之類的結果）
+    if not CHAIN_DOC_PATTERN.search(text):
+        return []
+    edges = []
+    for line in text.splitlines():
+        if "→" not in line:
+            continue
+        body = _BULLET_RE.sub("", line.strip(), count=1)
+        segments = [_split_alternatives(s) for s in body.split("→")]
+        if any(not names or any(len(n) > 30 or re.search(r"[：:，,。]", n) for n in names)
+               for names, _ in segments):
+            continue
+        for (pres, _), (posts, ext) in zip(segments, segments[1:]):
+            for pre in pres:
+                for post in posts:
+                    edges.append({"from": pre, "to": post,
+                                  "kind": EDGE_EXTENSION if ext else EDGE_SUGGESTED, "cond": ""})
+    return edges
+
+
+def _parse_prereq_field(value: str) -> List[Tuple[str, str]]:
+    """
+    「需先修「工程科學暨創新概論/2學分/60分以上」」或「工程科學暨創新概論（60分以上）」→ [(課名, 條件)]
+    """
+    quoted = re.findall(r"「([^」]+)」", value)
+    items = quoted or [s for s in re.split(r"[、，,]", re.sub(r"^需?先修", "", value)) if s.strip()]
+    out = []
+    for item in items:
+        parts = [p.strip() for p in item.split("/") if p.strip()]
+        if not parts:
+            continue
+        name, conds = parts[0], [p for p in parts[1:] if not _CREDIT_RE.fullmatch(p)]
+        m = re.match(r"^(.+?)[（(]([^）)]*(?:分|以上|及格)[^）)]*)[）)]$", name)
+        if m:
+            name, conds = m.group(1).strip(), [m.group(2).strip()] + conds
+        out.append((name, "、".join(conds)))
+    return out
+
+
+def parse_course_catalog(text: str) -> Tuple[Dict[str, Dict], List[Dict]]:
+    courses: Dict[str, Dict] = {}
+    edges: List[Dict] = []
+    grade = None
+    for line in text.splitlines():
+        m = _GRADE_RE.search(line)
+        if m:
+            grade = _GRADE_NUM[m.group(1)]
+            continue
+        m = _COURSE_LINE_RE.match(line)
+        if not m or not _CREDIT_RE.search(m.group(2)):
+            continue
+        name = m.group(1).strip()
+        c = {"name": name, "credits": None, "category": "", "teachers": [], "grade": grade,
+             "restrictions": [], "notes": []}
+        for field in (f.strip() for f in re.split(r"[｜|]", m.group(2))):
+            cm = _CREDIT_RE.fullmatch(field)
+            if cm:
+                c["credits"] = int(cm.group(1))
+            elif field.startswith(("必修", "選修")):
+                c["category"] = field
+            elif field.startswith(("教師：", "主負責：")):
+                c["teachers"] = [t.strip() for t in re.split(r"[、,，]", field.split("：", 1)[1]) if t.strip()]
+            elif field.startswith("先修限制："):
+                for pre, cond in _parse_prereq_field(field.split("：", 1)[1]):
+                    edges.append({"from": pre, "to": name, "kind": EDGE_REQUIRED, "cond": cond})
+            elif field.startswith("限制："):
+                c["restrictions"].append(field.split("：", 1)[1])
+            elif field.startswith("備註："):
+                c["notes"].append(field.split("：", 1)[1])
+        courses[name] = c
+    return courses, edges
+
+
+def parse_graduation(text: str) -> Optional[Dict]:
+    if "畢業總學分" not in text:
+        return None
+    grad = {"total": None, "items": {}, "limits": [], "title": ""}
+    for line in text.splitlines():
+        s = line.strip()
+        if s.startswith("主題："):
+            grad["title"] = s.split("：", 1)[1]
+        body = s.lstrip("-•* ").strip()
+        m = re.match(r"^(.+?)[:：]\s*(\d+)\s*學分$", body)
+        if m:
+            if "畢業總學分" in m.group(1):
+                grad["total"] = int(m.group(2))
+            else:
+                grad["items"][m.group(1).strip()] = int(m.group(2))
+        elif re.search(r"至多承認\s*\d+\s*學分", body):
+            grad["limits"].append(body)
+    return grad
+
+
+def _merge_course(dst: Dict, src: Dict):
+    for k, v in src.items():
+        if isinstance(v, list):
+            dst[k] = dst.get(k) or []
+            dst[k].extend(x for x in v if x not in dst[k])
+        elif not dst.get(k) and v:
+            dst[k] = v
+
+
+def build_course_graph(texts: Dict[str, str]) -> Dict:
+    """
+    texts：{檔名: 內容}（course_requirement 類）→ 可直接 json.dump 的圖
+    """
+    courses: Dict[str, Dict] = {}
+    edges: List[Dict] = []
+    graduation = None
+    for fn in sorted(texts):
+        text = texts[fn]
+        edges.extend(parse_prereq_chains(text))
+        cat, cat_edges = parse_course_catalog(text)
+        for name, c in cat.items():
+            _merge_course(courses.setdefault(name, {"name": name}), c)
+        edges.extend(cat_edges)
+        g = parse_graduation(text)
+        if g:
+            g["source"] = fn
+            graduation = graduation or g
+
+    seen = set()
+    unique = []
+    for e in edges:
+        key = (e["from"], e["to"], e["kind"])
+        if key in seen or e["from"] == e["to"]:
+            continue
+        seen.add(key)
+        unique.append(e)
+        for n in (e["from"], e["to"]):
+            courses.setdefault(n, {"name": n})
+    return {"courses": courses, "edges": unique, "graduation": graduation}
+
+
+def write_course_graph(out_dir: str, graph: Dict):
+    path = os.path.join(out_dir, COURSE_GRAPH_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(graph, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+# =============================================================================
+# Query（app.py）
+# =============================================================================
+class CourseGraph:
+    def __init__(self, data: Dict):
+        self.courses: Dict[str, Dict] = data.get("courses") or {}
+        self.graduation: Optional[Dict] = data.get("graduation")
+        self.parents: Dict[str, List[Dict]] = {}
+        self.children: Dict[str, List[Dict]] = {}
+        for e in data.get("edges") or []:
+            self.parents.setdefault(e["to"], []).append(e)
+            self.children.setdefault(e["from"], []).append(e)
+        self._aliases = self._build_aliases()
+
+    def _build_aliases(self) -> List[Tuple[str, str, bool]]:
+        """
+        [(正規化後的別名, 課名, 是否為 ALIASES 簡稱), ...]，依長度由長到短（比對時長的優先）
+        """
+        aliases: Dict[str, str] = {}
+        numbered: Dict[str, List[Tuple[int, str]]] = {}
+        for name in self.courses:
+            key = normalize(name)
+            aliases[key] = name
+            m = _NUM_SUFFIX_RE.match(key)
+            if m:
+                n = _GRADE_NUM[m.group(2)]
+                aliases.setdefault(m.group(1) + m.group(2), name)
+                aliases.setdefault(m.group(1) + str(n), name)
+                numbered.setdefault(m.group(1), []).append((n, name))
+                continue
+            m = _PAREN_SUFFIX_RE.match(key)
+            if m:
+                aliases.setdefault(m.group(1), name)
+        # 只寫課名主體（例如「工程數學」）時，指向編號最小的那門
+        for base, items in numbered.items():
+            aliases.setdefault(base, min(items)[1])
+        entries = [(alias, name, False) for alias, name in aliases.items()]
+        for alias, name in ALIASES.items():
+            key = normalize(alias)
+            if name in self.courses and key not in aliases:
+                entries.append((key, name, True))
+        return sorted(entries, key=lambda x: -len(x[0]))
+
+    def match_courses(self, question: str) -> List[str]:
+        q = normalize(question)
+        allow_short = COURSE_INTENT_PATTERN.search(q) is not None
+        taken = [False] * len(q)
+        found: List[Tuple[int, str]] = []
+        for alias, name, short in self._aliases:
+            if short and not allow_short:
+                continue
+            start = q.find(alias)
+            while start != -1:
+                end = start + len(alias)
+                boundary = not alias.isascii() or (
+                    (start == 0 or not _is_ascii_alnum(q[start - 1])) and (end == len(q) or not _is_ascii_alnum(q[end]))
+                )
+                if boundary and not any(taken[start:end]):
+                    for i in range(start, end):
+                        taken[i] = True
+                    if name not in (n for _, n in found):
+                        found.append((start, name))
+                start = q.find(alias, start + 1)
+        return [name for _, name in sorted(found)]
+
+    def ancestors(self, course: str) -> Dict[str, int]:
+        """
+        所有（遞移）先修課 → 與目標課的最長距離（1 = 直接先修）
+        """
+        depth: Dict[str, int] = {}
+        stack = [(course, 0, (course,))]
+        while stack:
+            node, d, path = stack.pop()
+            for e in self.parents.get(node, []):
+                pre = e["from"]
+                if pre in path or depth.get(pre, 0) >= d + 1:
+                    continue
+                depth[pre] = d + 1
+                stack.append((pre, d + 1, path + (pre,)))
+        return depth
+
+    # -------------------------------------------------------------------------
+    # answers
+    # -------------------------------------------------------------------------
+    def has_suggested(self, courses: List[str]) -> bool:
+        nodes = set(courses)
+        for c in courses:
+            nodes.update(self.ancestors(c))
+            nodes.update(e["to"] for e in self.children.get(c, []))
+        return any(e["kind"] != EDGE_REQUIRED for n in nodes for e in self.parents.get(n, []))
+
+    def answer_prerequisites(self, course: str) -> str:
+        depth = self.ancestors(course)
+        if not depth:
+            return f"📘 資料中沒有列出「{course}」的先修課程。\n（仍以當學期課程系統/課綱為準）"
+
+        levels: Dict[int, List[str]] = {}
+        for name, d in depth.items():
+            levels.setdefault(d, []).append(name)
+        chain = " → ".join("、".join(sorted(levels[d])) for d in sorted(levels, reverse=True))
+        lines = [f"📘 修「{course}」之前建議先修：", f"{chain} → {course}"]
+
+        required = [e for e in self.parents.get(course, []) if e["kind"] == EDGE_REQUIRED]
+        if required:
+            lines.append("")
+            lines.append("⚠️ 開課清單明列的先修限制：")
+            for e in required:
+                lines.append(f"• {e['from']}" + (f"（{e['cond']}）" if e["cond"] else ""))
+        return "\n".join(lines)
+
+    def answer_next(self, course: str) -> str:
+        nexts = self.children.get(course, [])
+        if not nexts:
+            return f"📘 資料中沒有列出以「{course}」為先修的後續課程。"
+        lines = [f"📘 修完「{course}」之後可以接著修："]
+        for e in nexts:
+            tag = "（延伸）" if e["kind"] == EDGE_EXTENSION else ("（先修限制）" if e["kind"] == EDGE_REQUIRED else "")
+            lines.append(f"• {e['to']}{tag}")
+        return "\n".join(lines)
+
+    def answer_course(self, course: str, asked: Tuple[str, ...] = ()) -> str:
+        """
+        asked：問題問到的欄位（INFO_FIELDS）；任何一個欄位在紀錄中沒有就回傳空字串
+        """
+        c = self.courses.get(course, {})
+        if any(c.get(f) in (None, "", []) for f in asked):
+            return ""
+        lines = [f"📗 {course}"]
+        if c.get("credits") is not None:
+            lines.append(f"• 學分：{c['credits']}")
+        if c.get("category"):
+            lines.append(f"• 類別：{c['category']}")
+        if c.get("teachers"):
+            lines.append(f"• 教師：{'、'.join(c['teachers'])}")
+        if c.get("grade"):
+            lines.append(f"• 開課年級：{c['grade']} 年級")
+        for e in self.parents.get(course, []):
+            if e["kind"] == EDGE_REQUIRED:
+                lines.append(f"• 先修限制：{e['from']}" + (f"（{e['cond']}）" if e["cond"] else ""))
+        suggested = [e["from"] for e in self.parents.get(course, []) if e["kind"] != EDGE_REQUIRED]
+        if suggested:
+            lines.append(f"• 建議先修：{'、'.join(suggested)}")
+        for r in c.get("restrictions") or []:
+            lines.append(f"• 限制：{r}")
+        for n in c.get("notes") or []:
+            lines.append(f"• 備註：{n}")
+        if len(lines) == 1:
+            return ""
+        return "\n".join(lines)
+
+    def answer_graduation(self) -> str:
+        g = self.graduation
+        if not g or not g.get("total"):
+            return ""
+        lines = ["🎓 畢業學分要求" + (f"（{g['title']}）" if g.get("title") else ""),
+                 f"• 畢業總學分：{g['total']} 學分"]
+        for name, credits in g.get("items", {}).items():
+            lines.append(f"  - {name}：{credits} 學分")
+        if g.get("limits"):
+            lines.append("")
+            lines.append("外系/非本系學分承認上限：")
+            lines.extend(f"• {s}" for s in g["limits"])
+        return "\n".join(lines)
+
+    def intent(self, question: str) -> Tuple[Optional[str], List[str]]:
+        """
+        (問題類型, 提到的課程)：類型為 INTENT_GRADUATION / INTENT_PREREQ / INTENT_NEXT / INTENT_INFO，先修圖不能回答則為 None
+        """
+        if len([p for p in _CLAUSE_SPLIT.split(question) if p.strip()]) > 1:
+            return None, []
+        courses = self.match_courses(question)
+        if not courses:
+            if GRAD_PATTERN.search(question) and CREDIT_PATTERN.search(question):
+                return INTENT_GRADUATION, []
+            return None, []
+        courses = courses[:3]
+        if PREREQ_PATTERN.search(question):
+            return INTENT_PREREQ, courses
+        if NEXT_PATTERN.search(question):
+            return INTENT_NEXT, courses
+        if INFO_PATTERN.search(question):
+            return INTENT_INFO, courses
+        return None, courses
+
+    def answer(self, question: str) -> Optional[str]:
+        """
+        能由結構化資料回答的問題回傳答案；其他（含自由提問）回傳 None 交給 RAG
+        """
+        kind, courses = self.intent(question)
+        if kind == INTENT_GRADUATION:
+            return self.answer_graduation() or None
+        if kind in (INTENT_PREREQ, INTENT_NEXT):
+            fn = self.answer_prerequisites if kind == INTENT_PREREQ else self.answer_next
+            text = "\n\n".join(fn(c) for c in courses)
+            if self.has_suggested(courses):
+                text += "\n\n" + SUGGESTED_NOTE
+            return text
+        if kind == INTENT_INFO:
+            asked = tuple(f for f, pattern in INFO_FIELDS if pattern.search(question))
+            parts = [self.answer_course(c, asked) for c in courses]
+            if not all(parts):
+                return None
+            return "\n\n".join(parts)
+        return None
+
+
+def load_course_graph(path: str) -> Optional[CourseGraph]:
+    fp = os.path.join(path, COURSE_GRAPH_FILE)
+    if not os.path.isfile(fp):
+        return None
+    try:
+        with open(fp, "r", encoding="utf-8") as f:
+            return CourseGraph(json.load(f))
+    except Exception as e:
+        print(f"Load course graph failed ({fp}): {e}")
+        return None
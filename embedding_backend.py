@@ -0,0 +1,132 @@
+"""
+Embedding 後端（build_faiss_db.py 與 app.py 共用；兩邊必須使用同一個後端，向量才相容）
+
+- EMBED_BACKEND=hf（預設）：sentence-transformers（需要 torch）
+- EMBED_BACKEND=onnx：以 onnxruntime 執行 export_onnx_model.py 匯出的同一個模型（預設用 int8 量化版），
+  不 import torch，啟動快、常駐記憶體小
+- embedding_id()：後端識別字串。建庫時寫進 manifest 的 config.model，app 載入時比對，不一致的資料庫不會載入；
+  embedding 快取也以它分資料夾，不同後端的向量不會混用
+- LazyEmbeddings：第一次 embed 時才建立底層模型，app 不必等模型載入完成就能開始服務
+"""
+import json
+import os
+import threading
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_BACKEND = os.environ.get("EMBED_BACKEND", "hf").strip().lower()
+# onnx 後端：模型資料夾（model.onnx / model_int8.onnx / tokenizer.json / onnx_config.json）
+EMBED_ONNX_DIR = os.environ.get(
+    "EMBED_ONNX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_model")
+)
+# 1 = 使用 int8 動態量化的 model_int8.onnx；0 = 使用 float32 的 model.onnx
+EMBED_ONNX_INT8 = os.environ.get("EMBED_ONNX_INT8", "1") == "1"
+# onnxruntime 的 intra-op thread 數（0 = onnxruntime 自行決定）
+EMBED_ONNX_THREADS = int(os.environ.get("EMBED_ONNX_THREADS", "0"))
+
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model_int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+ONNX_CONFIG_FILE = "onnx_config.json"
+BACKENDS = ("hf", "onnx")
+
+
+def embedding_id(model_name: str = EMBED_MODEL_NAME, backend: str = EMBED_BACKEND,
+                 int8: bool = EMBED_ONNX_INT8) -> str:
+    """
+    hf 後端沿用原本的模型名稱（既有資料庫與快取不必重建）；onnx 後端加上 @onnx / @onnx-int8
+    """
+    if backend == "onnx":
+        return f"{model_name}@onnx{'-int8' if int8 else ''}"
+    return model_name
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Transformer（ONNX）+ mean pooling + L2 normalize，與 sentence-transformers 的 all-MiniLM-L6-v2 相同
+    """
+
+    def __init__(self, model_dir: str, int8: bool = True, threads: int = 0, batch_size: int = 32):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        path = os.path.join(model_dir, ONNX_INT8_FILE if int8 else ONNX_FILE)
+        with open(os.path.join(model_dir, ONNX_CONFIG_FILE), "r", encoding="utf-8") as f:
+            cfg = json.load(f)
+        self.normalize = bool(cfg.get("normalize", True))
+        self.batch_size = batch_size
+
+        opts = ort.SessionOptions()
+        if threads > 0:
+            opts.intra_op_num_threads = threads
+        self._session = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+        self._inputs = {i.name for i in self._session.get_inputs()}
+
+        self._tok = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self._tok.enable_truncation(int(cfg.get("max_length", 256)))
+        pad = cfg.get("pad_token", "[PAD]")
+        self._tok.enable_padding(pad_id=self._tok.token_to_id(pad) or 0, pad_token=pad)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        out = []
+        for i in range(0, len(texts), self.batch_size):
+            enc = self._tok.encode_batch(texts[i:i + self.batch_size])
+            ids = np.asarray([e.ids for e in enc], dtype=np.int64)
+            mask = np.asarray([e.attention_mask for e in enc], dtype=np.int64)
+            feeds = {"input_ids": ids, "attention_mask": mask}
+            if "token_type_ids" in self._inputs:
+                feeds["token_type_ids"] = np.zeros_like(ids)
+            hidden = self._session.run(None, feeds)[0]
+            m = mask[..., None].astype(np.float32)
+            vec = (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                vec /= np.clip(np.linalg.norm(vec, axis=1, keepdims=True), 1e-12, None)
+            out.append(vec.astype(np.float32))
+        return np.vstack(out) if out else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+
+def create_embeddings(model_name: str = EMBED_MODEL_NAME, backend: str = EMBED_BACKEND) -> Embeddings:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown EMBED_BACKEND={backend!r} (expected one of {BACKENDS})")
+    if backend == "onnx":
+        return OnnxEmbeddings(EMBED_ONNX_DIR, int8=EMBED_ONNX_INT8, threads=EMBED_ONNX_THREADS)
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name)
+
+
+class LazyEmbeddings(Embeddings):
+    """
+    第一次使用時才呼叫 factory() 建立底層 embeddings（多個 thread 同時觸發也只建立一次）
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._base = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._base is not None
+
+    def get(self) -> Embeddings:
+        if self._base is None:
+            with self._lock:
+                if self._base is None:
+                    self._base = self._factory()
+        return self._base
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.get().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.get().embed_query(text)
@@ -0,0 +1,239 @@
+"""
+Content-addressed embedding cache（build_faiss_db.py 與 app.py 共用）
+
+- key：sha256(模型名稱 + chunk 文字)，同一段文字跨 tag、跨次建庫都只算一次
+- 向量：每個模型一個 np.memmap float32 矩陣（vectors.f32，固定 capacity 列）
+- 索引：SQLite（key → slot、最後使用時間），WAL 模式，多個 process 可同時讀寫
+- 超過 capacity 時淘汰最久沒用到的 slot（LRU）
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+DEFAULT_MAX_ENTRIES = 100_000
+_SQL_BATCH = 500
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str, model_name: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name))
+        os.makedirs(self.dir, exist_ok=True)
+
+        self._inherited = []
+        self._connect()
+        # serve.py pre-fork：sqlite 連線與 lock 不能跨 fork 沿用，子 process 重新連線
+        os.register_at_fork(after_in_child=self._after_fork)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, slot INTEGER UNIQUE NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_used)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT NOT NULL)")
+
+        # capacity 在第一次建立時固定（memmap 檔案大小取決於它），之後以 meta 內的值為準
+        self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('capacity', ?)", (str(max_entries),))
+        self.capacity = int(self._meta("capacity"))
+        dim = self._meta("dim")
+        self.dim: Optional[int] = int(dim) if dim else None
+
+        self._vectors: Optional[np.memmap] = None
+        self._tags: Optional[np.memmap] = None
+
+    # ---------------------------------------------------------------------
+    # internals
+    # ---------------------------------------------------------------------
+    def _connect(self):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(self.dir, "index.sqlite"),
+            timeout=30, check_same_thread=False, isolation_level=None,
+        )
+
+    def _after_fork(self):
+        # 父 process 的連線保留參照但不再使用：在子 process 關閉它可能釋放/刪除父 process 仍在用的 WAL 檔
+        self._inherited.append(self._conn)
+        self._connect()
+
+    def _meta(self, k: str) -> Optional[str]:
+        row = self._conn.execute("SELECT v FROM meta WHERE k = ?", (k,)).fetchone()
+        return row[0] if row else None
+
+    def _open(self, dim: Optional[int] = None) -> bool:
+        """
+        開啟（必要時建立）memmap 檔；dim 未知且尚未有任何向量時回傳 False
+        """
+        if self._vectors is not None:
+            return True
+        if self.dim is None:
+            if dim is None:
+                return False
+            self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('dim', ?)", (str(dim),))
+            self.dim = int(self._meta("dim"))
+
+        vec_path = os.path.join(self.dir, "vectors.f32")
+        tag_path = os.path.join(self.dir, "tags.u64")
+        for path, dtype, shape in ((vec_path, np.float32, (self.capacity, self.dim)),
+                                   (tag_path, np.uint64, (self.capacity,))):
+            if not os.path.exists(path):
+                # sparse file：只有寫到的 slot 會真正佔用磁碟
+                with open(path, "wb") as f:
+                    f.truncate(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self._vectors = np.memmap(vec_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+        self._tags = np.memmap(tag_path, dtype=np.uint64, mode="r+", shape=(self.capacity,))
+        return True
+
+    def key(self, text: str, namespace: str = "doc") -> str:
+        return hashlib.sha256(f"{self.model_name}\0{namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _tag(key: str) -> np.uint64:
+        # slot 內另存 key 的前 8 bytes：其他 process 剛好淘汰並覆寫同一個 slot 時，讀取端能發現並視為 miss
+        return np.uint64(int(key[:16], 16) or 1)
+
+    # ---------------------------------------------------------------------
+    # public API
+    # ---------------------------------------------------------------------
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        out: List[Optional[np.ndarray]] = [None] * len(keys)
+        if not keys:
+            return out
+        with self._lock:
+            if not self._open():
+                return out
+            slots = {}
+            for i in range(0, len(keys), _SQL_BATCH):
+                part = keys[i:i + _SQL_BATCH]
+                q = "SELECT key, slot FROM entries WHERE key IN (%s)" % ",".join("?" * len(part))
+                slots.update(self._conn.execute(q, part).fetchall())
+
+            hits = []
+            for i, k in enumerate(keys):
+                slot = slots.get(k)
+                if slot is None:
+                    continue
+                tag = self._tag(k)
+                if self._tags[slot] != tag:
+                    continue
+                vec = np.array(self._vectors[slot])
+                if self._tags[slot] != tag:
+                    continue
+                out[i] = vec
+                hits.append(k)
+
+            if hits:
+                now = time.time()
+                self._conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, k) for k in hits])
+        return out
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        if not keys:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # 只保留最後 capacity 筆（一次寫入超過容量時）
+        keys, vectors = keys[-self.capacity:], vectors[-self.capacity:]
+
+        with self._lock:
+            self._open(dim=vectors.shape[1])
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dim {vectors.shape[1]} != cache dim {self.dim} ({self.dir})")
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                existing = set()
+                for i in range(0, len(keys), _SQL_BATCH):
+                    part = keys[i:i + _SQL_BATCH]
+                    q = "SELECT key FROM entries WHERE key IN (%s)" % ",".join("?" * len(part))
+                    existing.update(r[0] for r in self._conn.execute(q, part))
+                todo = {}
+                for k, v in zip(keys, vectors):
+                    if k not in existing:
+                        todo[k] = v
+                if not todo:
+                    self._conn.execute("COMMIT")
+                    return
+
+                # 配置 slot：先用空的，不夠再淘汰最久沒用到的
+                used = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                free = list(range(used, min(self.capacity, used + len(todo))))
+                need = len(todo) - len(free)
+                if need > 0:
+                    victims = self._conn.execute(
+                        "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (need,)
+                    ).fetchall()
+                    self._conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k, _ in victims])
+                    free.extend(slot for _, slot in victims)
+
+                now = time.time()
+                rows = []
+                for (k, v), slot in zip(todo.items(), free):
+                    self._tags[slot] = 0
+                    self._vectors[slot] = v
+                    self._tags[slot] = self._tag(k)
+                    rows.append((k, slot, now))
+                self._vectors.flush()
+                self._tags.flush()
+                self._conn.executemany("INSERT INTO entries VALUES (?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    包一層 LangChain Embeddings：先查 EmbeddingCache，只有 miss 的文字才交給底層模型計算
+    """
+
+    def __init__(self, base: Embeddings, cache: EmbeddingCache):
+        self.base = base
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.cache.key(t) for t in texts]
+        cached = self.cache.get_many(keys)
+
+        # 同一批內重複的文字也只算一次
+        miss = {}
+        for k, t, v in zip(keys, texts, cached):
+            if v is None and k not in miss:
+                miss[k] = t
+        if miss:
+            miss_keys = list(miss)
+            vecs = np.asarray(self.base.embed_documents([miss[k] for k in miss_keys]), dtype=np.float32)
+            self.cache.put_many(miss_keys, vecs)
+            computed = dict(zip(miss_keys, vecs))
+            cached = [v if v is not None else computed[k] for k, v in zip(keys, cached)]
+        return [v.tolist() for v in cached]
+
+    def embed_query(self, text: str) -> List[float]:
+        # query 與 document 分開 namespace（部分模型兩者的編碼方式不同）
+        key = self.cache.key(text, namespace="query")
+        v = self.cache.get_many([key])[0]
+        if v is None:
+            v = np.asarray(self.base.embed_query(text), dtype=np.float32)
+            self.cache.put_many([key], v[None, :])
+        return v.tolist()
+
+
+def with_embedding_cache(base: Embeddings, model_name: str, cache_dir: Optional[str],
+                         max_entries: int = DEFAULT_MAX_ENTRIES) -> Embeddings:
+    """
+    cache_dir 為空時直接回傳原本的 embeddings（關閉快取）
+    """
+    if not cache_dir:
+        return base
+    try:
+        return CachedEmbeddings(base, EmbeddingCache(cache_dir, model_name, max_entries=max_entries))
+    except Exception as e:
+        print(f"Embedding cache disabled ({cache_dir}): {e}")
+        return base
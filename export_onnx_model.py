@@ -0,0 +1,82 @@
+"""
+把 sentence-transformers 模型匯出成 ONNX（EMBED_BACKEND=onnx 用），並做 int8 動態量化
+
+- 只在匯出時需要 torch / sentence-transformers / onnx；服務端只需要 onnxruntime 與 tokenizers
+- 輸出到 EMBED_ONNX_DIR：model.onnx、model_int8.onnx、tokenizer.json、onnx_config.json
+- 匯出後以幾個句子比對 sentence-transformers 與 ONNX 的向量（cosine），確認兩者一致
+
+換後端後資料庫要重建（python build_faiss_db.py；manifest 的 config.model 不同會自動全量重建）。
+"""
+import json
+import os
+
+import numpy as np
+
+from embedding_backend import (
+    EMBED_MODEL_NAME, EMBED_ONNX_DIR, ONNX_CONFIG_FILE, ONNX_FILE, ONNX_INT8_FILE, TOKENIZER_FILE,
+    OnnxEmbeddings,
+)
+
+
+SAMPLE_TEXTS = [
+    "獎學金申請資格與截止日期",
+    "資料結構的先修課程是什麼？",
+    "Deep learning lab recruiting graduate students",
+    "畢業學分需修滿 128 學分，其中專業必修 60 學分。",
+]
+MIN_COSINE = 0.98
+
+
+def export(out_dir: str = EMBED_ONNX_DIR, model_name: str = EMBED_MODEL_NAME):
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(out_dir, exist_ok=True)
+    st = SentenceTransformer(model_name, device="cpu")
+    transformer = st[0].auto_model.eval()
+    tokenizer = st.tokenizer
+
+    # 只匯出 transformer 本體；pooling 與 normalize 在 OnnxEmbeddings 以 numpy 計算
+    enc = tokenizer(["範例輸入"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in enc]
+    dynamic = {n: {0: "batch", 1: "seq"} for n in input_names}
+    dynamic["last_hidden_state"] = {0: "batch", 1: "seq"}
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer, tuple(enc[n] for n in input_names), os.path.join(out_dir, ONNX_FILE),
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic, opset_version=17,
+        )
+    quantize_dynamic(os.path.join(out_dir, ONNX_FILE), os.path.join(out_dir, ONNX_INT8_FILE),
+                     weight_type=QuantType.QInt8)
+
+    tokenizer.backend_tokenizer.save(os.path.join(out_dir, TOKENIZER_FILE))
+    normalize = any(type(m).__name__ == "Normalize" for m in st)
+    with open(os.path.join(out_dir, ONNX_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "model": model_name,
+            "max_length": int(st.max_seq_length),
+            "pad_token": tokenizer.pad_token,
+            "pooling": "mean",
+            "normalize": normalize,
+        }, f, ensure_ascii=False, indent=2)
+
+    # 確認 ONNX（float32 / int8）與 sentence-transformers 的輸出一致
+    ref = st.encode(SAMPLE_TEXTS, normalize_embeddings=True)
+    ok = True
+    for int8 in (False, True):
+        vecs = np.asarray(OnnxEmbeddings(out_dir, int8=int8).embed_documents(SAMPLE_TEXTS))
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+        cos = float((vecs * ref).sum(axis=1).min())
+        name = ONNX_INT8_FILE if int8 else ONNX_FILE
+        size = os.path.getsize(os.path.join(out_dir, name)) / 1e6
+        print(f"{'✅' if cos >= MIN_COSINE else '❌'} {name}: {size:.1f} MB, min cosine vs sentence-transformers = {cos:.4f}")
+        ok = ok and cos >= MIN_COSINE
+    if not ok:
+        print("⚠️ ONNX output differs from sentence-transformers; check the export before using EMBED_BACKEND=onnx")
+    print(f"Exported to {out_dir}")
+
+
+if __name__ == "__main__":
+    export()
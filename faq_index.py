@@ -0,0 +1,328 @@
+"""
+FAQ 預先回答（build_faiss_db.py 建庫時產生、app.py 載入）
+
+- 建庫時對每個檔案產生幾個學生可能會問的問題（FAQ_GENERATOR=groq 用 LLM；local 用標題與「欄位：內容」行組問題，
+  測試與離線建庫用），再走與線上相同的流程回答：hybrid 檢索 → assemble_messages → 生成
+- 回答要通過檢查才會上線：有檢索到出題的那個檔案、不是「沒有相關資訊」、回答的字元 bigram 大多出現在參考資料中
+- 檔案：faq.json（全部問答與檢查結果，可人工把 approved 改成 true/false）、faq.npz（有回答的問題 embedding），
+  與 index.faiss 放在同一個資料夾
+- 增量：問題與檢索到的來源檔案都沒變時沿用上一版的回答（含人工修改），不重新呼叫 LLM
+- app.py 收到問題時先比對 FAQ：cosine >= 門檻就直接回覆預先產生的答案
+"""
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from prompt_builder import (
+    GROQ_MODEL, RAG_SYSTEM_PROMPT, assemble_messages, char_bigrams, extractive_answer, normalize_question, rag_user_prompt,
+)
+from retrieval import hybrid_search
+from text_chunker import TITLE_FIELDS
+
+
+FAQ_FILE = "faq.json"
+FAQ_VECTORS_FILE = "faq.npz"
+NO_INFO_MARK = "沒有相關資訊"
+
+_TAG_LINE = re.compile(r"^\s*類型\s*[:：]")
+_FIELD_LINE = re.compile(r"^\s*[-•*・]?\s*([^\s:：]{2,12})\s*[:：]\s*(\S.*)$")
+_LIST_PREFIX = re.compile(r"^\s*(?:[-•*・]|\d+[.、)）]|Q\d*[:：])\s*")
+
+
+def has_faq_index(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, FAQ_FILE)) and os.path.isfile(os.path.join(path, FAQ_VECTORS_FILE))
+
+
+# =============================================================================
+# 出題 / 回答
+# =============================================================================
+def document_title(text: str) -> str:
+    """
+    標題：優先取「標題／名稱／實驗室／姓名／主題：…」欄位的內容，否則取第一個非空、非「類型：」的行
+    """
+    first = ""
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line or _TAG_LINE.match(line):
+            continue
+        m = _FIELD_LINE.match(line)
+        if m and m.group(1) in TITLE_FIELDS:
+            return m.group(2).strip()[:60]
+        first = first or line[:60]
+    return first
+
+
+class LocalFaqGenerator:
+    """
+    不呼叫 LLM 的替代品：標題與「欄位：內容」行組成問題，以 extractive_answer 從檢索片段摘錄回答
+    """
+    name = "local"
+
+    def questions(self, title: str, text: str, n: int) -> List[str]:
+        if not title:
+            return []
+        out = [f"{title}是什麼？"]
+        for line in text.splitlines():
+            m = _FIELD_LINE.match(line)
+            if m and not _TAG_LINE.match(line) and m.group(1) not in TITLE_FIELDS:
+                out.append(f"{title}的{m.group(1)}是什麼？")
+        return list(dict.fromkeys(out))[:n]
+
+    def answer(self, messages: List[Dict[str, str]], question: str, docs: List[Document]) -> str:
+        return extractive_answer(question, docs)
+
+
+class GroqFaqGenerator:
+    """
+    以 Groq LLM 出題與回答（回答使用與 app.py 相同的 system prompt 與 prompt 組裝）
+    """
+    name = "groq"
+
+    def __init__(self, api_key: str, model: str, temperature: float = 0.3):
+        from groq import Groq
+        self.client = Groq(api_key=api_key)
+        self.model = model
+        self.temperature = temperature
+
+    def _chat(self, messages: List[Dict[str, str]], temperature: float) -> str:
+        r = self.client.chat.completions.create(model=self.model, messages=messages, temperature=temperature)
+        return (r.choices[0].message.content or "").strip()
+
+    def questions(self, title: str, text: str, n: int) -> List[str]:
+        prompt = (
+            f"以下是系所資料庫中的一份文件。請列出 {n} 個學生最可能針對這份文件提出、且能由文件內容直接回答的問題。\n"
+            f"每行一個問題，使用繁體中文，不要編號、不要回答。\n\n"
+            f"【文件標題】：{title}\n【文件內容】：\n{text}"
+        )
+        reply = self._chat([{"role": "user", "content": prompt}], temperature=0.5)
+        out = []
+        for line in reply.splitlines():
+            q = _LIST_PREFIX.sub("", line).strip()
+            if len(q) >= 4:
+                out.append(q)
+        return list(dict.fromkeys(out))[:n]
+
+    def answer(self, messages: List[Dict[str, str]], question: str, docs: List[Document]) -> str:
+        return self._chat(messages, temperature=self.temperature)
+
+
+def create_faq_generator(name: str):
+    """
+    name："groq" | "local"；其他值（含空字串）回傳 None（不產生 FAQ）
+    """
+    name = (name or "").strip().lower()
+    if name == "local":
+        return LocalFaqGenerator()
+    if name == "groq":
+        api_key = os.environ.get("GROQ_API_KEY")
+        if not api_key:
+            raise RuntimeError("FAQ_GENERATOR=groq needs GROQ_API_KEY")
+        return GroqFaqGenerator(api_key, GROQ_MODEL)
+    return None
+
+
+# =============================================================================
+# 建庫
+# =============================================================================
+def grounding(answer: str, context: str) -> float:
+    """
+    回答的字元 bigram 有多少比例出現在參考資料中（條列符號與 URL 以外的文字）
+    """
+    a = char_bigrams(re.sub(r"https?://\S+|[•\-*・#]", "", answer or ""))
+    if not a:
+        return 0.0
+    return len(a & char_bigrams(context)) / len(a)
+
+
+def _file_texts(vs) -> Dict[str, str]:
+    """
+    docstore 內的 chunk 依 source_file 分組、依 start_index 排序後接起來
+    """
+    groups: Dict[str, List[Tuple[int, str]]] = {}
+    for faiss_id in sorted(vs.index_to_docstore_id):
+        doc = vs.docstore.search(vs.index_to_docstore_id[faiss_id])
+        if not isinstance(doc, Document):
+            continue
+        meta = doc.metadata or {}
+        src = meta.get("source_file")
+        if src:
+            groups.setdefault(src, []).append((meta.get("start_index") or 0, doc.page_content or ""))
+    return {src: "\n".join(t for _, t in sorted(parts)) for src, parts in groups.items()}
+
+
+def _context_key(question: str, docs: List[Document], hashes: Dict[str, str]) -> str:
+    srcs = sorted({(d.metadata or {}).get("source_file", "") for d in docs})
+    raw = json.dumps([question, [(s, hashes.get(s, "")) for s in srcs]], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def load_faq_json(path: str) -> Dict:
+    try:
+        with open(os.path.join(path, FAQ_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_faq(out_dir: str, vs, lexical, emb, generator, hashes: Dict[str, str], mode_label: str,
+              questions_per_doc: int = 5, curated: Optional[List[str]] = None,
+              k: int = 3, fetch_k: int = 10, min_relevance: float = 0.3, min_coverage: float = 0.5,
+              min_grounding: float = 0.5, budget: int = 3000) -> Dict:
+    """
+    產生並檢查 FAQ，寫出 faq.json / faq.npz（先寫暫存檔再 os.replace）
+    hashes：{檔名: sha256}（判斷出題的檔案與回答的來源是否有變）；curated：人工指定的問題（不綁定檔案）
+    回傳統計 {"questions", "approved", "reused", "generated", "dropped_ambiguous"}
+    """
+    prev = load_faq_json(out_dir)
+    same_generator = prev.get("generator") == generator.name
+    prev_by_origin: Dict[str, List[Dict]] = {}
+    prev_by_key: Dict[str, Dict] = {}
+    for e in prev.get("entries", []):
+        prev_by_origin.setdefault(e.get("origin") or "", []).append(e)
+        if same_generator:
+            prev_by_key[e.get("context_key", "")] = e
+
+    # 出題：檔案內容沒變就沿用上一版的問題
+    candidates: Dict[str, Tuple[str, Optional[str]]] = {}  # { 正規化問題: (問題, 出題的檔案) }
+    ambiguous = set()
+    texts = _file_texts(vs)
+    for src in sorted(texts):
+        old = prev.get("files", {}).get(src)
+        if same_generator and old and old == hashes.get(src):
+            questions = [e["question"] for e in prev_by_origin.get(src, [])]
+        else:
+            text = texts[src]
+            try:
+                questions = generator.questions(document_title(text), text[:3000], questions_per_doc)
+            except Exception as e:
+                print(f"⚠️ FAQ question generation failed ({src}): {e}")
+                questions = []
+        for q in questions:
+            key = normalize_question(q)
+            if key in candidates and candidates[key][1] != src:
+                ambiguous.add(key)  # 不同檔案出了同一題：答案取決於哪份文件，不預先回答
+            candidates.setdefault(key, (q, src))
+    for q in curated or []:
+        candidates.setdefault(normalize_question(q), (q, None))
+    for key in ambiguous:
+        del candidates[key]
+
+    entries, vec_rows, reused = [], [], 0
+    keys = list(candidates)
+    vecs = emb.embed_documents(keys) if keys else []
+    for key, vec in zip(keys, vecs):
+        question, origin = candidates[key]
+        hits = hybrid_search(vs, lexical, vec, question, k=k, fetch_k=fetch_k,
+                             min_relevance=min_relevance, min_coverage=min_coverage)
+        docs = [d for d, _ in hits]
+        ctx_key = _context_key(key, docs, hashes)
+        old = prev_by_key.get(ctx_key)
+        if old is not None:
+            entry = dict(old, origin=origin)
+            reused += 1
+        else:
+            entry = {"question": question, "origin": origin, "context_key": ctx_key,
+                     "sources": sorted({(d.metadata or {}).get("source_file", "") for d in docs})}
+            entry.update(_answer_and_vet(generator, question, docs, origin, mode_label, min_grounding, budget))
+        entries.append(entry)
+        # 有回答的項目都存 embedding：人工把 approved 改成 true 後不必重建就能上線
+        if entry.get("answer"):
+            vec_rows.append((len(entries) - 1, vec))
+
+    files = {src: hashes.get(src) for src in texts}
+    write_faq_index(out_dir, generator.name, files, entries, vec_rows)
+    return {"questions": len(entries), "approved": sum(1 for e in entries if e.get("approved")), "reused": reused,
+            "generated": len(entries) - reused, "dropped_ambiguous": len(ambiguous)}
+
+
+def _answer_and_vet(generator, question: str, docs: List[Document], origin: Optional[str], mode_label: str,
+                    min_grounding: float, budget: int) -> Dict:
+    if not docs:
+        return {"answer": "", "approved": False, "reason": "no_docs"}
+    if origin and origin not in {(d.metadata or {}).get("source_file") for d in docs}:
+        # 線上檢索找不到出題的那份文件：預先回答與即時回答會不一致
+        return {"answer": "", "approved": False, "reason": "origin_not_retrieved"}
+
+    messages, _ = assemble_messages(
+        RAG_SYSTEM_PROMPT, [], docs, lambda ctx: rag_user_prompt(mode_label, ctx, question), budget=budget,
+    )
+    try:
+        answer = (generator.answer(messages, question, docs) or "").strip()
+    except Exception as e:
+        print(f"⚠️ FAQ answer failed ({question}): {e}")
+        return {"answer": "", "approved": False, "reason": "error"}
+
+    score = grounding(answer, "\n".join(d.page_content or "" for d in docs))
+    if not answer:
+        reason = "empty"
+    elif NO_INFO_MARK in answer:
+        reason = "no_info"
+    elif score < min_grounding:
+        reason = "ungrounded"
+    else:
+        reason = ""
+    return {"answer": answer, "grounding": round(score, 3), "approved": not reason, "reason": reason}
+
+
+def write_faq_index(out_dir: str, generator: str, files: Dict[str, str], entries: List[Dict],
+                    vec_rows: List[Tuple[int, List[float]]]):
+    dim = len(vec_rows[0][1]) if vec_rows else 0
+    vectors = np.asarray([v for _, v in vec_rows], dtype=np.float32).reshape(len(vec_rows), dim)
+    if len(vectors):
+        vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+    path = os.path.join(out_dir, FAQ_VECTORS_FILE)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, vectors=vectors, rows=np.asarray([i for i, _ in vec_rows], dtype=np.int64))
+    os.replace(path + ".tmp", path)
+
+    path = os.path.join(out_dir, FAQ_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"generator": generator, "files": files, "entries": entries}, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+# =============================================================================
+# 服務
+# =============================================================================
+class FaqIndex:
+    def __init__(self, entries: List[Dict], vectors: np.ndarray, rows: np.ndarray):
+        self.entries = entries
+        self.vectors = vectors
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def match(self, query_vec, threshold: float = 0.9) -> Optional[Dict]:
+        """
+        回傳 cosine 最高且 >= threshold 的 FAQ 項目（含 question / answer / score），沒有則 None
+        """
+        if not len(self.rows):
+            return None
+        q = np.asarray(query_vec, dtype=np.float32)
+        q = q / max(float(np.linalg.norm(q)), 1e-12)
+        scores = self.vectors @ q
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        return dict(self.entries[int(self.rows[best])], score=float(scores[best]))
+
+
+def load_faq_index(path: str) -> Optional[FaqIndex]:
+    """
+    舊版資料夾沒有 FAQ 時回傳 None；只有 faq.json 內 approved=true 的項目會命中
+    """
+    if not has_faq_index(path):
+        return None
+    data = load_faq_json(path)
+    entries = data.get("entries", [])
+    with np.load(os.path.join(path, FAQ_VECTORS_FILE)) as z:
+        vectors, rows = z["vectors"].astype(np.float32), z["rows"]
+    keep = [i for i, r in enumerate(rows) if r < len(entries) and entries[r].get("approved")]
+    return FaqIndex(entries, vectors[keep], rows[keep])
@@ -0,0 +1,131 @@
+"""
+中文字元 bigram 的 BM25 倒排索引（build_faiss_db.py 寫出、app.py 載入）
+
+- 斷詞：NFKC + 小寫；連續的中日韓漢字切成字元 bigram（單一個字則保留 unigram），英數字串整段當一個 token
+  → 課名、教師姓名、公文字號等精確詞彙即使 embedding 模型不懂中文也找得到
+- 檔案：lexical.npz（詞彙表、postings、各 chunk 長度與 faiss id），與 index.faiss 放在同一個資料夾
+- 查詢回傳 faiss id，與向量檢索的結果以 reciprocal-rank fusion 合併（見 retrieval.py）
+"""
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+LEXICAL_FILE = "lexical.npz"
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]+|[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    out = []
+    for m in _TOKEN_RE.finditer(t):
+        s = m.group()
+        if s[0].isascii() or len(s) == 1:
+            out.append(s)
+        else:
+            out.extend(s[i:i + 2] for i in range(len(s) - 1))
+    return out
+
+
+def has_lexical_index(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, LEXICAL_FILE))
+
+
+def write_lexical_index(out_dir: str, vs):
+    """
+    以向量庫 docstore 內的全部 chunk 重建 BM25 索引（先寫暫存檔再 os.replace）
+    """
+    doc_ids, doc_len = [], []
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    for faiss_id in sorted(vs.index_to_docstore_id):
+        doc = vs.docstore.search(vs.index_to_docstore_id[faiss_id])
+        if not isinstance(doc, Document):
+            continue
+        tokens = tokenize(doc.page_content)
+        row = len(doc_ids)
+        doc_ids.append(int(faiss_id))
+        doc_len.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term, []).append((row, tf))
+
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    for i, term in enumerate(terms):
+        offsets[i + 1] = offsets[i] + len(postings[term])
+    flat = [p for term in terms for p in postings[term]]
+    post = np.asarray(flat, dtype=np.int32).reshape(-1, 2)
+
+    path = os.path.join(out_dir, LEXICAL_FILE)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            terms=np.asarray(terms, dtype=str),
+            offsets=offsets,
+            post_docs=post[:, 0],
+            post_tf=post[:, 1].astype(np.float32),
+            doc_ids=np.asarray(doc_ids, dtype=np.int64),
+            doc_len=np.asarray(doc_len, dtype=np.float32),
+        )
+    os.replace(path + ".tmp", path)
+
+
+class LexicalIndex:
+    def __init__(self, path: str):
+        with np.load(os.path.join(path, LEXICAL_FILE), allow_pickle=False) as z:
+            terms = z["terms"]
+            self._offsets = z["offsets"]
+            self._post_docs = z["post_docs"]
+            self._post_tf = z["post_tf"]
+            self.doc_ids = z["doc_ids"]
+            doc_len = z["doc_len"]
+        self._vocab = {str(t): i for i, t in enumerate(terms)}
+        self.n_docs = len(self.doc_ids)
+        avgdl = float(doc_len.mean()) if self.n_docs else 1.0
+        # BM25 分母中只和文件長度有關的部分，事先算好
+        self._norm = (BM25_K1 * (1 - BM25_B + BM25_B * doc_len / max(avgdl, 1e-6))).astype(np.float32)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[int, float, float]]:
+        """
+        回傳 [(faiss_id, bm25 分數, coverage), ...]；coverage = 命中的查詢 token 種類比例
+        """
+        q_terms = set(tokenize(query))
+        if not q_terms or not self.n_docs:
+            return []
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        matched = np.zeros(self.n_docs, dtype=np.int32)
+        for term in q_terms:
+            ti = self._vocab.get(term)
+            if ti is None:
+                continue
+            a, b = int(self._offsets[ti]), int(self._offsets[ti + 1])
+            docs, tf = self._post_docs[a:b], self._post_tf[a:b]
+            idf = math.log(1 + (self.n_docs - (b - a) + 0.5) / ((b - a) + 0.5))
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + self._norm[docs])
+            matched[docs] += 1
+
+        hit = np.flatnonzero(matched)
+        if not len(hit):
+            return []
+        if len(hit) > k:
+            hit = hit[np.argpartition(-scores[hit], k - 1)[:k]]
+        hit = hit[np.argsort(-scores[hit], kind="stable")]
+        return [(int(self.doc_ids[i]), float(scores[i]), float(matched[i]) / len(q_terms)) for i in hit]
+
+
+def load_lexical_index(path: str) -> Optional[LexicalIndex]:
+    if not has_lexical_index(path):
+        return None
+    try:
+        return LexicalIndex(path)
+    except Exception as e:
+        print(f"Load lexical index failed ({path}): {e}")
+        return None
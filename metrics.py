@@ -0,0 +1,237 @@
+"""
+輕量 Prometheus 指標（app.py 用；不額外依賴 prometheus_client）
+
+- Counter / Histogram / Gauge，支援 label；REGISTRY.render() 輸出 Prometheus text format（/metrics）
+- Trace：一次請求的各階段耗時。stage() 同時寫入 stage 直方圖；結束時依抽樣率印出一行 JSON 方便追查單一慢請求
+- 目前的 Trace 放在 thread-local，深層函式（例如 send_reply）不必層層傳參數也能記錄階段
+"""
+import json
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Tuple
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labelnames: Iterable[str] = (), registry=None):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """
+    set() 設定值；或以 callback 在輸出時才計算（回傳 {label tuple: 值}）
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labelnames: Iterable[str] = (), registry=None, callback=None):
+        super().__init__(name, doc, labelnames, registry)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._callback = callback
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def _samples(self):
+        if self._callback is not None:
+            try:
+                items = sorted(self._callback().items())
+            except Exception as e:
+                print(f"metrics gauge {self.name} error: {e}")
+                items = []
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labelnames, tuple(k))} {_fmt_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Iterable[str] = (), registry=None,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        out = []
+        for key, row in items:
+            cum = 0
+            for b, n in zip(self.buckets, row):
+                cum += n
+                le = 'le="%s"' % _fmt_value(b)
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {cum}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(row[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {row[-1]}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# =============================================================================
+# Per-request trace
+# =============================================================================
+_local = threading.local()
+
+
+class Trace:
+    def __init__(self, name: str, stage_histogram: Histogram, sample_rate: float = 0.0, **fields):
+        self.name = name
+        self.fields = dict(fields)
+        self.stages = []
+        self._hist = stage_histogram
+        self._sampled = sample_rate > 0 and random.random() < sample_rate
+        self._t0 = time.perf_counter()
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def record(self, stage: str, seconds: float, mode: Optional[str] = None):
+        self.stages.append((stage, round(seconds * 1000, 2)))
+        self._hist.observe(seconds, stage=stage, mode=mode if mode is not None else self.fields.get("mode", ""))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._t0
+
+    def finish(self):
+        if self._sampled:
+            print("TRACE " + json.dumps({
+                "name": self.name, "ms": round(self.elapsed() * 1000, 2),
+                "stages": self.stages, **self.fields,
+            }, ensure_ascii=False, default=str))
+
+
+def current_trace() -> Optional[Trace]:
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def start_trace(name: str, stage_histogram: Histogram, sample_rate: float = 0.0, **fields):
+    trace = Trace(name, stage_histogram, sample_rate, **fields)
+    prev = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = prev
+        trace.finish()
+
+
+def observe(name: str, stage_histogram: Histogram, seconds: float, mode: Optional[str] = None,
+            trace: Optional[Trace] = None):
+    """
+    記錄一個階段的耗時：有 Trace 就記在 Trace（順便寫入直方圖），沒有就直接寫入直方圖。
+    mode 未指定時使用 Trace 的 mode；背景 thread 可傳入建立時保存的 trace
+    """
+    trace = trace if trace is not None else current_trace()
+    if trace is not None:
+        trace.record(name, seconds, mode)
+    else:
+        stage_histogram.observe(seconds, stage=name, mode=mode or "")
+
+
+@contextmanager
+def stage(name: str, stage_histogram: Histogram, mode: Optional[str] = None):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, stage_histogram, time.perf_counter() - t0, mode)
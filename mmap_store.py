@@ -0,0 +1,130 @@
+"""
+可 memory-map 的向量庫格式（build_faiss_db.py 寫出、app.py 載入）
+
+- index.faiss：以 FAISS mmap IO flag 讀取，向量留在 page cache，不複製進 heap
+- docstore.bin：每個 chunk 一筆 UTF-8 JSON（page_content + metadata），直接串接
+- docstore_ids.npy：int64 陣列 [[faiss_id, offset, length], ...]，依 faiss_id 排序，np.load(mmap_mode="r")
+
+啟動時不必 unpickle 整個 InMemoryDocstore，只有被檢索到的 chunk 才會被解碼。
+"""
+import json
+import mmap
+import os
+from collections.abc import Mapping
+from typing import Iterator, Union
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+
+INDEX_FILE = "index.faiss"
+DOCSTORE_DATA_FILE = "docstore.bin"
+DOCSTORE_IDS_FILE = "docstore_ids.npy"
+
+
+def has_mmap_docstore(path: str) -> bool:
+    return all(os.path.isfile(os.path.join(path, fn)) for fn in (INDEX_FILE, DOCSTORE_DATA_FILE, DOCSTORE_IDS_FILE))
+
+
+def write_mmap_docstore(out_dir: str, vs: FAISS):
+    """
+    把 FAISS 向量庫的 docstore 轉成 docstore.bin + docstore_ids.npy
+    （先寫暫存檔再 os.replace，正在 mmap 舊檔的 process 不受影響）
+    """
+    rows = []
+    data_path = os.path.join(out_dir, DOCSTORE_DATA_FILE)
+    ids_path = os.path.join(out_dir, DOCSTORE_IDS_FILE)
+    with open(data_path + ".tmp", "wb") as f:
+        offset = 0
+        for faiss_id in sorted(vs.index_to_docstore_id):
+            doc = vs.docstore.search(vs.index_to_docstore_id[faiss_id])
+            if not isinstance(doc, Document):
+                continue
+            blob = json.dumps(
+                {"page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False
+            ).encode("utf-8")
+            f.write(blob)
+            rows.append((int(faiss_id), offset, len(blob)))
+            offset += len(blob)
+    with open(ids_path + ".tmp", "wb") as f:
+        np.save(f, np.asarray(rows, dtype=np.int64).reshape(-1, 3))
+    os.replace(data_path + ".tmp", data_path)
+    os.replace(ids_path + ".tmp", ids_path)
+
+
+class MmapDocstore(Docstore):
+    """
+    唯讀 docstore：以 faiss id 二分搜尋 offset，再從 mmap 的 docstore.bin 解碼單筆 Document
+    """
+
+    def __init__(self, path: str):
+        self._rows = np.load(os.path.join(path, DOCSTORE_IDS_FILE), mmap_mode="r")
+        self._ids = self._rows[:, 0]
+        self._file = open(os.path.join(path, DOCSTORE_DATA_FILE), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def ids(self) -> Iterator[int]:
+        return (int(i) for i in self._ids)
+
+    def search(self, search: Union[str, int]) -> Union[str, Document]:
+        try:
+            key = int(search)
+        except (TypeError, ValueError):
+            return f"ID {search} not found."
+        pos = int(np.searchsorted(self._ids, key))
+        if pos >= len(self._ids) or int(self._ids[pos]) != key:
+            return f"ID {search} not found."
+        _, offset, length = (int(x) for x in self._rows[pos])
+        rec = json.loads(self._data[offset:offset + length].decode("utf-8"))
+        return Document(page_content=rec["page_content"], metadata=rec.get("metadata") or {})
+
+
+class FaissIdMap(Mapping):
+    """
+    index_to_docstore_id 的替代品：MmapDocstore 直接以 faiss id 當 key，不必在記憶體中放一整個 dict
+    """
+
+    def __init__(self, docstore: MmapDocstore):
+        self._docstore = docstore
+
+    def __getitem__(self, key):
+        return int(key)
+
+    def __len__(self) -> int:
+        return len(self._docstore)
+
+    def __iter__(self):
+        return self._docstore.ids()
+
+
+def read_index_mmap(path: str):
+    """
+    以 mmap 讀取 FAISS index；目前 faiss 版本不支援時退回一般讀取
+    """
+    for name in ("IO_FLAG_MMAP_IFC", "IO_FLAG_MMAP"):
+        flag = getattr(faiss, name, None)
+        if flag is None:
+            continue
+        try:
+            return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+        except Exception:
+            continue
+    return faiss.read_index(path)
+
+
+def load_mmap_vectorstore(path: str, embeddings) -> FAISS:
+    docstore = MmapDocstore(path)
+    index = read_index_mmap(os.path.join(path, INDEX_FILE))
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=FaissIdMap(docstore),
+    )
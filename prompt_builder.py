@@ -0,0 +1,313 @@
+"""
+RAG prompt 組裝（app.py 用）：在 token 預算內放入參考資料與對話記憶
+
+- 同一個 source_file 的片段若彼此重疊（建庫 chunk_overlap）或相鄰，合併成一段；被包含的片段直接丟掉
+  （以建庫時記錄的 start_index 判斷；舊資料庫沒有則比對文字重疊）
+- 各段之間重複出現的行（例如每個檔案開頭的「類型：…」標頭）只保留第一次
+- 預算不足時先犧牲舊的對話：較舊的回合先縮成摘要（截斷），再整輪丟棄；最後才截斷排名較後的參考資料
+- token 數以字元估算（中日韓漢字約 1 token、其他約 4 字元 1 token），不需要載入 tokenizer
+- RAG 的系統提示、使用者訊息格式、LLM 模型與不經 LLM 的抽取式回答也放在這裡，app.py 與建庫時的 FAQ 預先回答共用
+"""
+import math
+import os
+import re
+import unicodedata
+from typing import Callable, Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+from text_chunker import parse_header
+
+
+MIN_MERGE_OVERLAP = 20
+MAX_MERGE_OVERLAP = 400
+MAX_MERGE_GAP = 4
+MIN_DEDUPE_LINE = 8
+
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿　-〿＀-￯]")
+
+# 線上回答與 FAQ 預先回答使用同一個模型（FAQ 的品質才會與線上一致）
+GROQ_MODEL = os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile")
+
+RAG_SYSTEM_PROMPT = """
+你是一個專業的「GuidES 系所資訊助理」。
+請依據下方【參考資料】回答學生問題，並遵守下列規則：
+
+【內容規則】
+1) 只能根據參考資料回答；若資料不足或無關，請明確說：「系上資料庫目前沒有相關資訊」。
+2) 不要猜測、不補充未出現在資料中的細節。
+
+【格式規則（很重要）】
+- 回答請適當分行，不要整段黏在一起。
+- 優先用條列（• 或 1./2./3.）整理重點。
+- 建議結構：
+  第一行是查詢結論
+  然後列 2–5 點相關内容的條列
+  有URL的話就放上來
+  注意事項：如有日期/資格/截止，獨立一行或條列
+- 使用繁體中文，語氣親切且專業。
+""".strip()
+
+SENTENCE_SPLIT = re.compile(r"(?<=[。！？!?；;])|\n+")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return cjk + math.ceil(other / 4)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, suffix: str = "…") -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) + estimate_tokens(suffix) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip() + suffix
+
+
+def _overlap_merge(a: str, b: str) -> str:
+    """
+    a 的結尾與 b 的開頭重疊時回傳合併後的文字，否則回傳空字串
+    """
+    for n in range(min(len(a), len(b), MAX_MERGE_OVERLAP), MIN_MERGE_OVERLAP - 1, -1):
+        if a.endswith(b[:n]):
+            return a + b[n:]
+    return ""
+
+
+def _merge_by_offset(spans: List[Tuple[int, str]]) -> List[str]:
+    """
+    spans：[(start_index, 文字), ...]（同一個來源）；重疊或相鄰（中間只隔分隔字元）的片段接成一段
+    """
+    merged: List[List] = []  # [[start, end, text], ...]
+    for start, text in sorted(spans):
+        end = start + len(text)
+        if merged and start <= merged[-1][1] + MAX_MERGE_GAP:
+            last = merged[-1]
+            if end > last[1]:
+                overlap = last[1] - start
+                last[2] = last[2] + (text[overlap:] if overlap >= 0 else "\n" + text)
+                last[1] = end
+            continue
+        merged.append([start, end, text])
+    return [m[2] for m in merged]
+
+
+def _merge_by_text(texts: List[str]) -> List[str]:
+    """
+    沒有 start_index 的舊資料庫：以文字重疊判斷（a 的結尾 = b 的開頭），被包含的片段丟掉
+    """
+    merged: List[str] = []
+    for text in texts:
+        if not text or any(text in m for m in merged):
+            continue
+        merged = [m for m in merged if m not in text]
+        changed = True
+        while changed:
+            changed = False
+            for j, m in enumerate(merged):
+                joined = _overlap_merge(m, text) or _overlap_merge(text, m)
+                if joined:
+                    text = joined
+                    del merged[j]
+                    changed = True
+                    break
+        merged.append(text)
+    return merged
+
+
+def merge_chunks(docs: List[Document]) -> List[Tuple[str, str]]:
+    """
+    回傳 [(source_file, 文字), ...]，依各來源第一次出現的名次排序
+    """
+    groups: Dict[Tuple, List[Document]] = {}
+    for i, doc in enumerate(docs):
+        meta = doc.metadata or {}
+        key = (meta.get("source_file") or f"#{i}", meta.get("page"))
+        groups.setdefault(key, []).append(doc)
+
+    blocks = []
+    for (src, _), group in groups.items():
+        texts = [(d.page_content or "").strip() for d in group]
+        if all(isinstance((d.metadata or {}).get("start_index"), int) for d in group):
+            # start_index 指向原始（未 strip）內容的開頭；strip 掉的前導空白要補回位移
+            spans = []
+            for d, t in zip(group, texts):
+                if t:
+                    spans.append((d.metadata["start_index"] + d.page_content.find(t[:1]), t))
+            merged = _merge_by_offset(spans)
+        else:
+            merged = _merge_by_text(texts)
+        blocks.extend((src, m) for m in merged)
+    return blocks
+
+
+def dedupe_lines(blocks: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    seen = set()
+    out = []
+    for src, text in blocks:
+        lines = []
+        for line in text.split("\n"):
+            key = line.strip()
+            if len(key) >= MIN_DEDUPE_LINE:
+                if key in seen:
+                    continue
+                seen.add(key)
+            lines.append(line)
+        body = "\n".join(lines).strip()
+        if body:
+            out.append((src, body))
+    return out
+
+
+def _history_pairs(history: List[Dict[str, str]]) -> List[List[Dict[str, str]]]:
+    """
+    把對話記憶切成回合（user + 後面的 assistant），丟棄時整輪一起丟
+    """
+    pairs: List[List[Dict[str, str]]] = []
+    for msg in history:
+        if msg.get("role") == "user" or not pairs:
+            pairs.append([msg])
+        else:
+            pairs[-1].append(msg)
+    return pairs
+
+
+def _msg_tokens(msgs: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(m["content"]) + 4 for m in msgs)
+
+
+def assemble_messages(system_prompt: str, history: List[Dict[str, str]], docs: List[Document],
+                      make_user_prompt: Callable[[str], str], budget: int = 3000,
+                      history_share: float = 0.3, summary_tokens: int = 80,
+                      format_block: Callable[[str, str], str] = None) -> Tuple[List[Dict[str, str]], Dict]:
+    """
+    make_user_prompt(context_text) -> 最後一則 user 訊息（含問題）
+    回傳 (messages, 統計)；統計含估算的 token 數、保留/摘要/丟棄的回合數、參考資料段數
+    """
+    format_block = format_block or (lambda src, text: f"[資料片段]: {text}")
+    blocks = dedupe_lines(merge_chunks(docs))
+
+    fixed = estimate_tokens(system_prompt) + estimate_tokens(make_user_prompt("")) + 8
+    avail = max(0, budget - fixed)
+
+    # 對話記憶最多使用 history_share 的預算；由新到舊放入，放不下的舊回合先縮成摘要，再不行就丟掉
+    pairs = _history_pairs(history)
+    hist_budget = int(avail * history_share)
+    kept: List[List[Dict[str, str]]] = []
+    used, summarized = 0, 0
+    for pair in reversed(pairs):
+        cost = _msg_tokens(pair)
+        if used + cost > hist_budget:
+            pair = [{"role": m["role"], "content": truncate_to_tokens(m["content"], summary_tokens)} for m in pair]
+            cost = _msg_tokens(pair)
+            if used + cost > hist_budget:
+                break
+            summarized += 1
+        kept.insert(0, pair)
+        used += cost
+    dropped = len(pairs) - len(kept)
+
+    # 參考資料使用剩下的預算（對話記憶沒用完的部分也給參考資料），依名次放入，最後一段可截斷
+    ctx_budget = avail - used
+    parts, ctx_used = [], 0
+    for src, text in blocks:
+        block = format_block(src, text)
+        cost = estimate_tokens(block) + 2
+        if ctx_used + cost > ctx_budget:
+            rest = ctx_budget - ctx_used - 2
+            if rest >= summary_tokens:
+                parts.append(truncate_to_tokens(block, rest))
+            break
+        parts.append(block)
+        ctx_used += cost
+
+    user_prompt = make_user_prompt("\n\n".join(parts))
+    messages = [{"role": "system", "content": system_prompt}]
+    for pair in kept:
+        messages.extend(pair)
+    messages.append({"role": "user", "content": user_prompt})
+
+    stats = {
+        "tokens": _msg_tokens(messages),
+        "blocks": len(parts),
+        "chunks": len(docs),
+        "history_turns": len(kept),
+        "history_summarized": summarized,
+        "history_dropped": dropped,
+    }
+    return messages, stats
+
+
+def rag_user_prompt(mode_label: str, context_text: str, question: str) -> str:
+    return f"""
+【查詢類別】：
+{mode_label}
+
+【參考資料】：
+{context_text}
+
+【學生問題】：
+{question}
+""".strip()
+
+
+def normalize_question(text: str) -> str:
+    """
+    問題正規化（全形轉半形、合併空白、轉小寫），作為快取與 FAQ 比對的 key
+    """
+    t = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", t).strip().lower()
+
+
+def char_bigrams(text: str) -> set:
+    t = re.sub(r"\s+", "", unicodedata.normalize("NFKC", text).lower())
+    return {t[i:i + 2] for i in range(len(t) - 1)}
+
+
+_TAG_LINE = re.compile(r"^\s*類型\s*[:：]\s*[A-Za-z0-9_]+\s*$", re.M)
+
+
+def _answer_body(doc: Document) -> str:
+    """
+    片段去掉檔案開頭的標頭（類型/標題/日期…欄位行，只在檔案的第一個片段）與類型標籤行：這些不是答案內容
+    """
+    text = doc.page_content or ""
+    if (doc.metadata or {}).get("start_index", 0) == 0:
+        _, body_start = parse_header(text)
+        text = text[body_start:]
+    return _TAG_LINE.sub("", text)
+
+
+def extractive_answer(question: str, docs: list, max_chars: int = 400) -> str:
+    """
+    不經 LLM 的快速回答：從檢索到的片段中挑出與問題字元 bigram 重疊最多的句子（依原順序列出）
+    """
+    q = char_bigrams(question)
+    scored = []
+    for rank, doc in enumerate(docs):
+        for pos, sent in enumerate(SENTENCE_SPLIT.split(_answer_body(doc))):
+            sent = (sent or "").strip().lstrip("-•*・ ").strip()
+            if len(sent) < 6:
+                continue
+            scored.append((len(q & char_bigrams(sent)), -rank, -pos, rank, pos, sent))
+    if not scored:
+        return "系上資料庫目前沒有相關資訊。"
+
+    picked, total = [], 0
+    for item in sorted(scored, reverse=True):
+        if total + len(item[5]) > max_chars and picked:
+            break
+        picked.append(item)
+        total += len(item[5])
+    picked.sort(key=lambda x: (x[3], x[4]))
+    return "\n".join("• " + x[5] for x in picked)
@@ -0,0 +1,147 @@
+"""
+帶分數的檢索（app.py 與 calibrate_retrieval.py 共用）
+
+- relevance：L2 index（建庫的預設）距離為平方 L2；embedding 為單位向量時 cosine = 1 - d/2
+- 低於門檻的片段直接丟掉；全部都不夠相關時呼叫端可以不問 LLM，直接回覆「沒有相關資訊」
+- 可選 MMR：在通過門檻的候選中兼顧相關性與多樣性（候選片段的向量直接從 index 依 id 取回，
+  index 不支援時才以建庫相同的 embedding_text 重新 embed）
+- hybrid：向量檢索與 BM25（lexical_index.py）平行查詢，以 reciprocal-rank fusion（RRF）合併
+"""
+import json
+import os
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.documents import Document
+
+from text_chunker import embedding_text
+
+
+def relevance_from_score(score: float, metric_type: int = faiss.METRIC_L2) -> float:
+    if metric_type == faiss.METRIC_INNER_PRODUCT:
+        return float(score)
+    return max(0.0, 1.0 - float(score) / 2.0)
+
+
+def vector_candidates(vs, query_vec, k: int) -> List[Tuple[int, float]]:
+    """
+    回傳 [(faiss_id, relevance), ...]（依相關度排序）
+    """
+    metric = getattr(vs.index, "metric_type", faiss.METRIC_L2)
+    scores, ids = vs.index.search(np.asarray([query_vec], dtype=np.float32), k)
+    return [(int(i), relevance_from_score(s, metric)) for s, i in zip(scores[0], ids[0]) if i != -1]
+
+
+def get_document(vs, faiss_id: int) -> Optional[Document]:
+    doc_id = vs.index_to_docstore_id.get(faiss_id)
+    doc = vs.docstore.search(doc_id) if doc_id is not None else None
+    return doc if isinstance(doc, Document) else None
+
+
+def stored_vectors(vs, faiss_ids: List[int]) -> Optional[np.ndarray]:
+    """
+    建庫時存進 index 的向量（IndexIDMap2 依 id reconstruct）；index 不支援（例如沒有 direct map 的 IVF）時回傳 None
+    """
+    try:
+        return np.vstack([vs.index.reconstruct(int(i)) for i in faiss_ids])
+    except Exception:
+        return None
+
+
+def apply_mmr(query_vec, vs, scored: List[Tuple[int, Document, float]], k: int, mmr_lambda: Optional[float],
+              embeddings=None) -> List[Tuple[Document, float]]:
+    """
+    scored：[(faiss_id, Document, 分數), ...]；回傳 [(Document, 分數), ...]
+    """
+    if mmr_lambda is None or len(scored) <= k:
+        return [(doc, r) for _, doc, r in scored[:k]]
+    try:
+        doc_vecs = stored_vectors(vs, [i for i, _, _ in scored])
+        if doc_vecs is None:
+            if embeddings is None:
+                return [(doc, r) for _, doc, r in scored[:k]]
+            doc_vecs = embeddings.embed_documents([embedding_text(doc) for _, doc, _ in scored])
+        picked = maximal_marginal_relevance(
+            np.asarray(query_vec, dtype=np.float32), doc_vecs, lambda_mult=mmr_lambda, k=k
+        )
+        return [scored[i][1:] for i in picked]
+    except Exception as e:
+        print(f"MMR failed, using plain ranking: {e}")
+        return [(doc, r) for _, doc, r in scored[:k]]
+
+
+def scored_search(vs, query_vec, k: int = 3, fetch_k: int = 10, min_relevance: float = 0.0,
+                  mmr_lambda: Optional[float] = None, embeddings=None) -> List[Tuple[Document, float]]:
+    """
+    回傳 [(Document, relevance), ...]（依相關度或 MMR 順序），只包含 relevance >= min_relevance 的片段
+    """
+    fetch = max(k, fetch_k) if mmr_lambda is not None else k
+    scored = []
+    for faiss_id, r in vector_candidates(vs, query_vec, fetch):
+        doc = get_document(vs, faiss_id) if r >= min_relevance else None
+        if doc is not None:
+            scored.append((faiss_id, doc, r))
+    return apply_mmr(query_vec, vs, scored, k, mmr_lambda, embeddings)
+
+
+def rrf_fuse(rankings: List[List[int]], k0: int = 60) -> Dict[int, float]:
+    """
+    reciprocal-rank fusion：score(id) = Σ 1 / (k0 + 名次)
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, faiss_id in enumerate(ranking, 1):
+            fused[faiss_id] = fused.get(faiss_id, 0.0) + 1.0 / (k0 + rank)
+    return fused
+
+
+def hybrid_search(vs, lexical, query_vec, question: str, k: int = 3, fetch_k: int = 10,
+                  min_relevance: float = 0.0, min_coverage: float = 0.5,
+                  mmr_lambda: Optional[float] = None, embeddings=None,
+                  executor: Optional[Executor] = None) -> List[Tuple[Document, float]]:
+    """
+    向量與 BM25 各取前 fetch_k 個候選（BM25 丟到 executor 平行執行），以 RRF 合併後取前 k 個。
+    候選要通過其中一邊的門檻才會留下：向量 relevance >= min_relevance，或 BM25 命中的查詢 token 比例 >= min_coverage。
+    回傳 [(Document, RRF 分數), ...]；lexical 為 None 時等同 scored_search。
+    """
+    if lexical is None:
+        return scored_search(vs, query_vec, k=k, fetch_k=fetch_k, min_relevance=min_relevance,
+                             mmr_lambda=mmr_lambda, embeddings=embeddings)
+
+    fetch = max(k, fetch_k)
+    lex_future = executor.submit(lexical.search, question, fetch) if executor else None
+    vec_hits = vector_candidates(vs, query_vec, fetch)
+    try:
+        lex_hits = lex_future.result() if lex_future else lexical.search(question, fetch)
+    except Exception as e:
+        print(f"Lexical search failed: {e}")
+        lex_hits = []
+
+    passed = {i for i, r in vec_hits if r >= min_relevance}
+    passed |= {i for i, _, cov in lex_hits if cov >= min_coverage}
+    fused = rrf_fuse([[i for i, _ in vec_hits], [i for i, _, _ in lex_hits]])
+
+    scored = []
+    for faiss_id in sorted(passed, key=lambda i: -fused[i]):
+        doc = get_document(vs, faiss_id)
+        if doc is not None:
+            scored.append((faiss_id, doc, fused[faiss_id]))
+    return apply_mmr(query_vec, vs, scored, k, mmr_lambda, embeddings)
+
+
+def load_thresholds(path: str) -> Dict[str, float]:
+    """
+    讀 calibrate_retrieval.py 產生的 {mode: 門檻}；檔案不存在回傳 {}
+    """
+    if not path or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return {str(k): float(v) for k, v in (data.get("thresholds") or {}).items()}
+    except Exception as e:
+        print(f"Load thresholds failed ({path}): {e}")
+        return {}
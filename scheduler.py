@@ -0,0 +1,240 @@
+"""
+webhook 事件的公平排程（app.py 用）
+
+- 同一個 key（sender；群組/房間整個算一個）的工作嚴格依提交順序執行（例如 mode= postback 一定先於之後的提問）
+- 工作分優先等級（PriorityClass，依建立順序由高到低）：有空的 worker 一律先取高優先的工作；
+  每個等級有同時執行數上限，最後 reserved 個 worker 只給最高等級用 → 選單/切換類別不會被 LLM 工作卡住
+- 同一等級內各 sender 輪流（round-robin）：一個 sender 連續丟十個問題，也只會在佇列裡佔一個位置
+- 每個 sender 在每個等級各有一個 token bucket（rate_per_min、burst）：超過速率直接拒絕；
+  等級的佇列已滿（max_queue）或排隊超過 max_wait 秒也拒絕，呼叫 on_reject(reason) 讓呼叫端回覆友善的訊息
+- worker thread 在第一次 submit 時才建立（fork 後的子 process 會自行重建）
+- run_inline：key 沒有排隊或執行中的工作時，直接在呼叫端 thread 執行（期間同一 key 新提交的工作排在它之後）
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, burst: float):
+        self.rate = rate_per_sec
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class PriorityClass:
+    """
+    limit：同時執行數上限（0 = 不限，最多用滿全部 worker）；rate_per_min / burst：每個 sender 的 token bucket（0 = 不限速）
+    max_queue：排隊中工作數上限（0 = 不限）；max_wait：排隊超過幾秒就不執行、改為拒絕（0 = 不限）
+    """
+
+    def __init__(self, name: str, limit: int = 0, rate_per_min: float = 0, burst: float = 0,
+                 max_queue: int = 0, max_wait: float = 0):
+        self.name = name
+        self.limit = limit
+        self.rate_per_min = rate_per_min
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+
+class _Task:
+    __slots__ = ("cls", "fn", "args", "future", "on_reject", "queued_at")
+
+    def __init__(self, cls: str, fn, args, future: Future, on_reject, queued_at: float):
+        self.cls = cls
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.on_reject = on_reject
+        self.queued_at = queued_at
+
+
+class FairScheduler:
+    RATE_LIMITED = "rate_limited"
+    QUEUE_FULL = "queue_full"
+    EXPIRED = "expired"
+
+    def __init__(self, workers: int, classes: List[PriorityClass], reserved: int = 1, name: str = "sched",
+                 max_buckets: int = 10000, on_wait: Optional[Callable[[str, float], None]] = None,
+                 on_rejected: Optional[Callable[[str, str], None]] = None):
+        self.workers = max(1, workers)
+        self.classes = {c.name: c for c in classes}
+        self.order = [c.name for c in classes]
+        self.reserved = min(max(0, reserved), self.workers - 1)
+        self.name = name
+        self.max_buckets = max_buckets
+        self.on_wait = on_wait
+        self.on_rejected = on_rejected
+
+        self._cond = threading.Condition()
+        self._keys: Dict[object, deque] = {}  # { key: deque[_Task] }，key 存在代表有工作排隊或執行中
+        self._ready = {c: deque() for c in self.order}  # { 等級: deque[key] }，key 的下一個工作屬於該等級
+        self._queued = {c: 0 for c in self.order}
+        self._running = {c: 0 for c in self.order}
+        self._buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+        self._pid = None
+
+    # ---- 統計 ----
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return sum(self._queued.values()) + sum(self._running.values())
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._cond:
+            return {c: {"queued": self._queued[c], "running": self._running[c]} for c in self.order}
+
+    # ---- 提交 ----
+    def _take_token(self, key, cls: PriorityClass, now: float) -> bool:
+        if cls.rate_per_min <= 0:
+            return True
+        bk = (key, cls.name)
+        bucket = self._buckets.get(bk)
+        if bucket is None:
+            bucket = self._buckets[bk] = TokenBucket(cls.rate_per_min / 60.0, max(1.0, cls.burst))
+        self._buckets.move_to_end(bk)
+        # 超過上限時淘汰最久沒用到的 bucket（閒置夠久的 bucket 早已補滿，淘汰等同重置）
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return bucket.take(now)
+
+    def submit(self, key, cls: str, fn, *args, on_reject: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        回傳 Future；被拒絕時 Future 的結果是 None，並呼叫 on_reject(reason)
+        （超速/佇列滿在呼叫端 thread 立即呼叫；排隊逾時則在輪到它時由 worker 呼叫，仍維持同一 key 的順序）
+        """
+        fut = Future()
+        c = self.classes[cls]
+        now = time.monotonic()
+        with self._cond:
+            self._ensure_workers()
+            if not self._take_token(key, c, now):
+                reason = self.RATE_LIMITED
+            elif c.max_queue > 0 and self._queued[cls] >= c.max_queue:
+                reason = self.QUEUE_FULL
+            else:
+                reason = None
+                task = _Task(cls, fn, args, fut, on_reject, now)
+                self._queued[cls] += 1
+                q = self._keys.get(key)
+                if q is None:
+                    self._keys[key] = deque([task])
+                    self._ready[cls].append(key)
+                    self._cond.notify()
+                else:
+                    q.append(task)
+        if reason:
+            self._reject(cls, reason, on_reject, fut)
+        return fut
+
+    def run_inline(self, key, fn, *args) -> bool:
+        """
+        key 目前閒置（沒有排隊或執行中的工作）才在呼叫端 thread 執行 fn 並回傳 True；否則不執行、回傳 False，
+        呼叫端應改用 submit 排在該 key 既有的工作之後
+        """
+        with self._cond:
+            if key in self._keys:
+                return False
+            # 空的 deque 代表該 key 執行中：期間 submit 的工作只會排進 deque，等這裡結束才進入 ready
+            self._keys[key] = deque()
+        try:
+            fn(*args)
+        finally:
+            with self._cond:
+                q = self._keys[key]
+                if q:
+                    self._ready[q[0].cls].append(key)
+                else:
+                    del self._keys[key]
+                self._cond.notify_all()
+        return True
+
+    def _reject(self, cls: str, reason: str, on_reject, fut: Future):
+        if self.on_rejected:
+            self.on_rejected(cls, reason)
+        try:
+            if on_reject:
+                on_reject(reason)
+        finally:
+            fut.set_result(None)
+
+    # ---- worker ----
+    def _ensure_workers(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._loop, name=f"{self.name}_{i}", daemon=True).start()
+
+    def _pick(self):
+        heavy = sum(self._running[c] for c in self.order[1:])
+        for i, cls in enumerate(self.order):
+            ready = self._ready[cls]
+            if not ready:
+                continue
+            limit = self.classes[cls].limit
+            if limit > 0 and self._running[cls] >= limit:
+                continue
+            if i > 0 and heavy >= self.workers - self.reserved:
+                continue
+            key = ready.popleft()
+            task = self._keys[key].popleft()
+            self._queued[cls] -= 1
+            self._running[cls] += 1
+            return key, task
+        return None
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                picked = self._pick()
+                while picked is None:
+                    self._cond.wait()
+                    picked = self._pick()
+            key, task = picked
+            try:
+                self._run(task)
+            finally:
+                with self._cond:
+                    self._running[task.cls] -= 1
+                    q = self._keys[key]
+                    if q:
+                        # 排到該等級的最後面：同等級的其他 sender 先輪
+                        self._ready[q[0].cls].append(key)
+                    else:
+                        del self._keys[key]
+                    self._cond.notify_all()
+
+    def _run(self, task: _Task):
+        waited = time.monotonic() - task.queued_at
+        if self.on_wait:
+            self.on_wait(task.cls, waited)
+        max_wait = self.classes[task.cls].max_wait
+        if max_wait > 0 and waited > max_wait:
+            try:
+                self._reject(task.cls, self.EXPIRED, task.on_reject, task.future)
+            except Exception as e:
+                print(f"Scheduler on_reject failed: {e!r}")
+            return
+        if not task.future.set_running_or_notify_cancel():
+            return
+        try:
+            task.future.set_result(task.fn(*task.args))
+        except BaseException as e:
+            task.future.set_exception(e)
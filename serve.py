@@ -0,0 +1,109 @@
+"""
+正式環境的多 worker 啟動方式（pre-fork）：python serve.py
+
+- master 先載入 embedding 模型權重與四個 FAISS 資料庫，再 fork 出 SERVE_WORKERS 個 worker：
+  模型權重以 copy-on-write 共用、mmap 的 index / docstore 共用 page cache，記憶體不隨 worker 數倍增
+- 所有 worker 在同一個 listening socket 上 accept（由 kernel 分配連線），每個 worker 內以 thread 處理請求
+- sender 狀態必須跨 process 一致：固定使用 STATE_BACKEND=sqlite（WAL，多 process 可同時讀寫）
+- worker 異常結束時 master 自動重新 fork；SIGTERM / SIGINT 時通知全部 worker 結束
+- 答案快取、問題 embedding 快取與 /metrics 的數值是各 worker 各自的
+"""
+import os
+import signal
+import socket
+import sys
+import time
+
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "5000"))
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", str(os.cpu_count() or 1)))
+SERVE_BACKLOG = int(os.environ.get("SERVE_BACKLOG", "128"))
+# worker 異常結束後等待幾秒再重新 fork（避免啟動即崩潰時不停重啟）
+SERVE_RESTART_DELAY = float(os.environ.get("SERVE_RESTART_DELAY", "1"))
+
+# 必須在 import app（以及 torch / onnxruntime）之前設定：
+# - 模型與資料庫由 master 在 fork 前載入，不使用背景 warm-up thread
+# - 熱更新 watcher 只在 worker 內執行（master 的資料庫沒有人使用，不必重新載入）
+# - 每個 worker 的推論 thread 數平分 CPU，避免 N 個 worker 各自開滿全部核心
+os.environ["INDEX_LAZY_LOAD"] = "1"
+os.environ["INDEX_WARMUP"] = "0"
+os.environ["INDEX_WATCHER_IN_PARENT"] = "0"
+os.environ.setdefault("STATE_BACKEND", "sqlite")
+_threads = str(max(1, (os.cpu_count() or 1) // max(1, SERVE_WORKERS)))
+os.environ.setdefault("OMP_NUM_THREADS", _threads)
+os.environ.setdefault("EMBED_ONNX_THREADS", _threads)
+
+
+def run_worker(sock: socket.socket, wsgi_app):
+    from werkzeug.serving import make_server
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = make_server(HOST, PORT, wsgi_app, threaded=True, fd=sock.fileno())
+    print(f"✅ Worker {os.getpid()} serving on {HOST}:{PORT}")
+    server.serve_forever()
+
+
+def main():
+    if os.environ["STATE_BACKEND"].strip().lower() != "sqlite":
+        print(f"❌ serve.py needs STATE_BACKEND=sqlite (got {os.environ['STATE_BACKEND']!r}): "
+              f"memory / firebase backends cache sender state inside each worker.")
+        sys.exit(1)
+
+    # socket 在 fork 前建立，全部 worker 共用；non-blocking：其他 worker 先 accept 走連線時不會卡住
+    sock = socket.create_server((HOST, PORT), backlog=SERVE_BACKLOG)
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+
+    import app as guides
+    from embedding_backend import EMBED_BACKEND
+
+    # torch 的權重可在 fork 前載入共用；onnxruntime session 帶有 thread pool，不能跨 fork，由各 worker 自行載入
+    guides.warm_up(load_model=EMBED_BACKEND == "hf", forward=False)
+
+    workers = {}  # { pid: worker 編號 }
+    stopping = False
+
+    def spawn(n: int):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock, guides.app)
+            finally:
+                os._exit(0)
+        workers[pid] = n
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for n in range(SERVE_WORKERS):
+        spawn(n)
+    print(f"✅ Master {os.getpid()}: {SERVE_WORKERS} workers on {HOST}:{PORT}")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        n = workers.pop(pid, None)
+        if n is None or stopping:
+            continue
+        print(f"⚠️ Worker {pid} exited (status={status}), restarting")
+        time.sleep(SERVE_RESTART_DELAY)
+        if not stopping:
+            spawn(n)
+    print("Master exit.")
+
+
+if __name__ == "__main__":
+    main()
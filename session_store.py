@@ -0,0 +1,386 @@
+"""
+對話記憶的 write-behind session 層與 sender 狀態儲存後端（app.py 用）
+
+- 讀：每個 sender 一個 process 內的 ring buffer（最近 keep 則）；第一次遇到的 sender 才從遠端載入一次
+- 寫：只更新 ring buffer，變更（新增的 key、被擠出 ring 的舊 key = None）累積成一份 multi-path update，
+      背景 thread 每 flush_interval 秒合併送出一次（Firebase RTDB 的 ref.update({path: value, ...})）
+
+遠端存取以兩個 callback 注入，方便替換儲存後端：
+- loader(sender_id) -> [(key, {"role": ..., "content": ...}), ...]（依 key 排序）
+- writer(updates)  -> None，updates 的 key 為相對於根節點的路徑，例如 "<sender>/history/<key>"
+
+另提供可替換的 StateBackend（mode + 對話記憶）：記憶體 LRU/TTL、本機 SQLite、Firebase。
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from firebase_admin import db as firebase_db
+
+
+HistoryItem = Tuple[str, Dict[str, str]]
+
+
+class _Session:
+    __slots__ = ("items", "last_key")
+
+    def __init__(self, keep: int):
+        self.items = deque(maxlen=keep)  # [(key, {"role", "content"})]
+        self.last_key = 0
+
+
+class WriteBehindHistory:
+    def __init__(self, loader: Callable[[str], List[HistoryItem]], writer: Callable[[Dict], None],
+                 keep: int = 8, max_senders: int = 10000, flush_interval: float = 0.5):
+        self._loader = loader
+        self._writer = writer
+        self.keep = keep
+        self.max_senders = max_senders
+        self.flush_interval = flush_interval
+
+        self._lock = threading.RLock()
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._pending: Dict[str, Optional[dict]] = {}
+        self._flush_lock = threading.Lock()
+
+        if flush_interval > 0:
+            threading.Thread(target=self._flush_loop, name="history-flusher", daemon=True).start()
+        atexit.register(self.flush)
+
+    # ---------------------------------------------------------------------
+    # internals
+    # ---------------------------------------------------------------------
+    @staticmethod
+    def _history_path(sender_id: str) -> str:
+        return f"{sender_id}/history"
+
+    def _stage(self, sender_id: str, key: str, value: Optional[dict]):
+        """
+        加入一筆待寫入的變更。若同一批已經排了「整個 history 節點」的覆寫（clear 之後），
+        就併進那個節點，避免同一次 multi-path update 內出現父子路徑衝突。
+        """
+        parent = self._history_path(sender_id)
+        if parent in self._pending:
+            node = dict(self._pending[parent] or {})
+            if value is None:
+                node.pop(key, None)
+            else:
+                node[key] = value
+            self._pending[parent] = node or None
+        else:
+            self._pending[f"{parent}/{key}"] = value
+
+    def _session(self, sender_id: str) -> _Session:
+        with self._lock:
+            sess = self._sessions.get(sender_id)
+            if sess is not None:
+                self._sessions.move_to_end(sender_id)
+                return sess
+            has_pending = any(k.startswith(self._history_path(sender_id)) for k in self._pending)
+
+        # 本地沒有：先把這個 sender 尚未送出的變更寫出，再從遠端載入一次
+        if has_pending:
+            self.flush()
+        try:
+            items = self._loader(sender_id) or []
+        except Exception as e:
+            print("history load error:", e)
+            items = []
+
+        with self._lock:
+            sess = self._sessions.get(sender_id)
+            if sess is not None:
+                return sess
+            sess = _Session(self.keep)
+            for key, item in items:
+                if len(sess.items) == self.keep:
+                    # 遠端多出來的舊記錄順便刪掉
+                    self._stage(sender_id, sess.items[0][0], None)
+                sess.items.append((key, item))
+                try:
+                    sess.last_key = max(sess.last_key, int(key))
+                except ValueError:
+                    pass
+            self._sessions[sender_id] = sess
+            while len(self._sessions) > self.max_senders:
+                self._sessions.popitem(last=False)
+            return sess
+
+    # ---------------------------------------------------------------------
+    # public API
+    # ---------------------------------------------------------------------
+    def load(self, sender_id: str, limit: int = 8) -> List[Dict[str, str]]:
+        sess = self._session(sender_id)
+        with self._lock:
+            items = list(sess.items)[-limit:] if limit else list(sess.items)
+        return [dict(v) for _, v in items if v.get("role") in ("user", "assistant") and v.get("content")]
+
+    def append(self, sender_id: str, role: str, content: str):
+        if role not in ("user", "assistant") or not content:
+            return
+        sess = self._session(sender_id)
+        with self._lock:
+            # 毫秒時間戳作 key（天然可排序）；同一毫秒內連續寫入時遞增，避免互相覆蓋
+            key_num = max(int(time.time() * 1000), sess.last_key + 1)
+            sess.last_key = key_num
+            if len(sess.items) == self.keep:
+                self._stage(sender_id, sess.items[0][0], None)
+            item = {"role": role, "content": content}
+            sess.items.append((str(key_num), item))
+            self._stage(sender_id, str(key_num), item)
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def clear(self, sender_id: str):
+        with self._lock:
+            sess = self._sessions.get(sender_id)
+            if sess is None:
+                sess = _Session(self.keep)
+                self._sessions[sender_id] = sess
+            sess.items.clear()
+            parent = self._history_path(sender_id)
+            for k in [k for k in self._pending if k.startswith(parent + "/")]:
+                del self._pending[k]
+            self._pending[parent] = None
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def flush(self):
+        """
+        把累積的變更合併成一次 multi-path update 送出；失敗時放回佇列下次重試
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                updates, self._pending = self._pending, {}
+            try:
+                self._writer(updates)
+            except Exception as e:
+                print("history flush error:", e)
+                with self._lock:
+                    # 較新的變更優先；與新變更有父子路徑關係的舊變更丟棄
+                    for k, v in updates.items():
+                        if any(k == p or k.startswith(p + "/") or p.startswith(k + "/") for p in self._pending):
+                            continue
+                        self._pending[k] = v
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+# =============================================================================
+# Pluggable state backends（mode + 對話記憶）
+# =============================================================================
+class StateBackend:
+    """
+    每個 sender 的狀態儲存介面：目前 mode 與同一 mode 內的對話記憶。
+    app.py 的 handle_postback / handle_text_message / generate_rag_response 只透過這個介面存取。
+    """
+
+    def get_mode(self, sender_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set_mode(self, sender_id: str, mode: str):
+        raise NotImplementedError
+
+    def load_history(self, sender_id: str, limit: int = 8) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+    def append_history(self, sender_id: str, role: str, content: str):
+        raise NotImplementedError
+
+    def clear_history(self, sender_id: str):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    process 內 LRU + TTL：最多 max_senders 位，超過 ttl 秒沒有互動的 sender 視為不存在。重啟即清空。
+    """
+
+    def __init__(self, keep: int = 8, max_senders: int = 10000, ttl: float = 86400):
+        self.keep = keep
+        self.max_senders = max_senders
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[str, dict]" = OrderedDict()  # { sender: {"mode", "history", "ts"} }
+
+    def _entry(self, sender_id: str, create: bool = False) -> Optional[dict]:
+        now = time.time()
+        entry = self._data.get(sender_id)
+        if entry is not None and self.ttl > 0 and now - entry["ts"] > self.ttl:
+            del self._data[sender_id]
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            entry = {"mode": None, "history": deque(maxlen=self.keep), "ts": now}
+            self._data[sender_id] = entry
+            while len(self._data) > self.max_senders:
+                self._data.popitem(last=False)
+        entry["ts"] = now
+        self._data.move_to_end(sender_id)
+        return entry
+
+    def get_mode(self, sender_id: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entry(sender_id)
+            return entry["mode"] if entry else None
+
+    def set_mode(self, sender_id: str, mode: str):
+        with self._lock:
+            self._entry(sender_id, create=True)["mode"] = mode
+
+    def load_history(self, sender_id: str, limit: int = 8) -> List[Dict[str, str]]:
+        with self._lock:
+            entry = self._entry(sender_id)
+            items = list(entry["history"]) if entry else []
+        return [dict(v) for v in (items[-limit:] if limit else items)]
+
+    def append_history(self, sender_id: str, role: str, content: str):
+        if role not in ("user", "assistant") or not content:
+            return
+        with self._lock:
+            self._entry(sender_id, create=True)["history"].append({"role": role, "content": content})
+
+    def clear_history(self, sender_id: str):
+        with self._lock:
+            entry = self._entry(sender_id)
+            if entry:
+                entry["history"].clear()
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    本機 SQLite：重啟後仍記得回訪使用者的 mode 與對話記憶，不需要網路往返
+    """
+
+    def __init__(self, path: str, keep: int = 8):
+        self.keep = keep
+        self.path = path
+        self._open()
+        # 多 process（serve.py pre-fork）共用同一個檔案：sqlite 連線不能跨 fork 沿用，子 process 重新連線
+        os.register_at_fork(after_in_child=self._open)
+
+    def _open(self):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS modes (sender TEXT PRIMARY KEY, mode TEXT, updated_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " sender TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL,"
+            " PRIMARY KEY (sender, seq))"
+        )
+
+    def get_mode(self, sender_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT mode FROM modes WHERE sender = ?", (sender_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_mode(self, sender_id: str, mode: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO modes VALUES (?, ?, ?) "
+                "ON CONFLICT(sender) DO UPDATE SET mode = excluded.mode, updated_at = excluded.updated_at",
+                (sender_id, mode, time.time()),
+            )
+
+    def load_history(self, sender_id: str, limit: int = 8) -> List[Dict[str, str]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM history WHERE sender = ? ORDER BY seq DESC LIMIT ?",
+                (sender_id, limit or self.keep),
+            ).fetchall()
+        return [{"role": r, "content": c} for r, c in reversed(rows)]
+
+    def append_history(self, sender_id: str, role: str, content: str):
+        if role not in ("user", "assistant") or not content:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT MAX(seq) FROM history WHERE sender = ?", (sender_id,)).fetchone()
+                seq = (row[0] or 0) + 1
+                self._conn.execute("INSERT INTO history VALUES (?, ?, ?, ?)", (sender_id, seq, role, content))
+                self._conn.execute(
+                    "DELETE FROM history WHERE sender = ? AND seq <= ?", (sender_id, seq - self.keep)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def clear_history(self, sender_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM history WHERE sender = ?", (sender_id,))
+
+
+class FirebaseStateBackend(StateBackend):
+    """
+    Firebase RTDB（TempMemory/<sender>/mode、TempMemory/<sender>/history）：
+    - mode：process 內 LRU/TTL 快取，miss 才讀 Firebase
+    - history：WriteBehindHistory（ring buffer 讀取 + 合併寫回）
+    """
+
+    def __init__(self, root: str = "TempMemory", keep: int = 8, max_senders: int = 10000,
+                 flush_interval: float = 0.5, ttl: float = 86400):
+        self.root = root
+        self._modes = MemoryStateBackend(keep=0, max_senders=max_senders, ttl=ttl)
+        self._history = WriteBehindHistory(
+            loader=self._read_history, writer=self._update,
+            keep=keep, max_senders=max_senders, flush_interval=flush_interval,
+        )
+
+    def _read_history(self, sender_id: str) -> List[HistoryItem]:
+        data = firebase_db.reference(f"{self.root}/{sender_id}/history").get() or {}
+        return sorted(data.items(), key=lambda x: x[0])
+
+    def _update(self, updates: Dict):
+        # multi-path update：一次送出多個路徑的變更（value 為 None 代表刪除）
+        firebase_db.reference(self.root).update(updates)
+
+    def get_mode(self, sender_id: str) -> Optional[str]:
+        mode = self._modes.get_mode(sender_id)
+        if mode:
+            return mode
+        try:
+            mode = firebase_db.reference(f"{self.root}/{sender_id}/mode").get()
+        except Exception as e:
+            print("firebase get_mode error:", e)
+            return None
+        if mode:
+            self._modes.set_mode(sender_id, mode)
+        return mode
+
+    def set_mode(self, sender_id: str, mode: str):
+        self._modes.set_mode(sender_id, mode)
+        try:
+            firebase_db.reference(f"{self.root}/{sender_id}").update({"mode": mode})
+        except Exception as e:
+            print("firebase set_mode error:", e)
+
+    def load_history(self, sender_id: str, limit: int = 8) -> List[Dict[str, str]]:
+        return self._history.load(sender_id, limit=limit)
+
+    def append_history(self, sender_id: str, role: str, content: str):
+        self._history.append(sender_id, role, content)
+
+    def clear_history(self, sender_id: str):
+        self._history.clear(sender_id)
+
+    def flush(self):
+        self._history.flush()
@@ -0,0 +1,218 @@
+"""
+中文/段落感知的切 chunk（build_faiss_db.py 用，取代 RecursiveCharacterTextSplitter）
+
+- 檔案開頭的「類型：…／標題：…／學制：…」標頭解析成 dict，放進每個 chunk 的 metadata（header、title），
+  後面的 chunk 雖然不含標頭文字，仍知道自己屬於哪份文件
+- 以標題行（「一、」「第二章」「# 」「【…】」「重點摘要：」這類以冒號結尾的短行）分段；
+  相鄰的小段落合併到 chunk_size 為止，段落放不下才換新 chunk（段落邊界不重疊）
+- 段落太長才在段內切：只在句子邊界（。！？；!?; 或換行）切，重疊部分也是完整的句子（最多 chunk_overlap 字）；
+  單一句子超過 chunk_size 才在逗號/空白處硬切
+- 每個字元只掃過常數次（線性時間）；page_content 是原文的連續片段，start_index 與 prompt_builder 的合併相容
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+
+TITLE_FIELDS = ("標題", "名稱", "課程名稱", "實驗室", "姓名", "主題")
+
+_HEADER_LINE = re.compile(r"^\s*([^\s:：]{1,12})\s*[:：]\s*(\S.*?)\s*$")
+# 段落標題行（re.M：一次 finditer 找出全文所有標題行的行首）
+_HEADING_LINE = re.compile(
+    r"^[ \t　]*(?:[一二三四五六七八九十]+[ \t]*[、.．]"
+    r"|第[一二三四五六七八九十百\d]+[章節條項部]"
+    r"|#{1,6}[ \t]"
+    r"|【[^】\n]{1,30}】[ \t]*$"
+    r"|[^\s:：。！？]{2,30}[:：][ \t]*$)",
+    re.M,
+)
+_SENTENCE_END = re.compile(r"[。！？!?；;]+[」』”’）)]*|\n")
+_SOFT_BREAK = re.compile(r"[，、,：:\s]")
+
+
+def parse_header(text: str) -> Tuple[Dict[str, str], int]:
+    """
+    開頭連續的「欄位：內容」行 → ({欄位: 內容}, 標頭結束的位置)；第一行不是欄位則沒有標頭
+    """
+    header: Dict[str, str] = {}
+    pos = 0
+    n = len(text)
+    while pos < n:
+        end = text.find("\n", pos)
+        end = n if end < 0 else end + 1
+        line = text[pos:end]
+        if not line.strip():
+            if header:
+                break
+            pos = end
+            continue
+        m = _HEADER_LINE.match(line)
+        if not m or _HEADING_LINE.match(line):
+            break
+        header.setdefault(m.group(1), m.group(2))
+        pos = end
+    return header, (pos if header else 0)
+
+
+def header_title(header: Dict[str, str]) -> str:
+    for key in TITLE_FIELDS:
+        if header.get(key):
+            return header[key]
+    return ""
+
+
+class CJKTextSplitter:
+    """
+    與 RecursiveCharacterTextSplitter 相同的用法：split_documents(docs) / split_text(text)
+    """
+
+    def __init__(self, chunk_size: int = 900, chunk_overlap: int = 150):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    # ---- 切分 ----
+    def _sections(self, text: str, start: int) -> List[Tuple[int, int, Optional[str]]]:
+        """
+        [(開始, 結束, 標題行 或 None), ...]；標頭（start 之前）自成一段
+        """
+        sections = []
+        if start > 0:
+            sections.append((0, start, None))
+        sec_start, heading = start, None
+        n = len(text)
+        for m in _HEADING_LINE.finditer(text, start):
+            pos = m.start()
+            if pos > sec_start and text[sec_start:pos].strip():
+                sections.append((sec_start, pos, heading))
+            end = text.find("\n", pos)
+            sec_start, heading = pos, text[pos:n if end < 0 else end].strip()
+        if text[sec_start:n].strip():
+            sections.append((sec_start, n, heading))
+        return sections
+
+    def _units(self, text: str, start: int, end: int) -> List[Tuple[int, int]]:
+        """
+        句子（含結尾標點/換行）；超過 chunk_size 的句子在逗號/空白處切成多段
+        """
+        units = []
+        pos = start
+        size = self.chunk_size
+        for m in _SENTENCE_END.finditer(text, start, end):
+            e = m.end()
+            if e - pos > size:
+                units.extend(self._hard_split(text, pos, e))
+            else:
+                units.append((pos, e))
+            pos = e
+        if pos < end:
+            units.extend(self._hard_split(text, pos, end))
+        return units
+
+    def _hard_split(self, text: str, start: int, end: int) -> List[Tuple[int, int]]:
+        out = []
+        size = self.chunk_size
+        while end - start > size:
+            cut = start + size
+            # 在後半段找最後一個逗號/空白
+            for i in range(cut - 1, start + size // 2, -1):
+                if _SOFT_BREAK.match(text[i]):
+                    cut = i + 1
+                    break
+            out.append((start, cut))
+            start = cut
+        if end > start:
+            out.append((start, end))
+        return out
+
+    def _pack_section(self, text: str, start: int, end: int) -> List[Tuple[int, int]]:
+        """
+        長段落：句子依序裝進 chunk，換 chunk 時帶上前一個 chunk 結尾的完整句子（總長不超過 chunk_overlap）
+        """
+        chunks = []
+        units = self._units(text, start, end)
+        first = 0  # 目前 chunk 的第一個句子
+        for i, (u_start, u_end) in enumerate(units):
+            if u_end - units[first][0] <= self.chunk_size:
+                continue
+            chunks.append((units[first][0], units[i - 1][1]))
+            # 重疊：從上一個 chunk 結尾往回取完整句子，且加上目前這句仍不超過 chunk_size
+            j = i
+            while j > first + 1 and units[i - 1][1] - units[j - 1][0] <= self.chunk_overlap \
+                    and u_end - units[j - 1][0] <= self.chunk_size:
+                j -= 1
+            first = j
+        chunks.append((units[first][0], units[-1][1]))
+        return chunks
+
+    def split_spans(self, text: str) -> Tuple[Dict[str, str], List[Tuple[int, int, Optional[str]]]]:
+        """
+        回傳 (標頭, [(開始, 結束, 所屬段落標題), ...])；範圍已去除前後空白
+        """
+        header, body_start = parse_header(text)
+        spans: List[Tuple[int, int, Optional[str]]] = []
+        cur: Optional[List] = None  # [開始, 結束, 標題]：相鄰小段落合併中的 chunk
+        for s, e, heading in self._sections(text, body_start):
+            if cur is not None and e - cur[0] <= self.chunk_size:
+                cur[1] = e
+                continue
+            if cur is not None:
+                spans.append(tuple(cur))
+                cur = None
+            if e - s <= self.chunk_size:
+                cur = [s, e, heading]
+                continue
+            spans.extend((cs, ce, heading) for cs, ce in self._pack_section(text, s, e))
+        if cur is not None:
+            spans.append(tuple(cur))
+
+        out = []
+        for s, e, heading in spans:
+            while s < e and text[s].isspace():
+                s += 1
+            while e > s and text[e - 1].isspace():
+                e -= 1
+            if e > s:
+                out.append((s, e, heading))
+        return header, out
+
+    def split_text(self, text: str) -> List[str]:
+        _, spans = self.split_spans(text or "")
+        return [text[s:e] for s, e, _ in spans]
+
+    def split_documents(self, docs: List[Document]) -> List[Document]:
+        """
+        同一個檔案的多個 Document（PDF 每頁一個）：標頭取自第一頁，套用到全部 chunk
+        metadata 另外加上 start_index、header、title、section
+        """
+        chunks = []
+        file_header: Optional[Dict[str, str]] = None
+        for doc in docs:
+            text = doc.page_content or ""
+            header, spans = self.split_spans(text)
+            if file_header is None:
+                file_header = header
+            title = header_title(file_header)
+            for s, e, heading in spans:
+                meta = dict(doc.metadata or {})
+                meta["start_index"] = s
+                if file_header:
+                    meta["header"] = dict(file_header)
+                if title:
+                    meta["title"] = title
+                if heading:
+                    meta["section"] = heading
+                chunks.append(Document(page_content=text[s:e], metadata=meta))
+        return chunks
+
+
+def embedding_text(doc: Document) -> str:
+    """
+    embed 用的文字：chunk 本身沒有文件標題/段落標題時補在前面（存進 docstore 的 page_content 不變）
+    """
+    meta = doc.metadata or {}
+    text = doc.page_content or ""
+    prefix = [p for p in (meta.get("title"), meta.get("section")) if p and p not in text]
+    return "\n".join(prefix + [text]) if prefix else text